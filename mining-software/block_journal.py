@@ -0,0 +1,100 @@
+#  Copyright (C) 2022 Jan Sturm
+#
+#  This program is free software: you can redistribute it and/or modify it under
+#  the terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  This program is distributed in the hope that it will be useful, but WITHOUT
+#  ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or FITNESS
+#  FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Durable journal of found blocks, that were not yet submitted successfully"""
+
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Optional
+
+from custom_logger import logger
+
+
+class BlockJournal:
+    """
+    Append-only journal (JSON lines) of pending blocks.
+
+    Each found block is written to disk (and synced) before its submission, so that it survives a crash or restart of
+    the miner. Every pending block is a dict with 'hash' and 'prevhash' (hex, RPC byte order), 'height' and the
+    hex-encoded 'block'. A submitted block is marked as removed, the file is deleted once no block is pending.
+    Without a path, the journal is kept in memory only.
+
+    The methods do blocking file I/O, the miner calls them in an executor. A lock serializes them, so that removing a
+    block (and deleting the file) never interleaves with appending another one.
+
+    :param path: optional path of the journal file
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = Path(path) if path else None
+        self.__pending: dict[str, dict] = {}
+        self.__lock = threading.Lock()
+        if self.path and self.path.exists():
+            self.__load()
+
+    def __str__(self):
+        return f"<BlockJournal [{self.path or 'in-memory'}, pending={len(self.__pending)}]>"
+
+    def pending(self) -> list[dict]:
+        """Returns all pending blocks in the order they were found"""
+        with self.__lock:
+            return list(self.__pending.values())
+
+    def add(self, entry: dict) -> None:
+        """
+        Adds a pending block
+
+        :param entry: pending block with 'hash', 'prevhash', 'height' and 'block'
+        """
+        with self.__lock:
+            self.__pending[entry["hash"]] = entry
+            self.__append(dict(add=entry))
+
+    def remove(self, block_hash: str) -> None:
+        """
+        Removes a pending block, e.g. after its submission
+
+        :param block_hash: hash of the block (hex, RPC byte order)
+        """
+        with self.__lock:
+            if self.__pending.pop(block_hash, None) is None:
+                return
+            if not self.__pending and self.path:
+                self.path.unlink(missing_ok=True)
+            else:
+                self.__append(dict(remove=block_hash))
+
+    def __append(self, record: dict) -> None:
+        if not self.path:
+            return
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def __load(self) -> None:
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # incomplete last line after a crash
+                    logger.debug(f"Skipping corrupted line in {self.path}")
+                    continue
+                if "add" in record:
+                    self.__pending[record["add"]["hash"]] = record["add"]
+                elif "remove" in record:
+                    self.__pending.pop(record["remove"], None)
@@ -0,0 +1,135 @@
+#  Copyright (C) 2022 Jan Sturm
+#
+#  This program is free software: you can redistribute it and/or modify it under
+#  the terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  This program is distributed in the hope that it will be useful, but WITHOUT
+#  ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or FITNESS
+#  FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Lightweight serializer for coinbase transactions (byte-compatible with bitcoinlib's Transaction.raw())"""
+
+import struct
+from functools import lru_cache
+from typing import Optional
+
+import bitcoinlib.encoding
+from bitcoinlib.encoding import int_to_varbyteint
+from bitcoinlib.keys import deserialize_address
+
+# script templates (prefix, suffix) for the public key hash / script hash of an address
+SCRIPT_TEMPLATES = {
+    "p2pkh": (bytes.fromhex("76a914"), bytes.fromhex("88ac")),
+    "p2sh": (bytes.fromhex("a914"), bytes.fromhex("87")),
+    "p2wpkh": (bytes.fromhex("0014"), b""),
+    "p2wsh": (bytes.fromhex("0020"), b""),
+}
+
+
+@lru_cache(maxsize=16)
+def address_script(address: str) -> bytes:
+    """
+    Creates the locking script (scriptPubKey) for the given address.
+
+    :param address: base58 or bech32 encoded address
+    :raises ValueError if the address is invalid or has an unsupported script type
+    :return: locking script
+    """
+    try:
+        decoded = deserialize_address(address)
+    except bitcoinlib.encoding.EncodingError as e:
+        raise ValueError(e)
+    if not decoded["network"]:
+        raise ValueError("Invalid coinbase address")
+    if decoded["script_type"] not in SCRIPT_TEMPLATES:
+        raise ValueError(
+            f"Unsupported coinbase address type '{decoded['script_type']}'"
+        )
+    prefix, suffix = SCRIPT_TEMPLATES[decoded["script_type"]]
+    return prefix + bytes.fromhex(decoded["public_key_hash"]) + suffix
+
+
+def parse_message(message: str) -> bytes:
+    """
+    Converts the coinbase message into bytes.
+
+    :param message: message with prefix 'hex:' (hexadecimal encoded) or 'str:' (text, default)
+    :return: message bytes
+    """
+    if message.startswith("hex:"):
+        return bytes.fromhex(message[4:])
+    return message[4 * message.startswith("str:") :].encode()
+
+
+class CoinbaseBuilder:
+    """
+    Builds raw coinbase transactions for a single block template without any transaction objects.
+
+    Everything but the extranonce is serialized once, a coinbase transaction is then assembled as
+    [prefix | extranonce | suffix], where
+    prefix = [version | input count | prev_txid | prev_index | scriptSig length | BIP 34 height (| extranonce push)]
+    suffix = [message | sequence | outputs | locktime].
+
+    :param height: block height
+    :param value: coinbase value in satoshi
+    :param cb_config: user specific coinbase data (message, address and optional extranonce size)
+    :param witness_commitment: optional witness commitment script (hex), which is added as additional output
+    :raises ValueError if the coinbase address is invalid
+    """
+
+    def __init__(
+        self,
+        height: int,
+        value: int,
+        cb_config: dict,
+        witness_commitment: Optional[str] = None,
+    ):
+        self.extranonce_size = cb_config.get("extranonce_size", 0)
+
+        # see BIP 34 (https://en.bitcoin.it/wiki/BIP_0034) for height of block in coinbase scriptSig
+        height_width = (height.bit_length() + 7) // 8
+        script_height = bytes([height_width]) + height.to_bytes(
+            height_width, byteorder="little"
+        )
+        if self.extranonce_size:
+            script_height += bytes([self.extranonce_size])
+        message = parse_message(cb_config["message"])
+        script_len = len(script_height) + self.extranonce_size + len(message)
+
+        outputs = [(value, address_script(cb_config["address"]))]
+        if witness_commitment:
+            outputs.append((0, bytes.fromhex(witness_commitment)))
+
+        self.prefix = (
+            struct.pack("<L", 1)
+            + b"\x01"
+            + bytes(32)
+            + struct.pack("<L", 0xFFFFFFFF)
+            + int_to_varbyteint(script_len)
+            + script_height
+        )
+        self.suffix = (
+            message
+            + struct.pack("<L", 0xFFFFFFFF)
+            + int_to_varbyteint(len(outputs))
+            + b"".join(
+                struct.pack("<Q", value) + int_to_varbyteint(len(script)) + script
+                for value, script in outputs
+            )
+            + struct.pack("<L", 0)
+        )
+
+    def build(self, extranonce: bytes = b"") -> bytes:
+        """
+        Assembles the raw coinbase transaction for the given extranonce
+
+        :param extranonce: extranonce of size 'extranonce_size'
+        :return: serialized coinbase transaction (without witness)
+        """
+        assert len(extranonce) == self.extranonce_size
+        return self.prefix + extranonce + self.suffix
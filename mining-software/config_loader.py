@@ -72,6 +72,49 @@ parser.add_argument(
     help=f"password for bitcoin json-rpc server (default '{miner_config['rpc']['password']}')",
 )
 
+# [metrics]
+parser.add_argument(
+    "--metrics-port",
+    metavar="<port>",
+    dest="metrics.port",
+    type=check_positive_int,
+    help=f"Serve metrics in OpenMetrics text format on this port "
+    f"(default '{miner_config.get('metrics', {}).get('port', 9100)}' if enabled in config)",
+)
+parser.add_argument(
+    "--metrics",
+    dest="metrics.http",
+    action="store_true",
+    help="Enable the metrics endpoint (see --metrics-port)",
+)
+
+# [stratum]
+parser.add_argument(
+    "--stratum-server",
+    dest="stratum.server",
+    action="store_true",
+    help="Serve the block templates to remote workers via Stratum V1 (see --stratum-port)",
+)
+parser.add_argument(
+    "--stratum-port",
+    metavar="<port>",
+    dest="stratum.port",
+    type=check_positive_int,
+    help=f"Port of the Stratum server (default '{miner_config.get('stratum', {}).get('port', 3333)}')",
+)
+parser.add_argument(
+    "--stratum-url",
+    metavar="<stratum+tcp://host:port>",
+    dest="stratum.url",
+    help="Mine the jobs of an upstream Stratum server instead of block templates of bitcoind",
+)
+parser.add_argument(
+    "--stratum-user",
+    metavar="<worker>",
+    dest="stratum.user",
+    help=f"Worker name for the upstream Stratum server (default '{miner_config.get('stratum', {}).get('user', '')}')",
+)
+
 # [coinbase]
 parser.add_argument(
     "--coinbase-message",
@@ -106,6 +149,7 @@ parser.add_argument(
 for dest, value in vars(parser.parse_args()).items():
     if "." in dest:
         group, key = dest.split(".")
-        miner_config[group].update({key: value})
+        # optional tables, e.g. [metrics], may be missing in the config file
+        miner_config.setdefault(group, {}).update({key: value})
     else:
         miner_config.update({dest: value})
@@ -1,10 +1,219 @@
 import asyncio
+import time
 import uuid
+from typing import Optional
 
 import serial.tools.list_ports
 
 from custom_logger import logger
-from mining_device import MiningDevice, SerialMiningDevice, SimulatorMiningDevice
+from mining_device import (
+    DeviceConnectionError,
+    MiningDevice,
+    SerialMiningDevice,
+    SimulatorMiningDevice,
+)
+
+
+# number of shares before the measured hashrate of a device replaces its configured hashrate
+MIN_MEASURED_SHARES = 4
+
+
+def split_nonce_range(
+    nonce_start: int, nonce_end: int, weights: list[float]
+) -> list[tuple[int, int]]:
+    """
+    Splits the nonce range [nonce_start, nonce_end) into consecutive ranges, proportional to the given weights
+
+    :param nonce_start: first nonce of the range
+    :param nonce_end: end of the range (exclusive)
+    :param weights: a positive weight per range, e.g. the hashrate of a device
+    :return: list of ranges (start, end)
+    """
+    total, size = sum(weights), nonce_end - nonce_start
+    bounds, acc = [nonce_start], 0.0
+    for weight in weights:
+        acc += weight
+        bounds.append(nonce_start + int(size * acc / total))
+    bounds[-1] = nonce_end
+    return list(zip(bounds, bounds[1:]))
+
+
+class DeviceSession:
+    """
+    Long-lived connection to a single mining device.
+
+    The device is opened once and kept open across block templates, so pushing new work is a plain write on an
+    already open link. The connection is only re-established after a DeviceConnectionError, using exponential backoff
+    between consecutive attempts. The device protocol is negotiated after each (re)connect, as the device may have been
+    replaced or its firmware updated in the meantime.
+
+    The session also measures the hashrate of the device from the shares it reports, i.e. a share below target T
+    stands for 2^256 / (T + 1) hashes on average.
+
+    :param device: the mining device
+    :param backoff_initial: delay in seconds before the first reconnection attempt
+    :param backoff_max: maximum delay in seconds between reconnection attempts
+    """
+
+    def __init__(
+        self,
+        device: MiningDevice,
+        backoff_initial: float = 1,
+        backoff_max: float = 60,
+    ):
+        self.device = device
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.connected = False
+        self.backoff = backoff_initial
+        self.stale_shares = 0
+        self.shares = 0
+        self.hashes = 0
+        self.measure_since: Optional[float] = None
+        self.__loop = None
+
+    def __str__(self):
+        return str(self.device)
+
+    def __repr__(self):
+        return repr(self.device)
+
+    async def open(self) -> None:
+        """
+        Connects to the device and negotiates its protocol (see MiningDevice.negotiate_protocol), unless it is already
+        connected within the running event loop.
+
+        Failed attempts are repeated forever with exponential backoff.
+        """
+        loop = asyncio.get_running_loop()
+        if self.connected and self.__loop is loop:
+            return
+        while True:
+            try:
+                await self.device.connect()
+                await self.device.negotiate_protocol()
+                self.connected, self.__loop = True, loop
+                return
+            except DeviceConnectionError as e:
+                logger.error(e)
+                logger.debug(f"\t{e.detail}")
+                await self.__wait_backoff()
+
+    async def reconnect(self) -> None:
+        """Closes the connection after a DeviceConnectionError and opens it again after the current backoff delay."""
+        await self.close()
+        await self.__wait_backoff()
+        await self.open()
+
+    async def close(self) -> None:
+        """Closes the connection to the device"""
+        self.connected = False
+        await self.device.close()
+
+    async def write(self, data: bytes) -> None:
+        """
+        Sends data to the device, connecting first if necessary.
+
+        :param data: bytes to be sent
+        :raises DeviceConnectionError
+        """
+        await self.open()
+        try:
+            await self.device.write(data)
+        except DeviceConnectionError:
+            self.connected = False
+            raise
+
+    async def read(self, size: int) -> bytes:
+        """
+        Reads size bytes from the device, connecting first if necessary.
+
+        :param size: number of bytes to read
+        :raises DeviceConnectionError
+        :return: bytes read from the device
+        """
+        await self.open()
+        try:
+            data = await self.device.read(size)
+        except DeviceConnectionError:
+            self.connected = False
+            raise
+        # the link is healthy again
+        self.backoff = self.backoff_initial
+        return data
+
+    def record_share(self, target: int) -> None:
+        """
+        Records a share of the device for the hashrate measurement
+
+        :param target: share target of the device
+        """
+        self.shares += 1
+        self.hashes += 2**256 // (target + 1)
+
+    def hashrate(self, now: Optional[float] = None) -> Optional[float]:
+        """
+        Returns the hashrate of the device, as measured from its shares or else as configured
+
+        :param now: current time in seconds (monotonic)
+        :return: hashrate in hashes per second, or None if unknown
+        """
+        now = time.monotonic() if now is None else now
+        if self.shares >= MIN_MEASURED_SHARES and now > self.measure_since:
+            return self.hashes / (now - self.measure_since)
+        return self.device.hashrate
+
+    async def send_work(self, job_id: int, data: bytes) -> None:
+        """
+        Sends new work to the device, connecting first if necessary (see MiningDevice.send_work).
+
+        :param job_id: ID of the job
+        :param data: work for the device
+        :raises DeviceConnectionError
+        """
+        await self.open()
+        if self.measure_since is None:
+            self.measure_since = time.monotonic()
+        try:
+            await self.device.send_work(job_id, data)
+        except DeviceConnectionError:
+            self.connected = False
+            raise
+
+    async def set_target(self, target: bytes) -> None:
+        """
+        Sets the share target of the device, connecting first if necessary (see MiningDevice.set_target).
+
+        :param target: 32 byte share target in big endian
+        :raises DeviceConnectionError
+        """
+        await self.open()
+        try:
+            await self.device.set_target(target)
+        except DeviceConnectionError:
+            self.connected = False
+            raise
+
+    async def read_share(self) -> tuple[Optional[int], bytes]:
+        """
+        Reads the next share from the device, connecting first if necessary (see MiningDevice.read_share).
+
+        :raises DeviceConnectionError
+        :return: job ID (None for legacy devices) and nonce
+        """
+        await self.open()
+        try:
+            share = await self.device.read_share()
+        except DeviceConnectionError:
+            self.connected = False
+            raise
+        self.backoff = self.backoff_initial
+        return share
+
+    async def __wait_backoff(self) -> None:
+        logger.info(f"\tTrying to reconnect to {self} in {self.backoff} seconds ...")
+        await asyncio.sleep(self.backoff)
+        self.backoff = min(2 * self.backoff, self.backoff_max)
 
 
 class DeviceManager:
@@ -20,15 +229,50 @@ class DeviceManager:
         self.__add_devices_config()
         if config.get("autodetect", False):
             self.__autodetect_serial_devices()
-        if not self.__devices:
+        # a Stratum server may serve remote workers only
+        if not self.__devices and not config.get("stratum", {}).get("server", False):
             raise Exception(
                 "No mining devices configured or found. Please specify at least one mining device and/or use auto-detection"
             )
+        self.__sessions = [DeviceSession(device) for device in self.__devices]
 
     def devices(self) -> list[MiningDevice]:
         """Returns a list of all managed mining devices."""
         return self.__devices
 
+    def sessions(self) -> list[DeviceSession]:
+        """Returns a list of long-lived sessions, one for each managed mining device."""
+        return self.__sessions
+
+    async def close(self) -> None:
+        """Closes the connections to all managed mining devices"""
+        await asyncio.gather(*(session.close() for session in self.__sessions))
+
+    def nonce_ranges(
+        self,
+        nonce_start: int,
+        nonce_end: int = 2**32,
+        sessions: Optional[list[DeviceSession]] = None,
+    ) -> list[tuple[int, int]]:
+        """
+        Allocates consecutive nonce ranges to the sessions, sized by the hashrate of each device.
+
+        Devices with unknown hashrate are weighted with the average hashrate of the other devices
+        (all devices are weighted equally if no hashrate is known).
+
+        :param nonce_start: first nonce to allocate
+        :param nonce_end: end of the nonce range (exclusive)
+        :param sessions: sessions to allocate ranges to, defaults to all sessions
+        :return: a nonce range (start, end) per session
+        """
+        sessions = self.__sessions if sessions is None else sessions
+        hashrates = [session.hashrate() for session in sessions]
+        known = [h for h in hashrates if h]
+        default = sum(known) / len(known) if known else 1
+        return split_nonce_range(
+            nonce_start, nonce_end, [h or default for h in hashrates]
+        )
+
     def serial_devices(self) -> list[SerialMiningDevice]:
         """Returns a list of all managed serial mining devices"""
         return [d for d in self.__devices if isinstance(d, SerialMiningDevice)]
@@ -59,19 +303,23 @@ class DeviceManager:
         try:
             device_type = config_device["type"]
             if device_type == "serial":
-                return SerialMiningDevice(
+                device = SerialMiningDevice(
                     name=self.__get_serial_device_name(config_device),
                     port=config_device["port"],
                     baudrate=config_device["baudrate"],
                     write_timeout=config_device.get("write_timeout", 3),
                 )
-
-            if device_type == "simulator":
-                return SimulatorMiningDevice(
+            elif device_type == "simulator":
+                device = SimulatorMiningDevice(
                     name=config_device.get("name", f"Simulator_{uuid.uuid4()}"),
                     avg_delay=config_device.get("avg_delay", 5),
+                    engine=config_device.get("engine", "hashlib"),
                 )
-            raise Exception(f"Unknown device type '{device_type}'")
+            else:
+                raise Exception(f"Unknown device type '{device_type}'")
+            # nominal hashrate (e.g. from the welcome message of the firmware), until measured
+            device.hashrate = config_device.get("hashrate")
+            return device
 
         except KeyError as e:
             raise Exception(f"Please specify mandatory device parameter {e}")
@@ -0,0 +1,134 @@
+#  Copyright (C) 2022 Jan Sturm
+#
+#  This program is free software: you can redistribute it and/or modify it under
+#  the terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  This program is distributed in the hope that it will be useful, but WITHOUT
+#  ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or FITNESS
+#  FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Framed binary protocol between mining software and mining devices.
+
+Each message is sent as a frame [SOF (1B) | type (1B) | job ID (1B) | length (1B) | payload | CRC16 (2B)], where the
+CRC-16/CCITT (big endian) covers type, job ID, length and payload. A receiver that loses a byte resynchronizes by
+scanning for the next start of frame with a valid checksum.
+"""
+
+import binascii
+import struct
+from collections import deque
+from typing import NamedTuple
+
+SOF = 0xA5
+PROTOCOL_VERSION = 1
+
+# message types
+MSG_HELLO = 0x01  # protocol negotiation, payload = [version (1B) | padding]
+MSG_WORK = 0x02  # new work, payload = midstate and the last 16 bytes of the header or the full 80 byte header
+MSG_SHARE = 0x03  # share found by the device, payload = nonce (4B, big endian)
+MSG_TARGET = 0x04  # new share target for all following shares, payload = target (32B, big endian)
+
+HEADER = struct.Struct(">BBBB")
+CHECKSUM = struct.Struct(">H")
+# largest payload (full block header), frames with a larger length are corrupted
+MAX_PAYLOAD = 80
+
+# legacy devices process every 48 bytes as new work, the hello frame therefore has the size of a legacy work item
+HELLO_SIZE = 48
+
+
+class Frame(NamedTuple):
+    msg_type: int
+    job_id: int
+    payload: bytes
+
+
+def encode_frame(msg_type: int, job_id: int, payload: bytes = b"") -> bytes:
+    """
+    Encodes a single frame
+
+    :param msg_type: message type (see MSG_*)
+    :param job_id: job ID (0-255)
+    :param payload: payload of at most MAX_PAYLOAD bytes
+    :return: encoded frame
+    """
+    assert len(payload) <= MAX_PAYLOAD
+    header = HEADER.pack(SOF, msg_type, job_id & 0xFF, len(payload))
+    return header + payload + CHECKSUM.pack(binascii.crc_hqx(header[1:] + payload, 0))
+
+
+def hello_frame() -> bytes:
+    """Returns the hello frame, that is sent to negotiate the framed protocol"""
+    padding = HELLO_SIZE - HEADER.size - CHECKSUM.size - 1
+    return encode_frame(MSG_HELLO, 0, bytes([PROTOCOL_VERSION]) + bytes(padding))
+
+
+class FrameDecoder:
+    """
+    Incremental decoder for a stream of frames.
+
+    Bytes in front of a start of frame and frames with an invalid length or checksum are dropped, every such
+    resynchronization is counted in 'resyncs'. A resynchronization rescans the buffered bytes and can complete several
+    frames at once, readers that take one frame at a time keep the remaining frames in 'frames'.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.frames: deque[Frame] = deque()
+        self.resyncs = 0
+
+    def reset(self) -> None:
+        """Drops all buffered bytes and frames, e.g. after a reconnect"""
+        self.buffer.clear()
+        self.frames.clear()
+
+    def pending(self) -> int:
+        """Returns the number of bytes that are at least missing to complete the next frame"""
+        if len(self.buffer) < HEADER.size:
+            return HEADER.size - len(self.buffer)
+        size = HEADER.size + self.buffer[3] + CHECKSUM.size
+        return max(1, size - len(self.buffer))
+
+    def feed(self, data: bytes) -> list[Frame]:
+        """
+        Adds received bytes to the stream
+
+        :param data: received bytes
+        :return: all frames that were completed by the received bytes
+        """
+        self.buffer += data
+        frames = []
+        while self.buffer:
+            start = self.buffer.find(SOF)
+            if start != 0:
+                # skip garbage up to the next start of frame
+                self.resyncs += 1
+                del self.buffer[: len(self.buffer) if start < 0 else start]
+                if start < 0:
+                    return frames
+            if len(self.buffer) < HEADER.size:
+                return frames
+            if self.buffer[3] > MAX_PAYLOAD:
+                # not a valid frame, continue searching behind this start of frame
+                self.resyncs += 1
+                del self.buffer[0]
+                continue
+            size = HEADER.size + self.buffer[3] + CHECKSUM.size
+            if len(self.buffer) < size:
+                return frames
+            frame = bytes(self.buffer[:size])
+            (checksum,) = CHECKSUM.unpack(frame[-CHECKSUM.size :])
+            if checksum != binascii.crc_hqx(frame[1 : -CHECKSUM.size], 0):
+                self.resyncs += 1
+                del self.buffer[0]
+                continue
+            del self.buffer[:size]
+            _, msg_type, job_id, _ = HEADER.unpack_from(frame)
+            frames.append(Frame(msg_type, job_id, frame[HEADER.size : -CHECKSUM.size]))
+        return frames
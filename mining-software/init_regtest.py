@@ -21,10 +21,11 @@ Performs some initialization tasks on a running bitcoind regtest instance
 - generation of address to be used for coinbase transaction
 """
 
-from bitcoinlib.services.authproxy import AuthServiceProxy, JSONRPCException
+import asyncio
 
 from config_loader import miner_config
 from custom_logger import logger
+from rpc_client import RPC_TIMEOUT, RPCClient, RPCError
 
 wallet_name = "stm32wallet"
 initial_blocks = 1000
@@ -33,51 +34,72 @@ tx_fee = 0.1
 
 config = miner_config["rpc"]
 url = f"http://{config['username']}:{config['password']}@{config['server']}"
-rpc = AuthServiceProxy(service_url=url)
-logger.info(f"Setting up regtest on {config['server']}")
 
-try:
+
+async def init_regtest(rpc: RPCClient) -> None:
+    logger.info(f"Setting up regtest on {config['server']}")
     try:
-        rpc.createwallet(wallet_name)
+        await rpc.call("createwallet", wallet_name)
         logger.info(f"  Created wallet '{wallet_name}'")
-    except JSONRPCException as e:
+    except RPCError as e:
         if "already exists" not in e.message:
             raise e
 
     try:
-        rpc.loadwallet(wallet_name)
+        await rpc.call("loadwallet", wallet_name)
         logger.info(f"  Loaded wallet '{wallet_name}'")
-    except JSONRPCException as e:
+    except RPCError as e:
         if "already loaded" not in e.message:
             raise e
 
-    rpc = AuthServiceProxy(service_url=f"{url}/wallet/{wallet_name}")
+    rpc = rpc.wallet(wallet_name)
     logger.info(f"  Using wallet '{wallet_name}'")
 
-    addr1 = rpc.getnewaddress()
+    addr1 = await rpc.call("getnewaddress")
     logger.info(f"  Generating {initial_blocks} blocks to address '{addr1}' ...")
-    rpc.generatetoaddress(initial_blocks, addr1)
+    # generating many blocks takes a while
+    await rpc.call("generatetoaddress", initial_blocks, addr1, timeout=None)
     logger.info(f"  ... done")
 
     logger.info(f"  Generating {random_transactions} transactions")
     logger.info(f"    > Setting transaction fee to {tx_fee} BTC/kB")
-    rpc.settxfee(tx_fee)
-    for i in range(random_transactions):
-        addr = rpc.getnewaddress()
-        rpc.sendtoaddress(addr, 1)
+    await rpc.call("settxfee", tx_fee)
+    # one request (JSON-RPC batch) for all addresses and one for all transactions
+    addresses = await rpc.batch([("getnewaddress", [])] * random_transactions)
+    for result in addresses:
+        if isinstance(result, RPCError):
+            raise result
+    calls = [("sendtoaddress", [addr, 1]) for addr in addresses]
+    for result in await rpc.batch(calls):
+        if isinstance(result, RPCError):
+            raise result
+    for i, addr in enumerate(addresses):
         logger.info(f"    > TX#{i}: Sent 1 BTC to '{addr}'")
 
+    address = await rpc.call("getnewaddress", "mining-rewards", "p2sh-segwit")
     logger.info("")
     logger.info("@" * 90)
     logger.info(
-        f"\x1b[31;1m==> Use address '{rpc.getnewaddress('mining-rewards', 'p2sh-segwit')}' as coinbase-addr for mining-software"
+        f"\x1b[31;1m==> Use address '{address}' as coinbase-addr for mining-software"
     )
     logger.info("@" * 90)
+    await rpc.close()
 
-except JSONRPCException as e:
-    logger.error(e)
-except ConnectionError as e:
-    logger.error(e)
-    logger.error(
-        f"Make sure an instance of bitcoind is running on '{config['server']}'"
-    )
+
+async def main():
+    rpc = RPCClient(url, config.get("timeout", RPC_TIMEOUT))
+    try:
+        await init_regtest(rpc)
+    except RPCError as e:
+        logger.error(e)
+    except ConnectionError as e:
+        logger.error(e)
+        logger.error(
+            f"Make sure an instance of bitcoind is running on '{config['server']}'"
+        )
+    finally:
+        await rpc.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,275 @@
+#  Copyright (C) 2022 Jan Sturm
+#
+#  This program is free software: you can redistribute it and/or modify it under
+#  the terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  This program is distributed in the hope that it will be useful, but WITHOUT
+#  ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or FITNESS
+#  FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""In-memory metrics of the mining engine (hashrate and shares per device, block templates and RPC latencies)"""
+
+import asyncio
+import bisect
+import json
+import time
+from collections import deque
+from typing import Optional
+
+from custom_logger import logger
+
+# upper bounds in seconds of the latency histogram buckets (the last bucket is unbounded)
+RPC_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+FIRST_SHARE_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600)
+WORK_GAP_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+
+class Histogram:
+    """
+    Histogram with fixed buckets, i.e. the number of observations less than or equal to each upper bound
+
+    :param buckets: sorted upper bounds of the buckets
+    """
+
+    def __init__(self, buckets: tuple = RPC_LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        # the last count is the overflow bucket (+Inf)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        """Adds a single observation"""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> list[tuple[float, int]]:
+        """Returns (upper bound, number of observations <= upper bound) for each bucket including +Inf"""
+        result, total = [], 0
+        for bound, count in zip((*self.buckets, float("inf")), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def snapshot(self) -> dict:
+        return dict(
+            count=self.count,
+            sum=self.sum,
+            buckets={str(bound): count for bound, count in self.cumulative()},
+        )
+
+
+class DeviceMetrics:
+    """
+    Metrics of a single device.
+
+    The effective hashrate is derived from the accepted shares, where a share below target T stands for
+    2^256 / (T + 1) hashes on average, averaged over a sliding window.
+    The work gap is the time from the end of a round of work (mining timeout or new block) to the first write of new
+    work to the device, i.e. the time the device spends on outdated work.
+
+    :param window: length of the hashrate window in seconds
+    """
+
+    def __init__(self, window: float = 600):
+        self.window = window
+        self.online = False
+        self.accepted_shares = 0
+        self.stale_shares = 0
+        self.invalid_shares = 0
+        self.first_share_latency = Histogram(FIRST_SHARE_BUCKETS)
+        self.work_gap = Histogram(WORK_GAP_BUCKETS)
+        self.work_since: Optional[float] = None
+        self.round_end: Optional[float] = None
+        self.started: Optional[float] = None
+        # (time, hashes) of each accepted share within the window
+        self.__shares: deque[tuple[float, int]] = deque()
+
+    def work(self, now: float, round_end: Optional[float] = None) -> None:
+        """
+        Records that new work was sent to the device
+
+        :param now: current time in seconds (monotonic)
+        :param round_end: end of the previous round of work, only the first work after it counts for the work gap
+        """
+        self.work_since = now
+        if round_end is not None and round_end != self.round_end:
+            self.round_end = round_end
+            self.work_gap.observe(now - round_end)
+        if self.started is None:
+            self.started = now
+
+    def share(self, status: str, target: int, now: float) -> None:
+        """
+        Records a share of the device
+
+        :param status: 'accepted', 'stale' or 'invalid' (hash above the share target)
+        :param target: share target of the device
+        :param now: current time in seconds (monotonic)
+        """
+        if status == "stale":
+            self.stale_shares += 1
+            return
+        if status == "invalid":
+            self.invalid_shares += 1
+            return
+        self.accepted_shares += 1
+        self.__shares.append((now, 2**256 // (target + 1)))
+        if self.work_since is not None:
+            self.first_share_latency.observe(now - self.work_since)
+            self.work_since = None
+
+    def hashrate(self, now: float) -> float:
+        """
+        Returns the effective hashrate over the window
+
+        :param now: current time in seconds (monotonic)
+        :return: hashes per second
+        """
+        while self.__shares and self.__shares[0][0] < now - self.window:
+            self.__shares.popleft()
+        if self.started is None or now <= self.started:
+            return 0.0
+        elapsed = min(self.window, now - self.started)
+        return sum(hashes for _, hashes in self.__shares) / elapsed
+
+    def snapshot(self, now: float) -> dict:
+        return dict(
+            online=self.online,
+            hashrate=self.hashrate(now),
+            accepted_shares=self.accepted_shares,
+            stale_shares=self.stale_shares,
+            invalid_shares=self.invalid_shares,
+            first_share_latency=self.first_share_latency.snapshot(),
+            work_gap=self.work_gap.snapshot(),
+        )
+
+
+class Metrics:
+    """
+    Registry for all metrics of the mining engine, fed by the mining tasks and the RPC calls of the miner.
+
+    All methods are called from within the event loop of the miner, only the export file is written in a separate
+    thread.
+
+    :param config: metrics config (see [metrics] in config.toml)
+    """
+
+    def __init__(self, config: Optional[dict] = None):
+        config = config or {}
+        self.window = config.get("hashrate_window", 600)
+        self.export_interval = config.get("export_interval", 60)
+        self.export_file = config.get("export_file")
+        self.devices: dict[str, DeviceMetrics] = {}
+        self.rpc_latency: dict[str, Histogram] = {}
+        self.rpc_errors: dict[str, int] = {}
+        self.templates = 0
+        self.template_since: Optional[float] = None
+        self.blocks_submitted = 0
+        self.blocks_accepted = 0
+        # delay in seconds of the last wakeup of the event loop (see run_loop_monitor)
+        self.loop_lag = 0.0
+
+    def device(self, name: str) -> DeviceMetrics:
+        """Returns the metrics of the device with the given name"""
+        if name not in self.devices:
+            self.devices[name] = DeviceMetrics(self.window)
+        return self.devices[name]
+
+    def rpc_call(self, method: str, seconds: float, error: bool = False) -> None:
+        """
+        Records the latency of an RPC call
+
+        :param method: JSON-RPC method
+        :param seconds: time until the response (or error)
+        :param error: True iff the call failed
+        """
+        if method not in self.rpc_latency:
+            self.rpc_latency[method] = Histogram()
+            self.rpc_errors[method] = 0
+        self.rpc_latency[method].observe(seconds)
+        if error:
+            self.rpc_errors[method] += 1
+
+    def template(self, now: float) -> None:
+        """Records that a new block template was received"""
+        self.templates += 1
+        self.template_since = now
+
+    def template_age(self, now: float) -> Optional[float]:
+        """Returns the age of the current block template in seconds, or None if there is none"""
+        return None if self.template_since is None else now - self.template_since
+
+    def block(self, accepted: bool) -> None:
+        """Records a submitted block"""
+        self.blocks_submitted += 1
+        self.blocks_accepted += accepted
+
+    def hashrate(self, now: float) -> float:
+        """Returns the effective hashrate of all devices"""
+        return sum(device.hashrate(now) for device in self.devices.values())
+
+    def snapshot(self, now: Optional[float] = None) -> dict:
+        """
+        Returns all metrics as plain dict, e.g. for JSON export
+
+        :param now: current time in seconds (monotonic)
+        """
+        now = time.monotonic() if now is None else now
+        return dict(
+            timestamp=time.time(),
+            hashrate=self.hashrate(now),
+            devices={
+                name: device.snapshot(now) for name, device in self.devices.items()
+            },
+            templates=self.templates,
+            template_age=self.template_age(now),
+            blocks_submitted=self.blocks_submitted,
+            blocks_accepted=self.blocks_accepted,
+            loop_lag=self.loop_lag,
+            rpc_errors=dict(self.rpc_errors),
+            rpc_latency={
+                method: histogram.snapshot()
+                for method, histogram in self.rpc_latency.items()
+            },
+        )
+
+    def export(self, snapshot: dict) -> None:
+        """Appends the snapshot as JSON line to the export file, or logs a summary if no file is configured"""
+        if self.export_file:
+            with open(self.export_file, "a") as f:
+                f.write(json.dumps(snapshot) + "\n")
+            return
+        for name, device in snapshot["devices"].items():
+            logger.info(
+                f"[{name}] {device['hashrate']:.0f} H/s, shares accepted/stale/invalid = "
+                f"{device['accepted_shares']}/{device['stale_shares']}/{device['invalid_shares']}"
+            )
+
+    async def run_exporter(self) -> None:
+        """Exports a snapshot every 'export_interval' seconds until cancelled"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.export_interval)
+            try:
+                await loop.run_in_executor(None, self.export, self.snapshot())
+            except OSError as e:
+                logger.error(f"Cannot export metrics ({e})")
+
+    async def run_loop_monitor(self, interval: float = 0.5) -> None:
+        """
+        Measures the lag of the event loop until cancelled, i.e. how late a sleep of 'interval' seconds wakes up
+
+        :param interval: time in seconds between two measurements
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            self.loop_lag = max(0.0, loop.time() - start - interval)
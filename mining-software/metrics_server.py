@@ -0,0 +1,219 @@
+#  Copyright (C) 2022 Jan Sturm
+#
+#  This program is free software: you can redistribute it and/or modify it under
+#  the terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  This program is distributed in the hope that it will be useful, but WITHOUT
+#  ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or FITNESS
+#  FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Optional HTTP endpoint that serves the metrics of the miner in OpenMetrics text format (e.g. for Prometheus)"""
+
+import asyncio
+import time
+from typing import Optional
+
+from custom_logger import logger
+from metrics import Histogram, Metrics
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+# maximum time in seconds to receive the request of a client
+REQUEST_TIMEOUT = 5
+
+
+def escape(value: str) -> str:
+    """Escapes a label value"""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def sample(name: str, value: float, **labels: str) -> str:
+    """Formats a single sample line 'name{labels} value'"""
+    if labels:
+        name += "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels.items()) + "}"
+    return f"{name} {value}"
+
+
+def histogram_samples(name: str, histogram: Histogram, **labels: str) -> list[str]:
+    """Formats the bucket, count and sum samples of a histogram"""
+    lines = [
+        sample(f"{name}_bucket", count, **labels, le=str(bound).replace("inf", "+Inf"))
+        for bound, count in histogram.cumulative()
+    ]
+    lines.append(sample(f"{name}_count", histogram.count, **labels))
+    lines.append(sample(f"{name}_sum", histogram.sum, **labels))
+    return lines
+
+
+def render(metrics: Metrics, now: Optional[float] = None) -> str:
+    """
+    Renders all metrics in OpenMetrics text format
+
+    :param metrics: metrics of the miner
+    :param now: current time in seconds (monotonic)
+    :return: exposition text, terminated by '# EOF'
+    """
+    now = time.monotonic() if now is None else now
+    devices = metrics.devices.items()
+    lines = [
+        "# TYPE miner_devices_online gauge",
+        "# HELP miner_devices_online Number of connected mining devices",
+        sample("miner_devices_online", sum(d.online for _, d in devices)),
+        "# TYPE miner_device_online gauge",
+        "# HELP miner_device_online 1 if the device is connected, else 0",
+        *(sample("miner_device_online", int(d.online), device=n) for n, d in devices),
+        "# TYPE miner_hashrate gauge",
+        "# HELP miner_hashrate Effective hashrate of the device",
+        *(sample("miner_hashrate", d.hashrate(now), device=n) for n, d in devices),
+        "# TYPE miner_shares counter",
+        "# HELP miner_shares Shares reported by the device",
+    ]
+    for name, device in devices:
+        for status in ("accepted", "stale", "invalid"):
+            value = getattr(device, f"{status}_shares")
+            lines.append(
+                sample("miner_shares_total", value, device=name, status=status)
+            )
+    lines += [
+        "# TYPE miner_first_share_seconds histogram",
+        "# UNIT miner_first_share_seconds seconds",
+        "# HELP miner_first_share_seconds Time from new work to the first share",
+    ]
+    for name, device in devices:
+        lines += histogram_samples(
+            "miner_first_share_seconds", device.first_share_latency, device=name
+        )
+    lines += [
+        "# TYPE miner_work_gap_seconds histogram",
+        "# UNIT miner_work_gap_seconds seconds",
+        "# HELP miner_work_gap_seconds Time from the end of a round of work to the new work of the device",
+    ]
+    for name, device in devices:
+        lines += histogram_samples(
+            "miner_work_gap_seconds", device.work_gap, device=name
+        )
+    lines += [
+        "# TYPE miner_block_templates counter",
+        "# HELP miner_block_templates Block templates received",
+        sample("miner_block_templates_total", metrics.templates),
+        "# TYPE miner_block_template_age_seconds gauge",
+        "# UNIT miner_block_template_age_seconds seconds",
+        "# HELP miner_block_template_age_seconds Age of the current block template",
+    ]
+    if metrics.template_since is not None:
+        lines.append(
+            sample("miner_block_template_age_seconds", metrics.template_age(now))
+        )
+    lines += [
+        "# TYPE miner_blocks_submitted counter",
+        "# HELP miner_blocks_submitted Blocks submitted to the server",
+        sample("miner_blocks_submitted_total", metrics.blocks_submitted),
+        "# TYPE miner_blocks_accepted counter",
+        "# HELP miner_blocks_accepted Blocks accepted by the server",
+        sample("miner_blocks_accepted_total", metrics.blocks_accepted),
+        "# TYPE miner_rpc_errors counter",
+        "# HELP miner_rpc_errors Failed RPC calls",
+        *(
+            sample("miner_rpc_errors_total", errors, method=method)
+            for method, errors in metrics.rpc_errors.items()
+        ),
+        "# TYPE miner_rpc_latency_seconds histogram",
+        "# UNIT miner_rpc_latency_seconds seconds",
+        "# HELP miner_rpc_latency_seconds Latency of RPC calls",
+    ]
+    for method, histogram in metrics.rpc_latency.items():
+        lines += histogram_samples(
+            "miner_rpc_latency_seconds", histogram, method=method
+        )
+    lines += [
+        "# TYPE miner_event_loop_lag_seconds gauge",
+        "# UNIT miner_event_loop_lag_seconds seconds",
+        "# HELP miner_event_loop_lag_seconds Delay of the last wakeup of the event loop",
+        sample("miner_event_loop_lag_seconds", metrics.loop_lag),
+        "# EOF",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """
+    Minimal asyncio HTTP server, that serves the metrics of the miner on 'GET /metrics'.
+
+    The server runs within the event loop of the miner. Rendering only reads the in-memory metrics and all socket I/O
+    is asynchronous, so scrapes never block the mining tasks.
+
+    :param config: metrics config (see [metrics] in config.toml)
+    :param metrics: metrics of the miner
+    """
+
+    def __init__(self, config: dict, metrics: Metrics):
+        self.host = config.get("host", "127.0.0.1")
+        self.port = config.get("port", 9100)
+        self.metrics = metrics
+        self.__started: Optional[asyncio.Event] = None
+
+    @property
+    def started(self) -> asyncio.Event:
+        """Event that is set once the server accepts connections (created within the running event loop)"""
+        if self.__started is None:
+            self.__started = asyncio.Event()
+        return self.__started
+
+    def __str__(self):
+        return f"<MetricsServer [http://{self.host}:{self.port}/metrics]>"
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """Handles a single HTTP request"""
+        try:
+            request = await asyncio.wait_for(
+                reader.readuntil(b"\r\n\r\n"), timeout=REQUEST_TIMEOUT
+            )
+            method, path, *_ = request.decode("latin-1").split(" ", 2)
+            if method != "GET":
+                status, content_type, body = "405 Method Not Allowed", "text/plain", ""
+            elif path.split("?")[0] != "/metrics":
+                status, content_type, body = "404 Not Found", "text/plain", ""
+            else:
+                status, content_type, body = (
+                    "200 OK",
+                    CONTENT_TYPE,
+                    render(self.metrics),
+                )
+            data = body.encode()
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode()
+                + data
+            )
+            await writer.drain()
+        except (
+            asyncio.TimeoutError,
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+            ValueError,
+        ) as e:
+            logger.debug(f"Invalid metrics request ({e!r})")
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def run(self) -> None:
+        """Serves the metrics until cancelled"""
+        try:
+            server = await asyncio.start_server(self.handle, self.host, self.port)
+        except OSError as e:
+            logger.error(f"Cannot start metrics endpoint ({e})")
+            return
+        # the actual port, if port 0 was configured
+        self.port = server.sockets[0].getsockname()[1]
+        logger.info(f"Serving metrics on {self}")
+        self.started.set()
+        async with server:
+            await server.serve_forever()
@@ -14,24 +14,40 @@
 import asyncio
 import hashlib
 import json
+import logging
 import signal
 import struct
 import sys
 import time
-from typing import Optional
+from pathlib import Path
+from typing import Iterator, Optional
 
-import bitcoinlib.encoding
 from bitcoinlib.encoding import int_to_varbyteint
-from bitcoinlib.keys import deserialize_address
-from bitcoinlib.services.authproxy import AuthServiceProxy, JSONRPCException
-from bitcoinlib.transactions import Input, Output, Transaction
 from bitcoinlib.values import Value
 
-from mining_device import MiningDevice, DeviceConnectionError
+from block_journal import BlockJournal
+from coinbase import CoinbaseBuilder
+from mining_device import DeviceConnectionError
 from config_loader import miner_config
 from custom_logger import logger
-from device_manager import DeviceManager
-from sha256d_ms import calculate_midstate
+from device_manager import DeviceManager, DeviceSession
+from metrics import Metrics
+from metrics_server import MetricsServer
+from node_pool import NodePool
+from rpc_client import DEFAULT, Backoff, RPCError
+import sha256d_batch
+from sha256d_ms import calculate_midstates
+from stratum_client import StratumClient, StratumCoinbase, StratumJob
+from stratum_server import StratumServer
+from vardiff import DEFAULT_SHARE_TARGET, VarDiff
+from zmq_notifier import ZMQNotifier
+
+# bound for rolled timestamps (seconds after 'curtime'), if getblocktemplate does not report 'maxtime'
+MAX_NTIME_ROLL = 600
+# version bits that may be rolled by miners (see https://github.com/bitcoin/bips/blob/master/bip-0320.mediawiki)
+BIP320_VERSION_MASK = 0x1FFFE000
+# minimum number of distinct midstates, that are computed with the vectorized backend (if numpy is available)
+VECTORIZED_MIDSTATES = 32
 
 
 class MinerError(Exception):
@@ -64,94 +80,142 @@ class BlockTemplate:
     Representation of a block template received from getblocktemplate RPC.
     See also https://github.com/bitcoin/bips/blob/master/bip-0022.mediawiki
 
+    All header fields and transactions are decoded into bytes once at construction, so that jobs, share validation
+    and block assembly work on bytes only. The hex-encoded transactions are not kept.
+
     :param template: result of getblocktemplate RPC
-    :param cb_config: user specific coinbase data (message and address)
+    :param cb_config: user specific coinbase data (message, address and optional extranonce size)
+    :raises MinerError if coinbase address is invalid
+
+    If the template lists 'time' (or 'time/increment') as 'mutable', the header timestamp may be rolled within
+    ['mintime', 'maxtime'] (see rolled_ntimes), which gives fresh headers without another getblocktemplate call.
+    Likewise, the BIP 320 bits of the version can be rolled (see rolled_versions), except for the bits of soft fork
+    deployments listed in 'vbavailable' and 'vbrequired'.
     """
 
+    __slots__ = (
+        "template",
+        "cb_config",
+        "extranonce_size",
+        "coinbase_builder",
+        "height",
+        "version",
+        "version_mask",
+        "version_next",
+        "prevhash",
+        "curtime",
+        "mintime",
+        "maxtime",
+        "ntime_mutable",
+        "received",
+        "ntime_next",
+        "bits",
+        "target",
+        "target_int",
+        "tx_count",
+        "txids",
+        "tx_data",
+        "coinbase",
+        "coinbase_txid",
+        "merkle_branch",
+        "merkle_root",
+    )
+
     def __init__(self, template: dict, cb_config: dict):
 
-        self.template = template
+        # keep all template fields except the hex-encoded transactions
+        self.template = {k: v for k, v in template.items() if k != "transactions"}
         self.cb_config = cb_config
+        self.extranonce_size = cb_config.get("extranonce_size", 0)
+        self.coinbase_builder = self.create_coinbase_builder(template, cb_config)
+
+        # header fields in the byte order of the block header (little endian), target hash in big endian
+        self.height = template["height"]
+        self.version = template["version"]
+        deployment_bits = sum(
+            1 << bit for bit in template.get("vbavailable", {}).values()
+        )
+        self.version_mask = (
+            BIP320_VERSION_MASK & ~deployment_bits & ~template.get("vbrequired", 0)
+        )
+        # index of the next rolled version (see rolled_versions), 0 is the version of the template
+        self.version_next = 0
+        self.prevhash = bytes.fromhex(template["previousblockhash"])[::-1]
+        self.curtime = template["curtime"]
+        self.mintime = template.get("mintime", self.curtime)
+        self.maxtime = template.get("maxtime", self.curtime + MAX_NTIME_ROLL)
+        mutable = template.get("mutable", [])
+        self.ntime_mutable = "time" in mutable or "time/increment" in mutable
+        # local time of reception, rolled timestamps advance with the age of the template
+        self.received = time.monotonic()
+        # timestamps before 'ntime_next' were already handed out (see rolled_ntimes)
+        self.ntime_next = self.mintime
+        self.bits = bytes.fromhex(template["bits"])[::-1]
+        self.target = bytes.fromhex(template["target"])
+        self.target_int = int.from_bytes(self.target, byteorder="big")
+
+        # all transactions except the coinbase transaction (txids in big-endian)
+        transactions = template["transactions"]
+        self.tx_count = len(transactions) + 1
+        self.txids = b"".join(bytes.fromhex(tx["txid"])[::-1] for tx in transactions)
+        self.tx_data = b"".join(bytes.fromhex(tx["data"]) for tx in transactions)
+
+        # precompute the default coinbase transaction (extranonce 0x00..00) and its Merkle root,
+        # jobs with other extranonces are derived from this template (see jobs())
+        self.coinbase = self.coinbase_tx(bytes(self.extranonce_size))
+        self.coinbase_txid = sha256d(self.coinbase)
+        self.merkle_branch = self.compute_merkle_branch()
+        self.merkle_root = self.merkle_root_from_branch(self.coinbase_txid)
+
+    def create_coinbase_builder(
+        self, template: dict, cb_config: dict
+    ) -> CoinbaseBuilder:
+        """
+        Creates the builder of the coinbase transactions for the given template
 
-        # for very low hashrates we can precompute coinbase transaction and Merkle root since we don't need extra-nonce
-        self.add_coinbase_tx()
-        self.merkle_root = self.merkle_root()
+        :param template: result of getblocktemplate RPC
+        :param cb_config: user specific coinbase data (message, address and optional extranonce size)
+        :raises MinerError if coinbase address is invalid
+        :return: coinbase builder
+        """
+        try:
+            return CoinbaseBuilder(
+                height=template["height"],
+                value=template["coinbasevalue"],
+                cb_config=cb_config,
+                witness_commitment=template.get("default_witness_commitment"),
+            )
+        except ValueError as e:
+            raise MinerError(e)
 
     def __str__(self):
-        return f"BlockTemplate for block #{self.template['height']}:\n{json.dumps(self.template, indent=4)}"
+        return (
+            f"BlockTemplate for block #{self.height} ({self.tx_count} transactions):\n"
+            f"{json.dumps(self.template, indent=4)}"
+        )
 
-    def add_coinbase_tx(self) -> None:
+    def coinbase_tx(self, extranonce: bytes) -> bytes:
         """
-        Creates the coinbase transaction and adds it as the first transaction to the template.
+        Creates the coinbase transaction for the given extranonce.
 
         If at least one witness transaction exists in the block, the commitment needs to be inserted as an additional
         output at the end of this coinbase transaction (see https://bips.xyz/145#block-assembly-with-witness-transactions).
         getblocktemplate already provides the commitment as 'default_witness_commitment'.
+        Segwit requires a commitment to the 'wtxid', which is 0x0000..0000 for the coinbase transaction.
 
-        :raises MinerError if coinbase address is invalid
+        :param extranonce: extranonce, which is pushed right after the block height in the coinbase scriptSig
+        :return: serialized coinbase transaction
         """
-        # see BIP 34 (https://en.bitcoin.it/wiki/BIP_0034) for height of block in coinbase scriptSig
-        block_height = self.template["height"]
-        height_width = (block_height.bit_length() + 7) // 8
-        script = bytes([height_width]) + block_height.to_bytes(
-            height_width, byteorder="little"
-        )
+        tx_coinbase = self.coinbase_builder.build(extranonce)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Coinbase: {tx_coinbase.hex()}")
+        return tx_coinbase
 
-        msg = self.cb_config["message"]
-        if msg.startswith("hex:"):
-            script += bytes.fromhex(msg[4:])
-        else:
-            script += msg[4 * msg.startswith("str:") :].encode()
+    def transaction_hashes(self) -> list[bytes]:
+        """Returns the txids of all transactions except the coinbase transaction (in big-endian)"""
+        return [self.txids[i : i + 32] for i in range(0, len(self.txids), 32)]
 
-        try:
-            cb_network = deserialize_address(self.cb_config["address"])["network"]
-            if not cb_network:
-                raise MinerError("Invalid coinbase address")
-        except bitcoinlib.encoding.EncodingError as e:
-            raise MinerError(e)
-
-        cb_input = Input(
-            prev_txid="00" * 32,
-            output_n=0xFFFFFFFF,
-            unlocking_script=script,
-            network=cb_network,
-        )
-        cb_outputs = [
-            Output(
-                value=self.template["coinbasevalue"],
-                address=self.cb_config["address"],
-                network=cb_network,
-            )
-        ]
-
-        if "default_witness_commitment" in self.template:
-            cb_outputs.append(
-                Output(
-                    value=0,
-                    lock_script=self.template["default_witness_commitment"],
-                    network=cb_network,
-                )
-            )
-
-        tx_coinbase = Transaction(
-            coinbase=True,
-            inputs=[cb_input],
-            outputs=cb_outputs,
-            network=cb_network,
-        )
-        logger.debug(f"Coinbase:\n{tx_coinbase.as_json()}")
-        self.template["transactions"].insert(
-            0,
-            dict(
-                data=tx_coinbase.raw().hex(),
-                # segwit requires a commitment to the 'wtxid' ('hash' in getblocktemplate result).
-                # The wtxid of the coinbase tx is 0x0000..0000
-                hash="00" * 32,
-                txid=sha256d(tx_coinbase.raw())[::-1].hex(),
-            ),
-        )
-
-    def merkle_root(self) -> bytes:
+    def compute_merkle_root(self, coinbase_txid: Optional[bytes] = None) -> bytes:
         """
         Computes the Merkle root of the block (hash of all transaction IDs).
 
@@ -161,13 +225,10 @@ class BlockTemplate:
               of the new serialization with witness data.
         See https://bips.xyz/141#transaction-id for more information
 
+        :param coinbase_txid: optional txid (big-endian) of another coinbase transaction, e.g. with another extranonce
         :return: Merkle root in little-endian
         """
-
-        # convert all txid to big-endian bytes
-        hashes = [
-            bytes.fromhex(tx["txid"])[::-1] for tx in self.template["transactions"]
-        ]
+        hashes = [coinbase_txid or self.coinbase_txid] + self.transaction_hashes()
         while len(hashes) > 1:
             # Duplicate last hash (will be ignored for even number of hashes)
             hashes.append(hashes[-1])
@@ -177,40 +238,188 @@ class BlockTemplate:
         logger.debug(f"merkle root (big endian) = {hashes[0].hex()}")
         return hashes[0][::-1]
 
+    def compute_merkle_branch(self) -> list[bytes]:
+        """
+        Computes the Merkle branch of the coinbase transaction, i.e. the sibling hash on each level of the Merkle tree
+        on the path from the coinbase txid to the Merkle root.
+
+        The branch does not depend on the coinbase transaction itself, so the Merkle root for any other coinbase
+        transaction can be computed with only log2(n) double SHA256 calls (see merkle_root_from_branch).
+
+        :return: list of sibling hashes in big-endian, starting at the lowest level
+        """
+        branch = []
+        hashes = [None] + self.transaction_hashes()
+        while len(hashes) > 1:
+            branch.append(hashes[1])
+            # Duplicate last hash (will be ignored for even number of hashes)
+            hashes.append(hashes[-1])
+            hashes = [None] + [
+                sha256d(hashes[i] + hashes[i + 1]) for i in range(2, len(hashes) - 1, 2)
+            ]
+        return branch
+
+    def merkle_root_from_branch(self, coinbase_txid: bytes) -> bytes:
+        """
+        Computes the Merkle root for the given coinbase transaction from the cached Merkle branch.
+
+        :param coinbase_txid: txid of the coinbase transaction (big-endian)
+        :return: Merkle root in little-endian
+        """
+        root = coinbase_txid
+        for sibling in self.merkle_branch:
+            root = sha256d(root + sibling)
+        return root[::-1]
+
+    def rolled_ntimes(
+        self, count: int, now: Optional[float] = None
+    ) -> Optional[list[int]]:
+        """
+        Hands out consecutive header timestamps, that give each of 'count' jobs a different block header.
+
+        The first timestamp follows the clock, i.e. 'curtime' plus the age of the template, but is never before
+        'mintime' or a timestamp that was already handed out, so that repeated calls never repeat a search space.
+        All timestamps must be within 'maxtime'.
+
+        :param count: number of timestamps
+        :param now: current time in seconds (monotonic)
+        :return: list of timestamps, or None if the timestamp is not mutable or the timestamps would exceed 'maxtime'
+        """
+        start = self.next_ntime(now)
+        if not self.ntime_mutable or start + count - 1 > self.maxtime:
+            return None
+        self.ntime_next = start + count
+        return list(range(start, start + count))
+
+    def next_ntime(self, now: Optional[float] = None) -> int:
+        """Returns the next timestamp that rolled_ntimes would hand out (without handing it out)"""
+        now = time.monotonic() if now is None else now
+        return max(self.ntime_next, self.curtime + int(now - self.received))
+
+    def rolled_version(self, index: int) -> int:
+        """
+        Returns the version with the bits of the given index spread over (i.e. xored into) the bits of 'version_mask'
+
+        :param index: index of the rolled version, 0 is the version of the template
+        :return: rolled version
+        """
+        version, mask = self.version, self.version_mask
+        while index and mask:
+            low = mask & -mask
+            if index & 1:
+                version ^= low
+            index, mask = index >> 1, mask ^ low
+        return version
+
+    def versions_left(self) -> int:
+        """Returns the number of rolled versions that were not yet handed out (see rolled_versions)"""
+        return (1 << bin(self.version_mask).count("1")) - self.version_next
+
+    def rolled_versions(self, count: int) -> Optional[list[int]]:
+        """
+        Hands out distinct versions, that give each of 'count' jobs a different block header (BIP 320).
+
+        :param count: number of versions
+        :return: list of versions, or None if no version bits can be rolled or all rolled versions were handed out
+        """
+        if not self.version_mask or self.versions_left() < count:
+            return None
+        start, self.version_next = self.version_next, self.version_next + count
+        return [self.rolled_version(i) for i in range(start, start + count)]
+
+    def job(
+        self,
+        extranonce: bytes = b"",
+        ntime: Optional[int] = None,
+        version: Optional[int] = None,
+    ) -> "Job":
+        """
+        Returns the job for the given extranonce, timestamp and version, e.g. to validate the share of a remote worker
+
+        :param extranonce: extranonce of size 'extranonce_size'
+        :param ntime: optional header timestamp, defaults to 'curtime'
+        :param version: optional (rolled) version, defaults to the version of this template
+        :return: job with the full nonce range
+        """
+        return Job(self, extranonce, ntime=ntime, version=version)
+
+    def jobs(
+        self, nonce_start: int = 0, ntime: Optional[int] = None
+    ) -> Iterator["Job"]:
+        """
+        Generates jobs with consecutive extranonces (starting with 0x00..00), i.e. disjoint search spaces that each
+        cover the full nonce range.
+
+        :param nonce_start: nonce to start iterating from for each job
+        :param ntime: optional header timestamp of the jobs, defaults to 'curtime'
+        :raises MinerError if extranonce_size is 0
+        :return: generator of jobs
+        """
+        if not self.extranonce_size:
+            raise MinerError("Extranonce rolling requires 'extranonce_size' > 0")
+        for extranonce in range(2 ** (8 * self.extranonce_size)):
+            yield Job(
+                self,
+                extranonce.to_bytes(self.extranonce_size, byteorder="little"),
+                nonce_start,
+                ntime=ntime,
+            )
+
     def block_info(self, nonce: Optional[str] = None) -> str:
         """Returns a printable block info string"""
         if not nonce:
-            return f"<Block [height={self.template['height']}]>"
+            return f"<Block [height={self.height}]>"
         else:
             return (
-                f"<Block [height={self.template['height']}, "
+                f"<Block [height={self.height}, "
                 f"header_hash={self.block_header_hash(nonce).hex()}]"
             )
 
-    def reward_info(self) -> str:
-        """Returns a printable reward string"""
+    def reward_info(self, coinbase_txid: Optional[bytes] = None) -> str:
+        """Returns a printable reward string (optionally for the coinbase transaction of a job)"""
         return (
-            f"<Reward 'Block#{self.template['height']}' "
+            f"<Reward 'Block#{self.height}' "
             f"[reward={Value(self.template['coinbasevalue'], 'sat').str('auto')}, "
             f"coinbase_address={self.cb_config['address']}, "
-            f"txid={self.template['transactions'][0]['txid']}]>"
+            f"txid={(coinbase_txid or self.coinbase_txid)[::-1].hex()}]>"
+        )
+
+    def header_prefix(
+        self,
+        merkle_root: Optional[bytes] = None,
+        ntime: Optional[int] = None,
+        version: Optional[int] = None,
+    ) -> bytes:
+        """
+        Assembles the first 76 bytes of the block header, i.e. everything but the nonce (see block_header)
+
+        :param merkle_root: optional Merkle root of a job, defaults to the Merkle root of this template
+        :param ntime: optional (rolled) timestamp of a job, defaults to 'curtime'
+        :param version: optional (rolled) version of a job, defaults to the version of this template
+        :return: 76 byte block header prefix in little endian
+        """
+        return (
+            struct.pack("<L", self.version if version is None else version)
+            + self.prevhash
+            + (merkle_root or self.merkle_root)[::-1]
+            + struct.pack("<L", self.curtime if ntime is None else ntime)
+            + self.bits
         )
 
-    def block_header(self, nonce: Optional[str]) -> bytes:
+    def block_header(
+        self, nonce: Optional[str], merkle_root: Optional[bytes] = None
+    ) -> bytes:
         """
         Assembles the 80 byte block header in the following format:
         [version (4B) | previous_block_hash (32B) | merkle_root (32B) | timestamp (4B) | bits (4B) | nonce (4B)].
 
         :param nonce: nonce in hex format (big endian)
+        :param merkle_root: optional Merkle root of a job, defaults to the Merkle root of this template
         :return: 80 byte block header in little endian
         """
-        header = struct.pack("<L", self.template["version"])
-        header += bytes.fromhex(self.template["previousblockhash"])[::-1]
-        header += self.merkle_root[::-1]
-        header += struct.pack("<L", self.template["curtime"])
-        header += bytes.fromhex(self.template["bits"])[::-1]
-        header += struct.pack("<L", int(nonce, 16) if nonce else 0)
-        return header
+        return self.header_prefix(merkle_root) + struct.pack(
+            "<L", int(nonce, 16) if nonce else 0
+        )
 
     def block_header_hash(self, nonce: str) -> bytes:
         """
@@ -223,24 +432,229 @@ class BlockTemplate:
 
     def target_hash(self) -> bytes:
         """
-        Extracts the target hash from block template
+        Returns the target hash of the block template
         :return: 32 byte target hash in big endian
         """
-        return bytes.fromhex(self.template["target"])
+        return self.target
 
-    def create_block(self, nonce: str) -> str:
+    def create_block(
+        self,
+        nonce: str,
+        merkle_root: Optional[bytes] = None,
+        coinbase: Optional[bytes] = None,
+    ) -> str:
         """
         Creates a block with valid proof of work for submitblock RPC.
 
         The block contains the block header, transaction counter (VarInt) and the transactions.
 
         :param nonce: nonce received from miner in hex format (big endian)
+        :param merkle_root: optional Merkle root of a job, defaults to the Merkle root of this template
+        :param coinbase: optional coinbase transaction of a job, defaults to the coinbase transaction of this template
         :return: the hex-encoded block data to submit
         """
-        block = self.block_header(nonce).hex()
-        block += int_to_varbyteint(len(self.template["transactions"])).hex()
-        block += "".join(tx["data"] for tx in self.template["transactions"])
-        return block
+        return (
+            self.block_header(nonce, merkle_root)
+            + int_to_varbyteint(self.tx_count)
+            + (coinbase or self.coinbase)
+            + self.tx_data
+        ).hex()
+
+
+class StratumTemplate(BlockTemplate):
+    """
+    Block template for a job of an upstream Stratum server (see stratum_client.StratumClient).
+
+    The coinbase transaction is [coinb1 | extranonce1 | extranonce2 | coinb2], the extranonce2 is rolled like the
+    extranonce of a block template. Consecutive calls of jobs() continue with the next extranonce2, so that restarted
+    devices never repeat a search space. The target is the share target of the server, i.e. every share that meets it
+    is submitted with mining.submit. Neither timestamp nor version are rolled.
+
+    :param job: job of mining.notify
+    """
+
+    __slots__ = ("stratum_job", "job_id", "extranonce_next")
+
+    def __init__(self, job: StratumJob):
+        self.stratum_job = job
+        self.job_id = job.job_id
+        self.extranonce_next = 0
+        # BIP 34 height at the start of the coinbase scriptSig (after the 41 bytes of version, input count and outpoint
+        # and the script length)
+        height = int.from_bytes(
+            job.coinb1[43 : 43 + job.coinb1[42]] if len(job.coinb1) > 42 else b"",
+            byteorder="little",
+        )
+        # the job in the form of a getblocktemplate result, without transactions (only their Merkle branch is known)
+        template = dict(
+            job_id=job.job_id,
+            height=height,
+            version=job.version,
+            previousblockhash=job.prevhash[::-1].hex(),
+            curtime=job.ntime,
+            maxtime=job.ntime,
+            bits=job.bits[::-1].hex(),
+            target=f"{job.target:064x}",
+            transactions=[],
+        )
+        super().__init__(template, dict(extranonce_size=job.extranonce2_size))
+        self.version_mask = 0
+
+    def create_coinbase_builder(
+        self, template: dict, cb_config: dict
+    ) -> StratumCoinbase:
+        """Returns the coinbase builder for [coinb1 | extranonce1 | extranonce2 | coinb2] of the job"""
+        return StratumCoinbase(self.stratum_job)
+
+    def compute_merkle_branch(self) -> list[bytes]:
+        """Returns the Merkle branch of the job"""
+        return self.stratum_job.merkle_branch
+
+    def jobs(
+        self, nonce_start: int = 0, ntime: Optional[int] = None
+    ) -> Iterator["Job"]:
+        """
+        Generates jobs with consecutive extranonce2 values, continuing after the last job of a previous call
+
+        :param nonce_start: nonce to start iterating from for each job
+        :param ntime: optional header timestamp of the jobs, defaults to 'curtime'
+        :raises MinerError if the server assigned no extranonce2
+        :return: generator of jobs
+        """
+        if not self.extranonce_size:
+            raise MinerError("Extranonce rolling requires 'extranonce2_size' > 0")
+        for extranonce in range(self.extranonce_next, 2 ** (8 * self.extranonce_size)):
+            self.extranonce_next = extranonce + 1
+            yield Job(
+                self,
+                extranonce.to_bytes(self.extranonce_size, byteorder="little"),
+                nonce_start,
+                ntime=ntime,
+            )
+
+    def reward_info(self, coinbase_txid: Optional[bytes] = None) -> str:
+        """Returns a printable string of the job (the reward goes to the Stratum server)"""
+        return f"<Job '{self.job_id}' [height={self.height}]>"
+
+
+class Job:
+    """
+    Work for a single mining device, derived from a block template.
+
+    A job with an extranonce has its own coinbase transaction and Merkle root, so that jobs with different
+    extranonces have disjoint search spaces, each covering the full 32-bit nonce range. The same holds for jobs with
+    different (rolled) timestamps or versions. Since the timestamp is in the last 16 bytes of the header, jobs with
+    different timestamps share the midstate of the first 64 bytes, whereas each version needs its own midstate.
+    The first 76 bytes of the block header are assembled once at construction, shares are validated on a mutable
+    copy of the header (see Miner.check_nonce).
+
+    :param block_template: the block template for the current block to be mined
+    :param extranonce: extranonce for the coinbase transaction (b"" if the template has no extranonce)
+    :param nonce_start: nonce to start iterating from
+    :param nonce_end: end of the nonce range allocated to this job (exclusive)
+    :param ntime: optional header timestamp, defaults to 'curtime' of the block template
+    :param version: optional (rolled) version, defaults to the version of the block template
+    """
+
+    __slots__ = (
+        "block_template",
+        "extranonce",
+        "ntime",
+        "version",
+        "nonce_start",
+        "nonce_end",
+        "coinbase",
+        "coinbase_txid",
+        "merkle_root",
+        "header_prefix",
+        "header",
+        "nonce_view",
+    )
+
+    def __init__(
+        self,
+        block_template: BlockTemplate,
+        extranonce: bytes = b"",
+        nonce_start: int = 0,
+        nonce_end: int = 2**32,
+        ntime: Optional[int] = None,
+        version: Optional[int] = None,
+    ):
+        self.block_template = block_template
+        self.extranonce = extranonce
+        self.ntime = block_template.curtime if ntime is None else ntime
+        self.version = block_template.version if version is None else version
+        self.nonce_start = nonce_start
+        self.nonce_end = nonce_end
+        if extranonce == bytes(block_template.extranonce_size):
+            self.coinbase = block_template.coinbase
+            self.coinbase_txid = block_template.coinbase_txid
+            self.merkle_root = block_template.merkle_root
+        else:
+            self.coinbase = block_template.coinbase_tx(extranonce)
+            self.coinbase_txid = sha256d(self.coinbase)
+            self.merkle_root = block_template.merkle_root_from_branch(
+                self.coinbase_txid
+            )
+        self.header_prefix = block_template.header_prefix(
+            self.merkle_root, self.ntime, self.version
+        )
+        # scratch header for share validation, only the nonce (last 4 bytes) is patched for each share
+        self.header = bytearray(self.block_header())
+        self.nonce_view = memoryview(self.header)[76:]
+
+    def block_info(self, nonce: Optional[str] = None) -> str:
+        """Returns a printable block info string"""
+        if not nonce:
+            return self.block_template.block_info()
+        return (
+            f"<Block [height={self.block_template.height}, "
+            f"extranonce={self.extranonce.hex()}, ntime={self.ntime}, "
+            f"version={self.version:#010x}, "
+            f"header_hash={self.block_header_hash(nonce).hex()}]"
+        )
+
+    def reward_info(self) -> str:
+        """Returns a printable reward string"""
+        return self.block_template.reward_info(self.coinbase_txid)
+
+    def block_header(self, nonce: Optional[str] = None) -> bytes:
+        """
+        Assembles the 80 byte block header of this job (see BlockTemplate.block_header)
+
+        :param nonce: nonce in hex format (big endian), defaults to the starting nonce of this job
+        :return: 80 byte block header in little endian
+        """
+        return self.header_prefix + struct.pack(
+            "<L", self.nonce_start if nonce is None else int(nonce, 16)
+        )
+
+    def block_header_hash(self, nonce: str) -> bytes:
+        """
+        Calculates the double SHA256 hash of the block header
+
+        :param nonce: nonce in hex format (big endian)
+        :return: 32 byte block header hash in big endian
+        """
+        return sha256d(self.block_header(nonce))[::-1]
+
+    def target_hash(self) -> bytes:
+        """Returns the 32 byte target hash in big endian"""
+        return self.block_template.target
+
+    def create_block(self, nonce: str) -> str:
+        """
+        Creates a block with valid proof of work for submitblock RPC (see BlockTemplate.create_block)
+
+        :param nonce: nonce received from miner in hex format (big endian)
+        :return: the hex-encoded block data to submit
+        """
+        return (
+            self.block_header(nonce)
+            + int_to_varbyteint(self.block_template.tx_count)
+            + self.coinbase
+            + self.block_template.tx_data
+        ).hex()
 
 
 class Miner:
@@ -254,77 +668,491 @@ class Miner:
         self.config = config
         self.device_manager = DeviceManager(config)
         self.rpc = config["rpc"]
-        self.rpc_url = (
-            f"http://{self.rpc['username']}:{self.rpc['password']}@{self.rpc['server']}"
+        self.nodes = NodePool(self.rpc)
+        # relative paths are relative to the directory of the miner
+        journal = self.rpc.get("journal")
+        self.journal = BlockJournal(
+            Path(__file__).parent / journal if journal else None
         )
 
         self.mining_timeout = config.get("timeout", 10)
+        self.ntime_rolling = config.get("ntime_rolling", True)
+        self.version_rolling = config.get("version_rolling", False)
+        self.template_max_age = config.get("template_max_age", 60)
+        self.prefetch_time = config.get("prefetch_time", 1)
+        self.longpoll = self.rpc.get("longpoll", True)
+        self.vardiff = config.get("vardiff", {})
+        self.metrics = Metrics(config.get("metrics"))
+        # optional Stratum server for remote workers, its templates need a larger extranonce
+        self.coinbase = config["coinbase"]
+        self.stratum = None
+        # optional upstream Stratum server, that replaces getblocktemplate as work source
+        self.upstream = None
+        if config.get("stratum", {}).get("url"):
+            self.upstream = StratumClient(config["stratum"])
+        if config.get("stratum", {}).get("server", False):
+            if self.upstream:
+                raise MinerError(
+                    "Stratum server and client mode cannot be combined, set either 'server' or 'url' in [stratum]"
+                )
+            self.stratum = StratumServer(
+                config["stratum"], self.found_block, self.metrics
+            )
+            self.coinbase = dict(
+                self.coinbase, extranonce_size=self.stratum.extranonce_size
+            )
+
+        self.__shares: Optional[asyncio.Queue] = None
+        self.__refresh: Optional[asyncio.Event] = None
+        self.__work_queues: list[asyncio.Queue] = []
+        self.__workers: list[asyncio.Task] = []
+        # current job of each session and the time it was sent to the device
+        self.__assignments: dict[DeviceSession, tuple[Job, float]] = {}
+        self.__handovers: list[asyncio.TimerHandle] = []
+        # unsearched job of each device that dropped out and the handovers of that job (see release and reclaim)
+        self.__released: dict[DeviceSession, tuple[Job, list[asyncio.TimerHandle]]] = {}
+        self.__submissions: set[asyncio.Task] = set()
+        # end of the previous round of work (see template_producer and DeviceMetrics.work)
+        self.__round_end: Optional[float] = None
 
     @staticmethod
-    def check_nonce(block_template: BlockTemplate, nonce: str) -> bool:
+    def share_hash(job: Job, nonce: bytes) -> int:
         """
-        Checks if the given nonce produces a valid proof of work for the given block
+        Computes the block hash of the given job and nonce as integer.
 
-        :param block_template: the block template for the current block to be mined
-        :param nonce: nonce in hex format (big endian)
+        The nonce is patched into the cached header of the job in place, i.e. no header is assembled and nothing is
+        formatted unless debug logging is on. Jobs must therefore not be validated concurrently from multiple threads.
+
+        :param job: the job of the device that sent the nonce
+        :param nonce: 4 byte nonce as received from the device (big endian)
+        :return: block hash as integer
+        """
+        job.nonce_view[:] = nonce[::-1]
+        block_hash = int.from_bytes(sha256d(job.header), byteorder="little")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"\t{job.block_info()} block_hash  = {block_hash:064x}")
+            logger.debug(
+                f"\t{job.block_info()} target_hash = {job.block_template.target_int:064x}"
+            )
+        return block_hash
+
+    @staticmethod
+    def check_nonce(job: Job, nonce: bytes) -> bool:
+        """
+        Checks if the given nonce produces a valid proof of work for the given job.
+
+        The block hash (see share_hash) is compared with the pre-decoded integer target of the block template.
+
+        :param job: the job of the device that sent the nonce
+        :param nonce: 4 byte nonce as received from the device (big endian)
         :return: True if valid, else False
         """
-        block_hash = block_template.block_header_hash(nonce)
-        target_hash = block_template.target_hash()
-        logger.debug(
-            f"\t{block_template.block_info()} block_hash  = {block_hash.hex()}"
+        return Miner.share_hash(job, nonce) <= job.block_template.target_int
+
+    async def mine_coroutine(self, session: DeviceSession, work: asyncio.Queue) -> None:
+        """
+        Long-running worker that handles the mining process on a single device.
+
+        The worker sends every new work item from its queue to the device, i.e. a new block template "restarts" the
+        device without cancelling the worker. After reception of a share, the block hash needs to be checked against
+        the actual target hash of the block, to determine if it is a valid proof of work for the block.
+        Valid proofs of work are put into the share queue as (job, nonce) pair.
+        Each work item gets a new job ID. Shares that devices report for a previous job ID are stale, they are
+        counted and dropped instead of being checked against the wrong job.
+        If vardiff is enabled, the share target of devices that support it is retargeted towards the configured
+        share rate (see vardiff.VarDiff). Each share is recorded for the hashrate measurement of the session.
+        If the device drops out, the unsearched part of its nonce range is handed over (see release). After the
+        reconnect, the device takes that part back if no successor has started it yet, else it waits for new work
+        (see reclaim).
+        Shares are classified as accepted, stale or invalid (block hash above the share target) in the metrics of the
+        device, along with the time from new work to the first share (see metrics.Metrics).
+
+        :param session: the session of the device to mine on
+        :param work:    queue of work items (job, data), where data is either midstate and the last 16 bytes
+                        of the block header (for devices with midstate support) or the full 80 byte block header
+        """
+        logger.info(f"Starting Mining Task for {session}")
+        metrics = self.metrics.device(str(session))
+        job, data = await work.get()
+        job_id = 0
+        vardiff = None
+        share_target = DEFAULT_SHARE_TARGET
+        next_work = asyncio.create_task(work.get())
+        response = None
+        try:
+            while True:
+                try:
+                    # the protocol, and therefore the support of share targets, is negotiated on each (re)connect
+                    await session.open()
+                    if not session.device.supports_target:
+                        vardiff, share_target = None, DEFAULT_SHARE_TARGET
+                    elif vardiff is None and self.vardiff.get("enabled", False):
+                        vardiff = VarDiff(self.vardiff, time.monotonic())
+                    if vardiff:
+                        share_target = vardiff.target
+                        await session.set_target(share_target.to_bytes(32, "big"))
+                    await session.send_work(job_id, data)
+                    self.__assignments[session] = (job, time.monotonic())
+                    metrics.work(time.monotonic(), self.__round_end)
+                    metrics.online = True
+                    while True:
+                        if response is None:
+                            response = asyncio.create_task(session.read_share())
+                        done, _ = await asyncio.wait(
+                            {response, next_work},
+                            timeout=vardiff.retarget_interval if vardiff else None,
+                            return_when=asyncio.FIRST_COMPLETED,
+                        )
+                        if vardiff:
+                            share = response in done and response.exception() is None
+                            await self.retarget(session, vardiff, share)
+                            # shares in flight may still meet the previous (larger) target
+                            share_target = max(share_target, vardiff.target)
+                        if next_work in done:
+                            job, data = next_work.result()
+                            job_id = (job_id + 1) & 0xFF
+                            next_work = asyncio.create_task(work.get())
+                            logger.debug(f"\tRestarting {session} with new work")
+                            await session.send_work(job_id, data)
+                            self.__assignments[session] = (job, time.monotonic())
+                            metrics.work(time.monotonic(), self.__round_end)
+                            if vardiff:
+                                share_target = vardiff.target
+                        if response in done:
+                            (share_job_id, share), response = response.result(), None
+                            if len(share) != 4:
+                                continue
+                            session.record_share(share_target)
+                            if share_job_id is not None and share_job_id != job_id:
+                                session.stale_shares += 1
+                                metrics.share("stale", share_target, time.monotonic())
+                                logger.debug(
+                                    f"\tDropped stale share of job {share_job_id} from {session}"
+                                )
+                                continue
+                            if logger.isEnabledFor(logging.DEBUG):
+                                logger.debug(
+                                    f"\tReceived share (nonce = 0x{share.hex()}) from {session}"
+                                )
+                            block_hash = self.share_hash(job, share)
+                            block_target = job.block_template.target_int
+                            metrics.share(
+                                "accepted"
+                                if block_hash <= max(share_target, block_target)
+                                else "invalid",
+                                share_target,
+                                time.monotonic(),
+                            )
+                            if block_hash <= block_target:
+                                logger.info(
+                                    f"\x1b[33;1m>>> {session} found a valid hash for {job.block_info()}\x1b[0m"
+                                )
+                                self.__shares.put_nowait((job, share.hex()))
+                            else:
+                                logger.debug(
+                                    "\tShare invalid (block_hash > target_hash)"
+                                )
+                except DeviceConnectionError as e:
+                    response = None
+                    metrics.online = False
+                    logger.error(e)
+                    logger.debug(f"\t{e.detail}")
+                    self.release(session)
+                    await session.reconnect()
+                    resumed = self.reclaim(session, job)
+                    if resumed is None:
+                        # the successors already search the rest of the nonce range
+                        job, data = await next_work
+                        next_work = asyncio.create_task(work.get())
+                        job_id = (job_id + 1) & 0xFF
+                    elif resumed is not job:
+                        job, data = self.work_items([session], [resumed])[0]
+                        job_id = (job_id + 1) & 0xFF
+
+        except asyncio.CancelledError:
+            logger.debug(f"Cancelling Mining Task for {session}")
+        finally:
+            metrics.online = False
+            for task in (response, next_work):
+                if task:
+                    task.cancel()
+            logger.debug(f"Exiting Mining Task for {session}")
+
+    @staticmethod
+    async def retarget(session: DeviceSession, vardiff: VarDiff, share: bool) -> None:
+        """
+        Records a share and sends a new share target to the device, once vardiff computes one
+
+        :param session: the session of the device
+        :param vardiff: vardiff controller of the device
+        :param share: True iff the device sent a share
+        :raises DeviceConnectionError
+        """
+        if share:
+            vardiff.share()
+        target = vardiff.retarget(time.monotonic())
+        if target is not None:
+            logger.info(f"\tRetargeting {session} to share target {target:064x}")
+            await session.set_target(target.to_bytes(32, "big"))
+
+    async def start_workers(self) -> None:
+        """Starts a long-running mining task for each device (see mine_coroutine)"""
+        self.__shares = asyncio.Queue()
+        self.__work_queues = [
+            asyncio.Queue(maxsize=1) for _ in self.device_manager.sessions()
+        ]
+        self.__workers = [
+            asyncio.create_task(self.mine_coroutine(session, queue))
+            for session, queue in zip(
+                self.device_manager.sessions(), self.__work_queues
+            )
+        ]
+
+    async def stop_workers(self) -> None:
+        """Cancels all mining tasks and waits for their termination"""
+        for worker in self.__workers:
+            worker.cancel()
+        await asyncio.gather(*self.__workers, return_exceptions=True)
+        self.__workers = []
+        for handover in self.__handovers:
+            handover.cancel()
+        self.__handovers = []
+        self.__released.clear()
+        self.__assignments.clear()
+
+    def create_jobs(
+        self, block_template: BlockTemplate, nonce_start: int = 0
+    ) -> list[Job]:
+        """
+        Creates a job for each device.
+
+        If the block template uses an extranonce, each device gets a job with its own extranonce and therefore
+        searches the full nonce range [nonce_start, 2^32) of a different coinbase transaction.
+        Otherwise, all devices are mining the same block concurrently, each with its own part of the nonce range,
+        sized by the hashrate of the device (see DeviceManager.nonce_ranges).
+        If version rolling is enabled and the template allows it, each device instead gets a header with its own
+        version (BIP 320) and the full nonce range (see BlockTemplate.rolled_versions). Otherwise, ntime rolling gives
+        each device its own timestamp (see BlockTemplate.rolled_ntimes).
+
+        :param block_template: the block template for the current block to be mined
+        :param nonce_start: nonce to start iterating from
+        :return: a job per session
+        """
+        sessions = self.device_manager.sessions()
+        if block_template.extranonce_size:
+            ntimes = self.ntime_rolling and block_template.rolled_ntimes(1)
+            jobs = block_template.jobs(nonce_start, ntimes[0] if ntimes else None)
+            return [next(jobs) for _ in sessions]
+        versions = self.version_rolling and block_template.rolled_versions(
+            len(sessions)
         )
-        logger.debug(
-            f"\t{block_template.block_info()} target_hash = {target_hash.hex()}"
+        if versions:
+            logger.debug(f"\tversions = {[hex(version) for version in versions]}")
+            return [
+                Job(block_template, nonce_start=nonce_start, version=version)
+                for version in versions
+            ]
+        ntimes = self.ntime_rolling and block_template.rolled_ntimes(len(sessions))
+        if ntimes:
+            logger.debug(f"\tntimes = {ntimes}")
+            return [
+                Job(block_template, nonce_start=nonce_start, ntime=ntime)
+                for ntime in ntimes
+            ]
+        jobs = [
+            Job(block_template, nonce_start=start, nonce_end=end)
+            for start, end in self.device_manager.nonce_ranges(nonce_start)
+        ]
+        logger.debug(f"\tstarting nonces = {[hex(j.nonce_start) for j in jobs]}")
+        return jobs
+
+    @staticmethod
+    def work_items(
+        sessions: list[DeviceSession], jobs: list[Job]
+    ) -> list[tuple[Job, bytes]]:
+        """
+        Creates the work items (job, data) for the given sessions, where data is either midstate and the last 16 bytes
+        of the block header (for devices with midstate support) or the full 80 byte block header.
+
+        Jobs that only differ in the last 16 bytes of the header (nonce range or timestamp) share their midstate,
+        so it is computed once per distinct first chunk. Many distinct midstates (e.g. one per rolled version) are
+        computed in a single vectorized pass, if numpy is available.
+
+        :param sessions: sessions of the devices
+        :param jobs: a job per session
+        :return: a work item per session
+        """
+        headers = [job.block_header() for job in jobs]
+        # one pass over the distinct first chunks of all devices with midstate support
+        chunks = list(
+            dict.fromkeys(
+                header[:64]
+                for header, session in zip(headers, sessions)
+                if session.device.has_midstate_support
+            )
+        )
+        vectorized = (
+            len(chunks) >= VECTORIZED_MIDSTATES and sha256d_batch.np is not None
         )
-        return block_hash <= target_hash
+        midstates = dict(zip(chunks, calculate_midstates(chunks, vectorized)))
+        items = []
+        for job, block_header, session in zip(jobs, headers, sessions):
+            if session.device.has_midstate_support:
+                midstate = midstates[block_header[:64]]
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"\tmidstate = {midstate.hex()}")
+                items.append((job, midstate + swap32_buffer(block_header[64:])))
+            else:
+                items.append((job, block_header))
+        return items
 
-    async def mine_coroutine(
+    def prepare_work(
         self,
-        device: MiningDevice,
         block_template: BlockTemplate,
-        midstate: bytes,
-        block_header: bytes,
-    ) -> Optional[str]:
+        nonce_start: Optional[str] = None,
+    ) -> list[tuple[Job, bytes]]:
+        """
+        Creates the work items of all devices for the given block template (see create_jobs and work_items)
+
+        :param block_template: the block template for the current block to be mined
+        :param nonce_start: optional nonce to start iterating from (in big endian hex format)
+        :return: a work item per session
+        """
+        jobs = self.create_jobs(
+            block_template, int(nonce_start, 16) if nonce_start else 0
+        )
+        return self.work_items(self.device_manager.sessions(), jobs)
+
+    def push_work(
+        self,
+        block_template: BlockTemplate,
+        nonce_start: Optional[str] = None,
+        items: Optional[list[tuple[Job, bytes]]] = None,
+    ) -> None:
         """
-        Coroutine that handles the mining process on a single device.
+        Pushes new work for the given block template to all running mining tasks (see create_jobs).
 
-        After reception of a share, the block hash needs to be checked against the actual target hash of the block,
-        to determine if it is a valid proof of work for the block.
+        Work that was not yet picked up by a mining task and pending handovers are replaced.
 
-        :param device:         the device to mine on
         :param block_template: the block template for the current block to be mined
-        :param midstate:       the SHA256 midstate for the first 64-byte chunk of block header data
-        :param block_header:   80 byte block header in little endian
-        :return: nonce iff a valid proof of work was found for this block
+        :param nonce_start: optional nonce to start iterating from (in big endian hex format)
+        :param items: work items prepared in advance (see prepare_work), instead of creating them now
         """
-        try:
-            logger.info(f"Starting Mining Task for {device}")
-            await device.connect()
-            if device.has_midstate_support:
-                await device.write(midstate + swap32_buffer(block_header[64:]))
-            else:
-                await device.write(block_header)
-            while True:
-                response = await device.read(size=4)
-                if len(response) == 4:
-                    nonce = response.hex()
-                    logger.debug(f"\tReceived share (nonce = 0x{nonce}) from {device}")
-                    if self.check_nonce(block_template, nonce):
-                        logger.info(
-                            f"\x1b[33;1m>>> {device} found a valid hash for {block_template.block_info()}\x1b[0m"
-                        )
-                        return nonce
-                    logger.debug("\tShare invalid (block_hash > target_hash)")
+        for handover in self.__handovers:
+            handover.cancel()
+        self.__handovers = []
+        self.__released.clear()
+        if items is None:
+            items = self.prepare_work(block_template, nonce_start)
+        for item, queue in zip(items, self.__work_queues):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(item)
+
+    def found_block(self, job: Job, nonce: str) -> None:
+        """
+        Passes a valid proof of work on to the submit consumer, e.g. a share of a remote worker
 
-        except asyncio.CancelledError:
-            logger.debug(f"Cancelling Mining Task for {device}")
-        except DeviceConnectionError as e:
-            logger.error(e)
-            logger.debug(f"\t{e.detail}")
-            await asyncio.sleep(10)
-        finally:
-            logger.debug(f"Exiting Mining Task for {device}")
+        :param job: the job of the share
+        :param nonce: nonce in hex format (big endian)
+        """
+        self.__shares.put_nowait((job, nonce))
+
+    def release(self, session: DeviceSession) -> list[tuple[DeviceSession, Job, float]]:
+        """
+        Hands over the unsearched part of the nonce range of a device that dropped out.
+
+        The position of the device is estimated from its hashrate. The rest of its range is split among the connected
+        devices by hashrate (see DeviceManager.nonce_ranges) and scheduled as new work for each device at the time it
+        is expected to finish its own range.
+        Only devices that mine the same block header can take over. Jobs with extranonce, rolled timestamp or rolled
+        version are not handed over, since every device has a full nonce range of its own.
+        The unsearched job is kept until the device reconnects (see reclaim).
+
+        :param session: the session of the device that dropped out
+        :return: list of handovers (successor, job, delay in seconds)
+        """
+        job, started = self.__assignments.pop(session, (None, 0))
+        if job is None:
+            return []
+        now = time.monotonic()
+        start = job.nonce_start + int((session.hashrate(now) or 0) * (now - started))
+        successors = [
+            s
+            for s, (own, _) in self.__assignments.items()
+            if s.connected and own.header_prefix == job.header_prefix
+        ]
+        if start >= job.nonce_end or not successors:
+            return []
+
+        handovers, handles = [], []
+        ranges = self.device_manager.nonce_ranges(start, job.nonce_end, successors)
+        for successor, (nonce_start, nonce_end) in zip(successors, ranges):
+            own, since = self.__assignments[successor]
+            hashrate = successor.hashrate(now) or 1
+            delay = (own.nonce_end - own.nonce_start) / hashrate - (now - since)
+            orphan = Job(
+                job.block_template,
+                job.extranonce,
+                nonce_start,
+                nonce_end,
+                job.ntime,
+                job.version,
+            )
+            logger.info(
+                f"\tHanding over nonces [{nonce_start:#010x}, {nonce_end:#010x}) of {session} to {successor} "
+                f"in {max(0.0, delay):.0f}s"
+            )
+            queue = self.__work_queues[self.device_manager.sessions().index(successor)]
+            item = self.work_items([successor], [orphan])[0]
+            handles.append(
+                asyncio.get_running_loop().call_later(
+                    max(0.0, delay), self.__hand_over, queue, item
+                )
+            )
+            handovers.append((successor, orphan, max(0.0, delay)))
+        self.__handovers += handles
+        unsearched = Job(
+            job.block_template,
+            job.extranonce,
+            start,
+            job.nonce_end,
+            job.ntime,
+            job.version,
+        )
+        self.__released[session] = (unsearched, handles)
+        return handovers
+
+    def reclaim(self, session: DeviceSession, job: Job) -> Optional[Job]:
+        """
+        Returns the job to resume on a device that reconnected after it dropped out (see release).
+
+        If the rest of its nonce range was handed over, but no successor has started it yet, the handovers are
+        cancelled and the device resumes at the position where it dropped out. If a successor has already started, the
+        device gets no job, since resending its previous job would search nonces of the successors again.
+
+        :param session: the session of the device that reconnected
+        :param job: the job of the device before it dropped out
+        :return: the given job if nothing was handed over, the unsearched part of it, or None if it was taken over
+        """
+        unsearched, handles = self.__released.pop(session, (job, []))
+        if not handles:
+            return unsearched
+        now = asyncio.get_running_loop().time()
+        if min(handle.when() for handle in handles) <= now:
+            return None
+        for handle in handles:
+            handle.cancel()
+        logger.info(
+            f"\tResuming {session} at nonce {unsearched.nonce_start:#010x}, handovers cancelled"
+        )
+        return unsearched
+
+    @staticmethod
+    def __hand_over(queue: asyncio.Queue, item: tuple[Job, bytes]) -> None:
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(item)
 
     async def mine(
         self,
@@ -332,128 +1160,471 @@ class Miner:
         nonce_start: Optional[str] = None,
     ) -> Optional[str]:
         """
-        Starts the mining process on all available mining devices, by creating a separate mining task for each device.
+        Mines a single block template on all available mining devices.
 
         All devices are mining the same block concurrently, each with a different starting nonce.
-        If any device finds a valid nonce, all other tasks are cancelled immediately.
-        If no device finds a valid nonce before a mining timeout, all tasks are cancelled.
+        If any device finds a valid nonce, all mining tasks are stopped immediately.
+        If no device finds a valid nonce before a mining timeout, all mining tasks are stopped.
 
         :param block_template: the block template for the current block to be mined
         :param nonce_start: optional nonce to start iterating from (in big endian hex format)
         :return: nonce if a valid proof of work was found for this block, else None (timeout)
         """
-        devices = self.device_manager.devices()
-        midstate = calculate_midstate(block_template.block_header(None))
-        logger.debug(f"\tmidstate = {midstate.hex()}")
-
-        nonce_end = 2**32 - 1
-        nonce_start = int(nonce_start, 16) if nonce_start else 0
-        nonce_incr = int((nonce_end - nonce_start) / len(devices))
-        nonces = [hex(nonce_start + i * nonce_incr) for i in range(len(devices))]
-        logger.debug(f"\tstarting nonces = {nonces}")
-
-        # create task for each device
-        mining_tasks = [
-            asyncio.create_task(
-                self.mine_coroutine(
-                    device=device,
-                    block_template=block_template,
-                    midstate=midstate,
-                    block_header=block_template.block_header(nonce),
-                )
+        await self.start_workers()
+        try:
+            self.push_work(block_template, nonce_start)
+            _, nonce = await asyncio.wait_for(
+                self.__shares.get(), timeout=self.mining_timeout
             )
-            for nonce, device in zip(nonces, devices)
-        ]
-        done, _ = await asyncio.wait(
-            mining_tasks,
-            timeout=self.mining_timeout,
-            return_when=asyncio.FIRST_COMPLETED,
-        )
-        if len(done):
-            return next(iter(done)).result()
-
-        logger.info("Mining timeout")
-        return None
+            return nonce
+        except asyncio.TimeoutError:
+            logger.info("Mining timeout")
+            return None
+        finally:
+            await self.stop_workers()
 
-    def get_block_template(self) -> BlockTemplate:
+    async def get_block_template(
+        self, longpollid: Optional[str] = None
+    ) -> BlockTemplate:
         """
         Calls the getblocktemplate JSON-RPC method and instantiates a BlockTemplate object.
 
-        This function will block forever until a successful connection to the RPC server can be established.
+        The RPC call is asynchronous (see rpc_client.RPCClient), so that all mining tasks keep working in the meantime.
+        The template is fetched from the fastest healthy node (or hedged across the two fastest nodes, see
+        node_pool.NodePool), failing over to the other nodes if a node is dead or stalls.
+        This function will wait forever until a successful connection to any RPC server can be established,
+        retrying with exponential backoff.
 
+        If a 'longpollid' is given, this is a long poll request (see BIP 22), i.e. the server will not respond until
+        a new block template is available, e.g. after a new block was found on the network.
+
+        :param longpollid: optional 'longpollid' of a previous block template
         :raises MinerError for some critical error during initialization of BlockTemplate
         :return: a new BlockTemplate object
         """
+        params = {"rules": ["segwit"]}
+        if longpollid:
+            params["longpollid"] = longpollid
+        backoff = Backoff()
         while True:
             try:
-                rpc = AuthServiceProxy(service_url=self.rpc_url)
-                logger.debug(f"RPC<{self.rpc['server']}> getblocktemplate()")
+                logger.debug(f"RPC<{self.nodes}> getblocktemplate({params})")
+                start = time.monotonic()
+                try:
+                    # long poll requests are supposed to stay open for a long time
+                    template = await self.nodes.call(
+                        "getblocktemplate",
+                        params,
+                        timeout=None if longpollid else DEFAULT,
+                        hedge=False if longpollid else None,
+                    )
+                finally:
+                    # long poll requests wait for the next block, their latency is meaningless
+                    if not longpollid:
+                        self.metrics.rpc_call(
+                            "getblocktemplate",
+                            time.monotonic() - start,
+                            error=sys.exc_info()[0] is not None,
+                        )
                 block_template = BlockTemplate(
-                    template=rpc.getblocktemplate({"rules": ["segwit"]}),
-                    cb_config=self.config["coinbase"],
+                    template=template,
+                    cb_config=self.coinbase,
                 )
+                self.metrics.template(time.monotonic())
                 logger.debug(block_template)
                 return block_template
-            except (JSONRPCException, ConnectionError) as e:
-                logger.error(f"Cannot connect to {self.rpc['server']}")
+            except (RPCError, ConnectionError) as e:
+                logger.error(f"Cannot get block template from {self.nodes}")
                 logger.debug(f"\t{e}")
-                logger.info("\tTrying again in 5 seconds ...")
-                time.sleep(5)
+                logger.info(f"\tTrying again in {backoff.delay:g} seconds ...")
+                await backoff.wait()
             except OSError as e:
                 raise MinerError(e)
 
-    def submit_block(self, block: str) -> bool:
+    async def submit_block(self, block: str) -> Optional[bool]:
         """
         Calls the submitblock JSON-RPC method to submit the newly created block with valid proof of work.
 
-        For connection errors to the server, there will be 10 attempts to submit the data with 5 seconds in between.
+        The block is submitted to all healthy nodes in parallel (see node_pool.NodePool.broadcast), so that it
+        propagates as fast as possible. It is accepted, if any node accepted it (or already knows it).
+        If no node can be reached, there will be 10 attempts to submit the data with exponential backoff in between.
         The block will be discarded if all attempts are unsuccessful.
 
         :param block: the hex-encoded block data to submit
-        :return: True if block was accepted by server,
-                 False if block was rejected by server or after connection timeout
+        :return: True if block was accepted by any server,
+                 False if block was rejected by all servers,
+                 None if no server could be reached
         """
         attempts = 10
+        backoff = Backoff()
+        while True:
+            logger.debug(f"RPC<{self.nodes}> submitblock()")
+            start = time.monotonic()
+            results = await self.nodes.broadcast("submitblock", block)
+            reachable = [
+                (node, result)
+                for node, result in results
+                if not isinstance(result, ConnectionError)
+            ]
+            self.metrics.rpc_call(
+                "submitblock", time.monotonic() - start, error=not reachable
+            )
+            # 'duplicate': the node already received the block (e.g. from one of the other nodes)
+            if any(result in (None, "duplicate") for _, result in reachable):
+                return True
+            for node, result in reachable:
+                logger.error(f"\tRPC<{node}> response: {result}")
+            if reachable:
+                return False
+            attempts -= 1
+            logger.error(f"Cannot connect to {self.nodes}")
+            for node, result in results:
+                logger.debug(f"\tRPC<{node}> {result}")
+            if attempts == 0:
+                return None
+            logger.info(
+                f"\tTrying again in {backoff.delay:g} seconds ({attempts} attempt{'s' if attempts > 1 else ''} left) ..."
+            )
+            await backoff.wait()
+
+    async def stratum_producer(self) -> None:
+        """
+        Restarts all mining tasks with the jobs of the upstream Stratum server (client mode).
+
+        Each new job restarts the devices immediately. After a mining timeout, the devices continue the current job
+        with the next extranonce2 values (see StratumTemplate). A job that became stale with a reconnect is no longer
+        rolled, the devices wait for the first job of the new connection.
+        """
+        block_template = None
         while True:
             try:
-                logger.debug(f"RPC<{self.rpc['server']}> submitblock()")
-                rpc = AuthServiceProxy(service_url=self.rpc_url)
-                response = rpc.submitblock(block)
-                if response:
-                    logger.error(f"\tRPC response: {response}")
-                    return False
+                job = await asyncio.wait_for(
+                    self.upstream.next_job(),
+                    timeout=None if block_template is None else self.mining_timeout,
+                )
+                self.__round_end = time.monotonic()
+                block_template = StratumTemplate(job)
+                self.metrics.template(time.monotonic())
+                logger.info(f"Received job '{job.job_id}' from {self.upstream}")
+            except asyncio.TimeoutError:
+                if not block_template.extranonce_size:
+                    # the devices keep searching their nonce ranges
+                    continue
+                if self.upstream.is_stale(block_template.stratum_job):
+                    logger.info(
+                        f"Waiting for a job of the new connection to {self.upstream}"
+                    )
+                    continue
+                self.__round_end = time.monotonic()
+                logger.info("Mining timeout, rolling extranonce2")
+            self.push_work(block_template)
+
+    async def share_consumer(self) -> None:
+        """
+        Submits the shares of all devices to the upstream Stratum server in background tasks (client mode).
+
+        Shares of stale jobs (see StratumClient.is_stale) are dropped.
+        """
+        while True:
+            job, nonce = await self.__shares.get()
+            if self.upstream.is_stale(job.block_template.stratum_job):
+                logger.debug(
+                    f"\tDropped share of stale job {job.block_template.job_id}"
+                )
+                continue
+            task = asyncio.create_task(
+                self.upstream.submit(
+                    job.block_template.job_id, job.extranonce, job.ntime, nonce
+                )
+            )
+            self.__submissions.add(task)
+            task.add_done_callback(self.__submissions.discard)
+
+    async def template_producer(self) -> None:
+        """
+        Fetches block templates and restarts all mining tasks with fresh work.
+
+        A new block template is fetched after each mining timeout or as soon as a block was submitted.
+        After a mining timeout, a template with rollable version or timestamp is reused with rolled headers instead,
+        until it is 'template_max_age' seconds old (see can_roll).
+        If long polling is enabled and supported by the server, a getblocktemplate request with the current
+        'longpollid' is kept outstanding. Its result restarts all mining tasks immediately.
+        The work of the next round after a mining timeout is prepared 'prefetch_time' seconds in advance (see
+        prefetch_work), so that the devices only wait for the write of their new work. It is discarded, if the round
+        ends early (long poll, new block).
+        """
+        block_template = None
+        items = None
+        longpoll = None
+        prefetch = None
+        try:
+            while True:
+                self.__refresh.clear()
+                if block_template is None:
+                    block_template = await self.get_block_template()
+                self.push_work(block_template, None, items)
+                if self.stratum:
+                    self.stratum.notify(block_template)
+
+                longpollid = block_template.template.get("longpollid")
+                if self.longpoll and longpollid and longpoll is None:
+                    longpoll = asyncio.create_task(self.get_block_template(longpollid))
+                if self.prefetch_time > 0:
+                    prefetch = asyncio.create_task(self.prefetch_work(block_template))
+
+                refresh = asyncio.create_task(self.__refresh.wait())
+                done, _ = await asyncio.wait(
+                    [task for task in (refresh, longpoll) if task],
+                    timeout=self.mining_timeout,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                refresh.cancel()
+                self.__round_end = time.monotonic()
+                items = None
+                if longpoll in done:
+                    block_template, longpoll = longpoll.result(), None
+                    logger.info("Received new block template (long poll)")
+                elif done:
+                    block_template = None
+                elif prefetch:
+                    rolled = block_template
+                    block_template, items = await prefetch
+                    if block_template is rolled:
+                        logger.info("Mining timeout, rolling block header (prefetched)")
+                    else:
+                        logger.info("Mining timeout (prefetched block template)")
+                elif self.can_roll(block_template):
+                    logger.info("Mining timeout, rolling block header")
+                else:
+                    block_template = None
+                    logger.info("Mining timeout")
+                if prefetch:
+                    prefetch.cancel()
+                    prefetch = None
+        finally:
+            for task in (longpoll, prefetch):
+                if task:
+                    task.cancel()
+
+    async def prefetch_work(
+        self, block_template: BlockTemplate
+    ) -> tuple[BlockTemplate, list[tuple[Job, bytes]]]:
+        """
+        Prepares the work of the next round 'prefetch_time' seconds before the mining timeout (but not before half of
+        the round, so that a short mining timeout does not fetch the next block template right after the current one):
+        the work items of the given block template with rolled headers (see can_roll), or otherwise of a new block
+        template.
+
+        :param block_template: the block template of the current round
+        :return: block template and work items (see prepare_work) of the next round
+        """
+        await asyncio.sleep(
+            max(self.mining_timeout - self.prefetch_time, self.mining_timeout / 2)
+        )
+        if not self.can_roll(block_template):
+            block_template = await self.get_block_template()
+        return block_template, self.prepare_work(block_template)
+
+    def can_roll(self, block_template: BlockTemplate) -> bool:
+        """
+        Returns True iff fresh work for the given block template can be created by rolling its version or timestamp
+        (see create_jobs), i.e. without fetching a new block template
+        """
+        now = time.monotonic()
+        if now - block_template.received >= self.template_max_age:
+            return False
+        if block_template.extranonce_size:
+            count = 1
+        else:
+            count = len(self.device_manager.sessions())
+            if (
+                self.version_rolling
+                and block_template.version_mask
+                and block_template.versions_left() >= count
+            ):
                 return True
-            except ConnectionError as e:
-                attempts -= 1
-                logger.error(f"Cannot connect to {self.rpc['server']}")
-                logger.debug(f"\t{e}")
-                if attempts == 0:
-                    return False
+        return (
+            self.ntime_rolling
+            and block_template.ntime_mutable
+            and block_template.next_ntime(now) + count - 1 <= block_template.maxtime
+        )
+
+    def request_template(self, reason: str) -> None:
+        """
+        Requests a new block template from the template producer, e.g. after a notification from bitcoind
+
+        :param reason: reason for the request (shown in logs)
+        """
+        logger.info(f"Requesting new block template ({reason})")
+        self.__refresh.set()
+
+    async def submit_consumer(self) -> None:
+        """
+        Hands each block with valid proof of work over to a background submission and requests a new block template
+        immediately, i.e. mining continues while the block is submitted.
+
+        Each block is written to the journal before its submission (see block_journal.BlockJournal). A block that cannot
+        be written to the journal (e.g. the disk is full) is submitted anyway.
+        """
+        solved = None
+        loop = asyncio.get_running_loop()
+        while True:
+            job, nonce = await self.__shares.get()
+            # devices may report further valid shares for a block that has already been submitted
+            if job.block_template is solved:
+                continue
+            solved = job.block_template
+            self.__refresh.set()
+            entry = dict(
+                hash=job.block_header_hash(nonce).hex(),
+                prevhash=job.block_template.prevhash[::-1].hex(),
+                height=job.block_template.height,
+                block=job.create_block(nonce),
+            )
+            try:
+                await loop.run_in_executor(None, self.journal.add, entry)
+            except OSError as e:
+                logger.error(
+                    f"Cannot write {job.block_info(nonce)} to {self.journal}: {e}"
+                )
+            self.submit_in_background(entry, job.block_info(nonce), job.reward_info())
+
+    def submit_in_background(
+        self, entry: dict, info: Optional[str] = None, reward: Optional[str] = None
+    ) -> None:
+        """
+        Starts the submission of a pending block as background task (see submit_pending)
+
+        :param entry: pending block (see block_journal.BlockJournal)
+        :param info: optional block info for logs
+        :param reward: optional reward info for logs
+        """
+        task = asyncio.create_task(self.submit_pending(entry, info, reward))
+        self.__submissions.add(task)
+        task.add_done_callback(self.__submissions.discard)
+
+    async def submit_pending(
+        self, entry: dict, info: Optional[str] = None, reward: Optional[str] = None
+    ) -> Optional[bool]:
+        """
+        Submits a pending block until it was accepted or rejected, or until it no longer extends the current tip.
+        The block is removed from the journal afterwards.
+
+        :param entry: pending block (see block_journal.BlockJournal)
+        :param info: optional block info for logs
+        :param reward: optional reward info for logs
+        :return: True if accepted, False if rejected, None if discarded
+        """
+        info = info or f"<Block [height={entry['height']}, header_hash={entry['hash']}]"
+        while True:
+            accepted = await self.submit_block(entry["block"])
+            if accepted is not None:
+                self.metrics.block(accepted)
+                break
+            if not await self.extends_tip(entry):
+                logger.error(f"Discarding {info}, it no longer extends the chain tip")
+                break
+        if accepted:
+            logger.info(f"\x1b[33;1m>>> Successfully mined {info}\x1b[0m")
+            if reward:
+                logger.info(f"\x1b[33;1m>>> {reward}\x1b[0m")
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.journal.remove, entry["hash"]
+        )
+        return accepted
+
+    async def extends_tip(self, entry: dict) -> bool:
+        """
+        Checks if a pending block still extends the current chain tip (or already is the tip)
+
+        :param entry: pending block (see block_journal.BlockJournal)
+        :return: False if the chain moved on, else True (also if no node can be reached)
+        """
+        try:
+            tip = await self.nodes.call("getbestblockhash")
+        except (RPCError, OSError) as e:
+            logger.debug(f"\tCannot get chain tip ({e})")
+            return True
+        return tip in (entry["prevhash"], entry["hash"])
+
+    async def resubmit_journal(self) -> None:
+        """Resubmits all pending blocks of the journal (e.g. after a restart), that still extend the chain tip"""
+        for entry in self.journal.pending():
+            if await self.extends_tip(entry):
                 logger.info(
-                    f"\tTrying again in 5 seconds ({attempts} attempt{'s' if attempts > 1 else ''} left) ..."
+                    f"Resubmitting pending block #{entry['height']} from {self.journal}"
+                )
+                self.submit_in_background(entry)
+            else:
+                logger.info(
+                    f"Discarding pending block #{entry['height']} from {self.journal}, it no longer extends the chain tip"
+                )
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self.journal.remove, entry["hash"]
                 )
-                time.sleep(5)
+
+    async def run(self) -> None:
+        """
+        Persistent mining engine (getblocktemplate -> mining -> submitblock) within a single event loop.
+
+        It consists of a template producer, a long-running mining task per device and a submit consumer, that submits
+        blocks in background tasks. Pending blocks of the journal are resubmitted at startup.
+        In server mode, a Stratum server distributes the block templates to remote workers as well.
+        In client mode, the jobs of an upstream Stratum server replace the block templates and all shares are submitted
+        to the server (see stratum_producer and share_consumer).
+        The device connections stay open for the whole time and are closed on shutdown.
+        """
+        self.__refresh = asyncio.Event()
+        await self.start_workers()
+        if self.upstream:
+            tasks = [
+                asyncio.create_task(self.upstream.run()),
+                asyncio.create_task(self.stratum_producer()),
+                asyncio.create_task(self.share_consumer()),
+            ]
+        else:
+            tasks = [
+                asyncio.create_task(self.template_producer()),
+                asyncio.create_task(self.submit_consumer()),
+                asyncio.create_task(self.resubmit_journal()),
+            ]
+        if self.config.get("zmq", {}).get("enabled", False):
+            try:
+                notifier = ZMQNotifier(self.config["zmq"], self.request_template)
+                tasks.append(asyncio.create_task(notifier.run()))
+            except ImportError as e:
+                logger.error(f"{e}, falling back to polling")
+        metrics_config = self.config.get("metrics", {})
+        if self.stratum:
+            tasks.append(asyncio.create_task(self.stratum.run()))
+        if metrics_config.get("export", False):
+            tasks.append(asyncio.create_task(self.metrics.run_exporter()))
+        if metrics_config.get("http", False):
+            server = MetricsServer(metrics_config, self.metrics)
+            tasks.append(asyncio.create_task(server.run()))
+        if metrics_config.get("export", False) or metrics_config.get("http", False):
+            tasks.append(asyncio.create_task(self.metrics.run_loop_monitor()))
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+        except MinerError as e:
+            logger.critical(e)
+        finally:
+            # pending blocks stay in the journal
+            tasks += self.__submissions
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.stop_workers()
+            await self.device_manager.close()
+            await self.nodes.close()
 
     def start(self) -> None:
-        """Starts the mining loop (getblocktemplate -> mining -> submitblock)"""
+        """Starts the mining engine (getblocktemplate -> mining -> submitblock)"""
         logger.info("Starting Miner")
         logger.debug(f"Using config\n{json.dumps(miner_config, indent=4)}")
-        while True:
-            try:
-                block_template = self.get_block_template()
-                nonce = asyncio.run(self.mine(block_template))
-                if nonce:
-                    if self.submit_block(block_template.create_block(nonce)):
-                        logger.info(
-                            f"\x1b[33;1m>>> Successfully mined {block_template.block_info(nonce)}\x1b[0m"
-                        )
-                        logger.info(
-                            f"\x1b[33;1m>>> {block_template.reward_info()}\x1b[0m"
-                        )
-
-            except MinerError as e:
-                logger.critical(e)
-                break
+        asyncio.run(self.run())
 
 
 def main():
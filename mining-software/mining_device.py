@@ -16,10 +16,28 @@ import hashlib
 import random
 import struct
 from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
 
 import serial_asyncio
 from serial import SerialException
 
+import sha256d_batch
+from device_protocol import (
+    MSG_HELLO,
+    MSG_SHARE,
+    MSG_TARGET,
+    MSG_WORK,
+    PROTOCOL_VERSION,
+    FrameDecoder,
+    encode_frame,
+    hello_frame,
+)
+
+# device protocols (see device_protocol), devices that do not answer the hello frame use the raw legacy protocol
+PROTOCOL_LEGACY = "legacy"
+PROTOCOL_FRAMED = "framed"
+
 
 class MiningDevice(ABC):
     """Device interface with abstract methods that must be overridden by the concrete mining device classes"""
@@ -28,15 +46,43 @@ class MiningDevice(ABC):
         self.type = device_type
         self.name = name
         self.has_midstate_support = True
+        self.hashrate: Optional[float] = None
+        self.protocol = PROTOCOL_LEGACY
+        self.decoder = FrameDecoder()
 
     def __str__(self):
         return f"<Device '{self.name}' [type={self.type}]>"
 
+    async def negotiate_protocol(self, timeout: float = 0.2) -> str:
+        """
+        Negotiates the device protocol by sending a hello frame to the connected device.
+
+        Devices with support for the framed protocol answer with a hello frame. Legacy devices process the hello frame,
+        which has exactly the size of a legacy work item, as (garbage) work and do not answer.
+
+        :param timeout: time in seconds to wait for the answer
+        :raises DeviceConnectionError
+        :return: the negotiated protocol
+        """
+        self.protocol = PROTOCOL_LEGACY
+        self.decoder.reset()
+        await self.write(hello_frame())
+        try:
+            frame = await asyncio.wait_for(self.read_frame(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return self.protocol
+        if frame.msg_type == MSG_HELLO and frame.payload[:1] == bytes(
+            [PROTOCOL_VERSION]
+        ):
+            self.protocol = PROTOCOL_FRAMED
+        return self.protocol
+
     async def is_mining_device(self) -> bool:
         """
         Checks whether the device has mining capabilities using midstate hashing.
 
-        Sends known answer test for block #222222. Device should reply instantly with the correct nonce.
+        Negotiates the device protocol and sends known answer test for block #222222. Device should reply instantly
+        with the correct nonce.
         :return: True iff device is a mining device and uses midstate hashing, else False.
         """
 
@@ -46,15 +92,19 @@ class MiningDevice(ABC):
             )
             try:
                 await self.connect()
-                await self.write(data)
+                await self.negotiate_protocol()
+                await self.send_work(0, data)
+                job_id, nonce = await self.read_share()
+                return job_id in (0, None) and nonce == data[-4:]
             except DeviceConnectionError:
                 return False
-            return data[-4:] == await self.read(4)
 
         try:
             return await asyncio.wait_for(kat(), timeout=0.5)
         except asyncio.TimeoutError:
             return False
+        finally:
+            await self.close()
 
     @abstractmethod
     async def connect(self) -> None:
@@ -64,6 +114,13 @@ class MiningDevice(ABC):
         """
         pass
 
+    @abstractmethod
+    async def close(self) -> None:
+        """
+        Closes the connection to the device. Closing an already closed device has no effect.
+        """
+        pass
+
     @abstractmethod
     async def write(self, data: bytes) -> None:
         """
@@ -83,6 +140,60 @@ class MiningDevice(ABC):
         """
         pass
 
+    async def read_frame(self):
+        """
+        Reads the next valid frame from the device (see device_protocol.FrameDecoder)
+        :raises DeviceConnectionError for any connection issue
+        :return: the received frame
+        """
+        # a resync can complete several frames with one read, the remaining frames are returned by the next calls
+        while not self.decoder.frames:
+            self.decoder.frames += self.decoder.feed(
+                await self.read(self.decoder.pending())
+            )
+        return self.decoder.frames.popleft()
+
+    async def send_work(self, job_id: int, data: bytes) -> None:
+        """
+        Sends new work to the device
+        :param job_id: ID of the job, that is reported back with each share (framed protocol only)
+        :param data: midstate and the last 16 bytes of the block header or the full 80 byte block header
+        :raises DeviceConnectionError for any connection issue
+        """
+        if self.protocol == PROTOCOL_FRAMED:
+            await self.write(encode_frame(MSG_WORK, job_id, data))
+        else:
+            await self.write(data)
+
+    @property
+    def supports_target(self) -> bool:
+        """True iff the share target of the device can be changed (see set_target)"""
+        return self.protocol == PROTOCOL_FRAMED
+
+    async def set_target(self, target: bytes) -> None:
+        """
+        Sets the share target of the device for all following shares (framed protocol only, devices with the legacy
+        protocol keep the share target of their firmware)
+        :param target: 32 byte share target in big endian
+        :raises DeviceConnectionError for any connection issue
+        """
+        if not self.supports_target:
+            return
+        await self.write(encode_frame(MSG_TARGET, 0, target))
+
+    async def read_share(self) -> tuple[Optional[int], bytes]:
+        """
+        Reads the next share from the device
+        :raises DeviceConnectionError for any connection issue
+        :return: job ID (None for the legacy protocol) and nonce (4 bytes, big endian)
+        """
+        if self.protocol != PROTOCOL_FRAMED:
+            return None, await self.read(4)
+        while True:
+            frame = await self.read_frame()
+            if frame.msg_type == MSG_SHARE and len(frame.payload) == 4:
+                return frame.job_id, frame.payload
+
 
 class DeviceConnectionError(Exception):
     def __init__(self, device: MiningDevice, detail: str):
@@ -129,6 +240,9 @@ class SerialMiningDevice(MiningDevice):
         )
 
     async def connect(self) -> None:
+        # never leave a previously opened port behind
+        await self.close()
+        self.decoder.reset()
         try:
             self.reader, self.writer = await serial_asyncio.open_serial_connection(
                 url=self.port, baudrate=self.baudrate, write_timeout=self.write_timeout
@@ -136,50 +250,190 @@ class SerialMiningDevice(MiningDevice):
         except SerialException as e:
             raise DeviceConnectionError(self, e.strerror)
 
+    async def close(self) -> None:
+        if self.writer is None:
+            return
+        writer, self.reader, self.writer = self.writer, None, None
+        try:
+            writer.close()
+            await writer.wait_closed()
+        except (SerialException, OSError, RuntimeError):
+            # the port may already be gone (e.g. device was unplugged) or belongs to an event loop that is closed
+            pass
+
     async def write(self, data: bytes) -> None:
+        if self.writer is None:
+            raise DeviceConnectionError(self, "Device is not connected")
         try:
             self.writer.write(data)
         except SerialException as e:
             raise DeviceConnectionError(self, e.strerror)
 
     async def read(self, size: int):
+        if self.reader is None:
+            raise DeviceConnectionError(self, "Device is not connected")
         try:
-            return await self.reader.readexactly(4)
+            return await self.reader.readexactly(size)
         except SerialException as e:
             raise DeviceConnectionError(self, e.strerror)
+        except asyncio.IncompleteReadError:
+            raise DeviceConnectionError(self, "Connection closed by device")
+
+
+# default share target of the mining firmware
+SHARE_TARGET = bytes.fromhex("00" * 2 + "FF" * 30)
+
+# SHA256d engines of simulated devices
+ENGINES = ("hashlib", "numpy")
+
+# all simulated devices share a pool of worker processes (see SimulatorMiningDevice)
+_scan_pool: Optional[ProcessPoolExecutor] = None
+
+
+def scan_pool() -> ProcessPoolExecutor:
+    """Returns the process pool for simulated devices, which is created on first use"""
+    global _scan_pool
+    if _scan_pool is None:
+        _scan_pool = ProcessPoolExecutor()
+    return _scan_pool
+
+
+def scanhash(
+    header: bytes,
+    nonce: int,
+    count: int,
+    engine: str = "hashlib",
+    target: bytes = SHARE_TARGET,
+) -> list[int]:
+    """
+    Scans count nonces starting at nonce for shares, i.e. the block hashes that are below the share target
+    (0x0000FF..FF by default, like the mining firmware).
+
+    Runs in a worker process, hence the module-level function.
+
+    :param header: 80 byte block header (the nonce is ignored)
+    :param nonce: first nonce to check
+    :param count: number of nonces to check
+    :param engine: 'hashlib' (one nonce at a time) or 'numpy' (batches of nonces, see sha256d_batch)
+    :param target: 32 byte share target in big endian
+    :return: all nonces of shares within the range
+    """
+    if engine == "numpy":
+        return sha256d_batch.scanhash(header, nonce, count, target)
+    target_hash = target
+    header = bytearray(header)
+    view = memoryview(header)[76:]
+    shares = []
+    for nonce in range(nonce, min(nonce + count, 0x100000000)):
+        # Update the block header with the new 32-bit nonce
+        view[:] = nonce.to_bytes(4, byteorder="little")
+        header_hash = hashlib.sha256(hashlib.sha256(header).digest()).digest()[::-1]
+        if header_hash <= target_hash:
+            shares.append(nonce)
+    return shares
 
 
 class SimulatorMiningDevice(MiningDevice):
-    def __init__(self, name: str, avg_delay: float):
+    """
+    Simulated mining device, that scans the nonce range of the last received block header in chunks on a shared
+    process pool, so that the hashing never blocks the event loop and many simulators can run side by side.
+
+    Shares are streamed into a bounded queue as soon as a chunk is finished and returned by read after a random delay.
+    Like devices with the framed protocol, each share is reported with the ID of its job. The queue persists across
+    new work, so that a pending read_share is not lost on a restart. Shares of replaced work are dropped.
+
+    :param name: an arbitrary name for the device (shown in logs)
+    :param avg_delay: average delay in seconds between two shares
+    :param chunk_size: number of nonces per task of the process pool
+    :param engine: SHA256d engine, 'hashlib' or 'numpy' (requires the package 'numpy')
+    """
+
+    def __init__(
+        self,
+        name: str,
+        avg_delay: float,
+        chunk_size: int = 0x10000,
+        engine: str = "hashlib",
+    ):
         super().__init__("simulator", name)
+        if engine not in ENGINES:
+            raise Exception(f"Unknown simulator engine '{engine}'")
+        if engine == "numpy" and sha256d_batch.np is None:
+            raise Exception("Simulator engine 'numpy' requires the package 'numpy'")
         self.avg_delay = avg_delay
+        self.chunk_size = chunk_size
+        self.engine = engine
         self.data = b""
         self.has_midstate_support = False
+        self.protocol = PROTOCOL_FRAMED
+        self.share_target = SHARE_TARGET
+        # (work generation, job ID, share), created within the running event loop
+        self.shares: Optional[asyncio.Queue] = None
+        self.generation = 0
+        self.scanner: Optional[asyncio.Task] = None
 
     def __repr__(self):
-        return f"<Device '{self.name}' [type={self.type}, avg_delay={self.avg_delay}s]>"
-
-    @staticmethod
-    def _scanhash(header: bytes) -> int:
-        target_hash = bytes.fromhex("00" * 2 + "FF" * 30)
-        nonce = int(header[76:][::-1].hex(), 16)
-        while nonce < 0xFFFFFFFF:
-            # Update the block header with the new 32-bit nonce
-            header = header[0:76] + nonce.to_bytes(4, byteorder="little")
-            header_hash = hashlib.sha256(hashlib.sha256(header).digest()).digest()[::-1]
-            if header_hash <= target_hash:
-                return nonce
-            nonce += 1
-        return nonce
+        return f"<Device '{self.name}' [type={self.type}, avg_delay={self.avg_delay}s, engine={self.engine}]>"
+
+    async def scan(self, job_id: Optional[int], header: bytes) -> None:
+        """Scans the nonce range of the given header, starting at its nonce, until cancelled or exhausted"""
+        loop = asyncio.get_running_loop()
+        generation = self.generation
+        nonce = struct.unpack_from("<L", header, 76)[0]
+        while nonce <= 0xFFFFFFFF:
+            shares = await loop.run_in_executor(
+                scan_pool(),
+                scanhash,
+                header,
+                nonce,
+                self.chunk_size,
+                self.engine,
+                self.share_target,
+            )
+            for share in shares:
+                await self.shares.put((generation, job_id, struct.pack(">L", share)))
+            nonce += self.chunk_size
+
+    async def negotiate_protocol(self, timeout: float = 0.2) -> str:
+        # simulated devices always use the framed protocol
+        return self.protocol
 
     async def connect(self) -> None:
         pass
 
+    async def close(self) -> None:
+        if self.scanner is not None:
+            self.scanner.cancel()
+            self.scanner = None
+
     async def write(self, data) -> None:
-        self.data = data
+        await self.send_work(None, data)
 
     async def read(self, size):
+        return (await self.read_share())[1]
+
+    async def set_target(self, target: bytes) -> None:
+        # applies to all chunks that are not yet started
+        self.share_target = target
+
+    async def send_work(self, job_id: Optional[int], data: bytes) -> None:
+        # new work replaces the current scan and all of its pending shares
+        await self.close()
+        self.data = data
+        self.generation += 1
+        if self.shares is None:
+            self.shares = asyncio.Queue(maxsize=16)
+        while not self.shares.empty():
+            self.shares.get_nowait()
+        self.scanner = asyncio.create_task(self.scan(job_id, data))
+
+    async def read_share(self) -> tuple[Optional[int], bytes]:
+        if self.shares is None:
+            raise DeviceConnectionError(self, "Device has no work")
         # add up to +-2 seconds of delay for some randomness
         delay = self.avg_delay + (random.uniform(-2, 2) if self.avg_delay > 2 else 0)
         await asyncio.sleep(delay)
-        return struct.pack(">L", self._scanhash(self.data))
+        while True:
+            generation, job_id, share = await self.shares.get()
+            if generation == self.generation:
+                return job_id, share
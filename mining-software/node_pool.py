@@ -0,0 +1,206 @@
+#  Copyright (C) 2022 Jan Sturm
+#
+#  This program is free software: you can redistribute it and/or modify it under
+#  the terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  This program is distributed in the hope that it will be useful, but WITHOUT
+#  ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or FITNESS
+#  FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Pool of bitcoind nodes with health tracking, failover and hedged requests"""
+
+import asyncio
+import time
+from typing import Any, Optional
+
+from custom_logger import logger
+from rpc_client import DEFAULT, RPC_TIMEOUT, RPCClient, RPCError
+
+# weight of the latest latency in the moving average of a node
+LATENCY_ALPHA = 0.3
+
+
+class RPCNode:
+    """
+    A single bitcoind node and its health.
+
+    A failed call marks the node unhealthy for a backoff delay, that doubles with each consecutive failure.
+    Afterwards, the node gets another chance (and is healthy again after the first successful call).
+
+    :param name: ip address and port of the node
+    :param client: JSON-RPC client of the node
+    :param backoff_initial: delay in seconds after the first failure
+    :param backoff_max: maximum delay in seconds
+    """
+
+    def __init__(
+        self,
+        name: str,
+        client: RPCClient,
+        backoff_initial: float = 1,
+        backoff_max: float = 60,
+    ):
+        self.name = name
+        self.client = client
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        # moving average of the latency in seconds, None until the first successful call
+        self.latency: Optional[float] = None
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def __str__(self):
+        return self.name
+
+    def healthy(self, now: float) -> bool:
+        """Returns True iff the node did not fail recently"""
+        return now >= self.retry_at
+
+    def success(self, seconds: Optional[float]) -> None:
+        """
+        Records a successful call
+
+        :param seconds: latency of the call, or None if the latency is meaningless (e.g. long poll requests)
+        """
+        self.failures, self.retry_at = 0, 0.0
+        if seconds is not None:
+            self.latency = (
+                seconds
+                if self.latency is None
+                else LATENCY_ALPHA * seconds + (1 - LATENCY_ALPHA) * self.latency
+            )
+
+    def failure(self, now: float) -> None:
+        """Records a failed call"""
+        delay = min(self.backoff_initial * 2**self.failures, self.backoff_max)
+        self.failures += 1
+        self.retry_at = now + delay
+
+
+class NodePool:
+    """
+    Distributes JSON-RPC calls across several bitcoind nodes.
+
+    Single calls go to the fastest healthy node (by moving average latency, nodes without measurement first) and fail
+    over to the next node on errors. Hedged calls are sent to the two fastest healthy nodes at once, the first
+    successful response wins. Broadcasts (e.g. submitblock) are sent to all healthy nodes in parallel.
+
+    :param config: rpc config (see [rpc] in config.toml), further nodes are given as list 'nodes' of dicts with
+                   'server' and optional 'username' and 'password' (defaults to the credentials of the main node)
+    """
+
+    def __init__(self, config: dict):
+        self.timeout = config.get("timeout", RPC_TIMEOUT)
+        self.hedge = config.get("hedge", False)
+        self.nodes = []
+        for node in [config, *config.get("nodes", [])]:
+            username = node.get("username", config["username"])
+            password = node.get("password", config["password"])
+            url = f"http://{username}:{password}@{node['server']}"
+            self.nodes.append(RPCNode(node["server"], RPCClient(url, self.timeout)))
+
+    def __str__(self):
+        return f"<NodePool [{', '.join(map(str, self.nodes))}]>"
+
+    def candidates(self, now: Optional[float] = None) -> list[RPCNode]:
+        """
+        Returns the healthy nodes ordered by latency, or all nodes ordered by their retry time if none is healthy
+
+        :param now: current time in seconds (monotonic)
+        """
+        now = time.monotonic() if now is None else now
+        healthy = [node for node in self.nodes if node.healthy(now)]
+        if not healthy:
+            return sorted(self.nodes, key=lambda node: node.retry_at)
+        return sorted(
+            healthy, key=lambda node: -1 if node.latency is None else node.latency
+        )
+
+    async def call_node(
+        self, node: RPCNode, method: str, *params, timeout: Any = DEFAULT
+    ) -> Any:
+        """
+        Calls a JSON-RPC method on the given node and records the outcome in its health
+
+        :raises RPCError or OSError (e.g. RPCConnectionError)
+        """
+        start = time.monotonic()
+        try:
+            result = await node.client.call(method, *params, timeout=timeout)
+        except (RPCError, OSError) as e:
+            node.failure(time.monotonic())
+            logger.debug(f"\tRPC<{node}> {method} failed ({e})")
+            raise
+        node.success(None if timeout is None else time.monotonic() - start)
+        return result
+
+    async def call(
+        self,
+        method: str,
+        *params,
+        timeout: Any = DEFAULT,
+        hedge: Optional[bool] = None,
+    ) -> Any:
+        """
+        Calls a JSON-RPC method on the fastest healthy node, failing over to the other nodes
+
+        :param method: name of the method
+        :param params: positional parameters
+        :param timeout: timeout in seconds per node (None = no timeout, e.g. for long poll requests)
+        :param hedge: send the call to the two fastest nodes at once (defaults to 'hedge' of the config)
+        :raises RPCError or OSError of the last node, if the call failed on all nodes
+        :return: result of the first successful call
+        """
+        hedge = self.hedge if hedge is None else hedge
+        candidates = self.candidates()
+        error = None
+        if hedge and len(candidates) > 1:
+            tasks = [
+                asyncio.create_task(
+                    self.call_node(node, method, *params, timeout=timeout)
+                )
+                for node in candidates[:2]
+            ]
+            candidates = candidates[2:]
+            try:
+                for task in asyncio.as_completed(tasks):
+                    try:
+                        return await task
+                    except (RPCError, OSError) as e:
+                        error = e
+            finally:
+                for task in tasks:
+                    task.cancel()
+        for node in candidates:
+            try:
+                return await self.call_node(node, method, *params, timeout=timeout)
+            except (RPCError, OSError) as e:
+                error = e
+        raise error
+
+    async def broadcast(
+        self, method: str, *params, timeout: Any = DEFAULT
+    ) -> list[tuple[RPCNode, Any]]:
+        """
+        Calls a JSON-RPC method on all healthy nodes in parallel (on all nodes, if none is healthy)
+
+        :param method: name of the method
+        :param params: positional parameters
+        :param timeout: timeout in seconds per node
+        :return: (node, result or exception) for each node that was called
+        """
+        nodes = self.candidates()
+        results = await asyncio.gather(
+            *(self.call_node(node, method, *params, timeout=timeout) for node in nodes),
+            return_exceptions=True,
+        )
+        return list(zip(nodes, results))
+
+    async def close(self) -> None:
+        """Closes the connections to all nodes"""
+        await asyncio.gather(*(node.client.close() for node in self.nodes))
@@ -0,0 +1,264 @@
+#  Copyright (C) 2022 Jan Sturm
+#
+#  This program is free software: you can redistribute it and/or modify it under
+#  the terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  This program is distributed in the hope that it will be useful, but WITHOUT
+#  ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or FITNESS
+#  FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Asyncio JSON-RPC client for bitcoind with persistent keep-alive connections"""
+
+import asyncio
+import base64
+import itertools
+import json
+from decimal import Decimal
+from typing import Any, Optional
+from urllib.parse import unquote, urlsplit
+
+# default timeout in seconds of a single RPC call (including the connection setup)
+RPC_TIMEOUT = 30
+# marks the default timeout of call() and batch(), since None disables the timeout
+DEFAULT = object()
+
+
+class RPCError(Exception):
+    """
+    Error object returned by the server for a JSON-RPC call
+
+    :param error: JSON-RPC error object with 'code' and 'message'
+    """
+
+    def __init__(self, error: dict):
+        super().__init__(error.get("message"))
+        self.error = error
+        self.code = error.get("code")
+        self.message = error.get("message")
+
+    def __str__(self):
+        return f"{self.code}: {self.message}"
+
+
+class RPCConnectionError(ConnectionError):
+    """The server cannot be reached, closed the connection or did not respond in time"""
+
+
+class Backoff:
+    """
+    Exponential backoff between consecutive attempts
+
+    :param initial: delay in seconds before the first retry
+    :param maximum: maximum delay in seconds
+    """
+
+    def __init__(self, initial: float = 0.5, maximum: float = 30):
+        self.initial = initial
+        self.maximum = maximum
+        self.delay = initial
+
+    def reset(self) -> None:
+        """Resets the delay after a successful attempt"""
+        self.delay = self.initial
+
+    async def wait(self) -> None:
+        """Waits for the current delay and doubles it for the next attempt"""
+        await asyncio.sleep(self.delay)
+        self.delay = min(2 * self.delay, self.maximum)
+
+
+class RPCClient:
+    """
+    JSON-RPC client (see https://developer.bitcoin.org/reference/rpc/) on top of asyncio streams.
+
+    Connections use HTTP/1.1 keep-alive and are kept in a pool, so consecutive calls skip the TCP and authentication
+    setup. A call that is pending (e.g. a long poll request) occupies its connection, concurrent calls use further
+    connections up to 'max_connections'. A reused connection that was closed by the server in the meantime is replaced
+    transparently.
+
+    :param url: server URL 'http://<user>:<password>@<host>:<port>[/path]'
+    :param timeout: default timeout in seconds of a single call
+    :param max_connections: maximum number of concurrent connections
+    """
+
+    def __init__(
+        self, url: str, timeout: float = RPC_TIMEOUT, max_connections: int = 4
+    ):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 8332
+        self.path = parts.path or "/"
+        self.timeout = timeout
+        self.max_connections = max_connections
+        credentials = f"{unquote(parts.username or '')}:{unquote(parts.password or '')}"
+        self.__auth = "Basic " + base64.b64encode(credentials.encode()).decode()
+        self.__ids = itertools.count(1)
+        self.__idle: list[tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+        self.__slots: Optional[asyncio.Semaphore] = None
+        self.__loop = None
+        # number of established connections (for tests and metrics)
+        self.connections = 0
+
+    def __str__(self):
+        return f"<RPCClient [{self.host}:{self.port}{self.path}]>"
+
+    def wallet(self, name: str) -> "RPCClient":
+        """Returns a client for the wallet endpoint '/wallet/<name>' of the same server"""
+        client = RPCClient.__new__(RPCClient)
+        client.__dict__.update(self.__dict__)
+        client.path = f"/wallet/{name}"
+        client.__idle, client.__slots, client.__loop = [], None, None
+        client.connections = 0
+        return client
+
+    async def call(self, method: str, *params, timeout: Any = DEFAULT) -> Any:
+        """
+        Calls a single JSON-RPC method
+
+        :param method: name of the method
+        :param params: positional parameters
+        :param timeout: timeout in seconds (None = no timeout, e.g. for long poll requests)
+        :raises RPCError if the server returned an error
+        :raises RPCConnectionError if the server cannot be reached or does not respond in time
+        :return: result of the call
+        """
+        request = dict(jsonrpc="1.0", id=next(self.__ids), method=method, params=params)
+        response = await self.__post(request, timeout)
+        if not isinstance(response, dict):
+            raise RPCConnectionError(f"Invalid JSON-RPC response {response!r}")
+        if response.get("error"):
+            raise RPCError(response["error"])
+        return response.get("result")
+
+    async def batch(
+        self, calls: list[tuple[str, list]], timeout: Any = DEFAULT
+    ) -> list[Any]:
+        """
+        Calls several JSON-RPC methods with a single request (JSON-RPC batch)
+
+        :param calls: list of (method, params)
+        :param timeout: timeout in seconds (None = no timeout)
+        :raises RPCConnectionError if the server cannot be reached or does not respond in time
+        :return: for each call in order either its result or an RPCError
+        """
+        if not calls:
+            return []
+        requests = [
+            dict(jsonrpc="1.0", id=next(self.__ids), method=method, params=params)
+            for method, params in calls
+        ]
+        responses = await self.__post(requests, timeout)
+        if not isinstance(responses, list):
+            raise RPCConnectionError(f"Invalid JSON-RPC batch response {responses!r}")
+        by_id = {response.get("id"): response for response in responses}
+        results = []
+        for request in requests:
+            response = by_id.get(request["id"])
+            if response is None:
+                results.append(RPCError(dict(code=None, message="Missing response")))
+            elif response.get("error"):
+                results.append(RPCError(response["error"]))
+            else:
+                results.append(response.get("result"))
+        return results
+
+    async def close(self) -> None:
+        """Closes all idle connections"""
+        idle, self.__idle = self.__idle, []
+        for _, writer in idle:
+            writer.close()
+
+    async def __post(self, payload: Any, timeout: Any) -> Any:
+        timeout = self.timeout if timeout is DEFAULT else timeout
+        loop = asyncio.get_running_loop()
+        if self.__loop is not loop:
+            # connections and semaphore are bound to the event loop
+            self.__idle, self.__loop = [], loop
+            self.__slots = asyncio.Semaphore(self.max_connections)
+        body = json.dumps(payload).encode()
+        async with self.__slots:
+            try:
+                return await asyncio.wait_for(self.__request(body), timeout)
+            except asyncio.TimeoutError:
+                raise RPCConnectionError(
+                    f"{self} did not respond within {timeout} seconds"
+                )
+
+    async def __request(self, body: bytes) -> Any:
+        # a reused connection may have been closed by the server, retry once on a new connection
+        while True:
+            reused = bool(self.__idle)
+            reader, writer = self.__idle.pop() if reused else await self.__connect()
+            try:
+                status, keep_alive, data = await self.__exchange(reader, writer, body)
+                break
+            except (OSError, asyncio.IncompleteReadError) as e:
+                writer.close()
+                if not reused:
+                    raise RPCConnectionError(f"Connection to {self} lost ({e!r})")
+            except BaseException:
+                # e.g. cancelled by a timeout, the connection is in an undefined state
+                writer.close()
+                raise
+        if keep_alive:
+            self.__idle.append((reader, writer))
+        else:
+            writer.close()
+        # bitcoind responds to failed calls with an HTTP error status and a JSON-RPC error object
+        try:
+            return json.loads(data, parse_float=Decimal)
+        except ValueError:
+            if status == 401:
+                raise RPCError(dict(code=401, message="Unauthorized"))
+            raise RPCConnectionError(f"Invalid response from {self} (HTTP {status})")
+
+    async def __connect(self) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        try:
+            connection = await asyncio.open_connection(self.host, self.port)
+        except OSError as e:
+            # e.g. refused connections, but also unresolvable host names (socket.gaierror)
+            raise RPCConnectionError(f"Cannot connect to {self} ({e})")
+        self.connections += 1
+        return connection
+
+    async def __exchange(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, body: bytes
+    ) -> tuple[int, bool, bytes]:
+        writer.write(
+            f"POST {self.path} HTTP/1.1\r\n"
+            f"Host: {self.host}:{self.port}\r\n"
+            f"Authorization: {self.__auth}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: keep-alive\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+
+        head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1")
+        status_line, *header_lines = head.split("\r\n")
+        version, status, *_ = status_line.split(" ", 2)
+        headers = {}
+        for line in header_lines:
+            if ":" in line:
+                key, value = line.split(":", 1)
+                headers[key.strip().lower()] = value.strip().lower()
+
+        if headers.get("transfer-encoding") == "chunked":
+            data = bytearray()
+            while size := int((await reader.readuntil(b"\r\n")).split(b";")[0], 16):
+                data += await reader.readexactly(size + 2)
+                del data[-2:]
+            await reader.readuntil(b"\r\n")
+        elif "content-length" in headers:
+            data = await reader.readexactly(int(headers["content-length"]))
+        else:
+            # the body ends with the connection
+            data, headers["connection"] = await reader.read(), "close"
+
+        keep_alive = headers.get("connection", "") != "close" and version == "HTTP/1.1"
+        return int(status), keep_alive, bytes(data)
@@ -0,0 +1,189 @@
+#  Copyright (C) 2022 Jan Sturm
+#
+#  This program is free software: you can redistribute it and/or modify it under
+#  the terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  This program is distributed in the hope that it will be useful, but WITHOUT
+#  ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or FITNESS
+#  FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Optional batch SHA256d engine (requires numpy) that hashes many nonces of a block header at once"""
+
+import struct
+from typing import Optional, Sequence
+
+from sha256d_ms import A0, B0, C0, D0, E0, F0, G0, H0, K, calculate_midstate
+
+try:
+    import numpy as np
+
+    K_U32 = [np.uint32(k) for k in K]
+except ImportError:
+    np = None
+
+# number of nonces per batch
+BATCH_SIZE = 4096
+
+
+def rotateright(i: "np.ndarray", p: int) -> "np.ndarray":
+    """i>>>p for arrays of uint32"""
+    return (i >> np.uint32(p)) | (i << np.uint32(32 - p))
+
+
+def compress(state: tuple, w: list, rounds: int = 64) -> tuple:
+    """
+    SHA256 compression function for a batch of 64 byte chunks
+
+    :param state: 8 state words (integers or uint32 arrays)
+    :param w: 16 message words (integers or uint32 arrays)
+    :param rounds: number of rounds to compute, fewer than 64 rounds return the intermediate working variables
+                   (without adding the initial state)
+    :return: the new 8 state words as uint32 arrays
+    """
+    # broadcast all words to arrays, so that additions wrap around without overflow warnings
+    state = np.broadcast_arrays(*(np.asarray(x, dtype=np.uint32) for x in (*state, *w)))
+    state, w = state[:8], list(state[8:])
+    a, b, c, d, e, f, g, h = state
+
+    for i, k in enumerate(K_U32[:rounds]):
+        if i >= 16:
+            # message schedule in a ring buffer of 16 words
+            w15, w2 = w[(i - 15) % 16], w[(i - 2) % 16]
+            s0 = rotateright(w15, 7) ^ rotateright(w15, 18) ^ (w15 >> np.uint32(3))
+            s1 = rotateright(w2, 17) ^ rotateright(w2, 19) ^ (w2 >> np.uint32(10))
+            w[i % 16] = w[i % 16] + s0 + w[(i - 7) % 16] + s1
+
+        s1 = rotateright(e, 6) ^ rotateright(e, 11) ^ rotateright(e, 25)
+        ch = (e & f) ^ (~e & g)
+        t1 = h + s1 + ch + k + w[i % 16]
+        s0 = rotateright(a, 2) ^ rotateright(a, 13) ^ rotateright(a, 22)
+        ma = (a & b) ^ (a & c) ^ (b & c)
+
+        a, b, c, d, e, f, g, h = t1 + s0 + ma, a, b, c, d + t1, e, f, g
+
+    if rounds < 64:
+        return a, b, c, d, e, f, g, h
+    return tuple(x + y for x, y in zip((a, b, c, d, e, f, g, h), state))
+
+
+def midstates(headers: Sequence[bytes]) -> list[bytes]:
+    """
+    Calculates the SHA256 midstates of the first 64 byte chunks of many block headers in one pass
+
+    :param headers: block headers in little endian (at least 64 bytes each)
+    :raises ImportError if numpy is not installed
+    :return: 32 byte midstate for each header (see sha256d_ms.calculate_midstate)
+    """
+    if np is None:
+        raise ImportError("Vectorized midstates require the package 'numpy'")
+    if not headers:
+        return []
+    chunks = np.frombuffer(b"".join(h[:64] for h in headers), dtype=">u4")
+    w = list(chunks.reshape(-1, 16).astype(np.uint32).T)
+    state = compress((A0, B0, C0, D0, E0, F0, G0, H0), w)
+    data = np.stack(state, axis=-1).astype("<u4").tobytes()
+    return [data[i : i + 32] for i in range(0, len(data), 32)]
+
+
+def second_chunk(header: bytes, nonces: "np.ndarray") -> list:
+    """Message words of the second 64 byte chunk of the header for each nonce"""
+    # [merkle root (last 4B) | timestamp | bits | nonce | padding | length of 640 bits]
+    w = list(struct.unpack(">3I", header[64:76]))
+    return w + [nonces.byteswap(), 0x80000000] + [0] * 10 + [640]
+
+
+def sha256d_nonces(
+    header: bytes, nonces: "np.ndarray", midstate: Optional[bytes] = None
+) -> "np.ndarray":
+    """
+    Computes the double SHA256 hash of the block header for each of the given nonces.
+
+    The first 64 byte chunk of the header does not depend on the nonce, so hashing starts from its midstate.
+
+    :param header: 80 byte block header in little endian (the nonce is ignored)
+    :param nonces: array of nonces
+    :param midstate: optional midstate of the header (see calculate_midstate)
+    :return: array of shape (len(nonces), 8) with the big endian words of each hash,
+             i.e. hashes[i].astype(">u4").tobytes() is the hash of nonce i in little endian
+    """
+    nonces = np.asarray(nonces, dtype=np.uint32)
+    state = struct.unpack("<8I", midstate or calculate_midstate(header))
+    digest = compress(state, second_chunk(header, nonces))
+
+    # second hash of the 32 byte digest: [digest | padding | length of 256 bits]
+    w = list(digest) + [0x80000000] + [0] * 6 + [256]
+    digest = compress((A0, B0, C0, D0, E0, F0, G0, H0), w)
+    return np.stack(digest, axis=-1)
+
+
+def sha256d_top_words(
+    header: bytes, nonces: "np.ndarray", midstate: Optional[bytes] = None
+) -> "np.ndarray":
+    """
+    Computes only the most significant 32 bits of the double SHA256 hash (in big endian) for each of the given
+    nonces, which is enough to reject almost all hashes above a target.
+
+    The last word of the hash is final after 61 rounds of the second hash, the remaining rounds are skipped.
+
+    :param header: 80 byte block header in little endian (the nonce is ignored)
+    :param nonces: array of nonces
+    :param midstate: optional midstate of the header (see calculate_midstate)
+    :return: array of the most significant 32 bits of each hash
+    """
+    nonces = np.asarray(nonces, dtype=np.uint32)
+    state = struct.unpack("<8I", midstate or calculate_midstate(header))
+    digest = compress(state, second_chunk(header, nonces))
+    w = list(digest) + [0x80000000] + [0] * 6 + [256]
+    e = compress((A0, B0, C0, D0, E0, F0, G0, H0), w, rounds=61)[4]
+    return (e + np.uint32(H0)).byteswap()
+
+
+def below_target(hashes: "np.ndarray", target: bytes) -> "np.ndarray":
+    """
+    Compares the hashes with the target, i.e. the 256-bit numbers in big endian byte order
+
+    :param hashes: array of hash words (see sha256d_nonces)
+    :param target: 32 byte target hash in big endian
+    :return: boolean array, True iff hash <= target
+    """
+    # the most significant word of the hash is the last word with swapped bytes
+    words = hashes[:, ::-1].byteswap()
+    below = np.zeros(len(hashes), dtype=bool)
+    equal = np.ones(len(hashes), dtype=bool)
+    for i, t in enumerate(struct.unpack(">8I", target)):
+        below |= equal & (words[:, i] < t)
+        equal &= words[:, i] == t
+    return below | equal
+
+
+def scanhash(header: bytes, nonce: int, count: int, target: bytes) -> list[int]:
+    """
+    Scans count nonces starting at nonce for hashes below the target (see mining_device.scanhash).
+
+    Candidates are preselected by the most significant 32 bits of their hash and then checked with the full hash.
+
+    :param header: 80 byte block header in little endian (the nonce is ignored)
+    :param nonce: first nonce to check
+    :param count: number of nonces to check
+    :param target: 32 byte target hash in big endian
+    :return: all nonces within the range, whose hash is below the target
+    """
+    midstate = calculate_midstate(header)
+    top_target = struct.unpack_from(">I", target)[0]
+    shares = []
+    end = min(nonce + count, 0x100000000)
+    # small batches keep the intermediate arrays in the CPU cache
+    for start in range(nonce, end, BATCH_SIZE):
+        nonces = np.arange(start, min(start + BATCH_SIZE, end), dtype=np.uint64)
+        nonces = nonces.astype(np.uint32)
+        top_words = sha256d_top_words(header, nonces, midstate)
+        candidates = nonces[top_words <= top_target]
+        if len(candidates):
+            hashes = sha256d_nonces(header, candidates, midstate)
+            shares += candidates[below_target(hashes, target)].tolist()
+    return shares
@@ -14,6 +14,7 @@
 #  You should have received a copy of the GNU General Public License along with
 #  this program.  If not, see <http://www.gnu.org/licenses/>.
 import struct
+from typing import Sequence
 
 # fmt: off
 K = [
@@ -41,16 +42,6 @@ G0 = 0x1F83D9AB
 H0 = 0x5BE0CD19
 
 
-def rotateright(i, p):
-    """i>>>p"""
-    p &= 0x1F  # p mod 32
-    return i >> p | ((i << (32 - p)) & 0xFFFFFFFF)
-
-
-def addu32(*i):
-    return sum(list(i)) & 0xFFFFFFFF
-
-
 def calculate_midstate(header: bytes) -> bytes:
     """
     Calculates the SHA256 midstate for the first 64-byte chunk of block header data,
@@ -62,34 +53,63 @@ def calculate_midstate(header: bytes) -> bytes:
     :param header: 80 byte block header in little endian
     :return: 32 byte midstate
     """
-    w = list(struct.unpack(f">{'I' * 16}", header[:64]))
+    # message schedule, all rotations and additions are inlined to avoid temporary objects
+    w = list(struct.unpack_from(">16I", header))
+    for i in range(16, 64):
+        x, y = w[i - 15], w[i - 2]
+        s0 = ((x >> 7 | x << 25) ^ (x >> 18 | x << 14) ^ (x >> 3)) & 0xFFFFFFFF
+        s1 = ((y >> 17 | y << 15) ^ (y >> 19 | y << 13) ^ (y >> 10)) & 0xFFFFFFFF
+        w.append((w[i - 16] + s0 + w[i - 7] + s1) & 0xFFFFFFFF)
 
     a, b, c, d, e, f, g, h = A0, B0, C0, D0, E0, F0, G0, H0
 
-    for k in K:
-        s0 = rotateright(a, 2) ^ rotateright(a, 13) ^ rotateright(a, 22)
-        s1 = rotateright(e, 6) ^ rotateright(e, 11) ^ rotateright(e, 25)
+    for k, wi in zip(K, w):
+        s1 = (
+            (e >> 6 | e << 26) ^ (e >> 11 | e << 21) ^ (e >> 25 | e << 7)
+        ) & 0xFFFFFFFF
+        ch = (e & f) ^ (~e & g)
+        t1 = h + s1 + ch + k + wi
+        s0 = (
+            (a >> 2 | a << 30) ^ (a >> 13 | a << 19) ^ (a >> 22 | a << 10)
+        ) & 0xFFFFFFFF
         ma = (a & b) ^ (a & c) ^ (b & c)
-        ch = (e & f) ^ ((~e) & g)
-
-        h = addu32(h, w[0], k, ch, s1)
-        d = addu32(d, h)
-        h = addu32(h, ma, s0)
-
-        a, b, c, d, e, f, g, h = h, a, b, c, d, e, f, g
-
-        s0 = rotateright(w[1], 7) ^ rotateright(w[1], 18) ^ (w[1] >> 3)
-        s1 = rotateright(w[14], 17) ^ rotateright(w[14], 19) ^ (w[14] >> 10)
-        w.append(addu32(w[0], s0, w[9], s1))
-        w.pop(0)
+        a, b, c, d, e, f, g, h = (
+            (t1 + s0 + ma) & 0xFFFFFFFF,
+            a,
+            b,
+            c,
+            (d + t1) & 0xFFFFFFFF,
+            e,
+            f,
+            g,
+        )
+
+    return struct.pack(
+        "<8I",
+        (a + A0) & 0xFFFFFFFF,
+        (b + B0) & 0xFFFFFFFF,
+        (c + C0) & 0xFFFFFFFF,
+        (d + D0) & 0xFFFFFFFF,
+        (e + E0) & 0xFFFFFFFF,
+        (f + F0) & 0xFFFFFFFF,
+        (g + G0) & 0xFFFFFFFF,
+        (h + H0) & 0xFFFFFFFF,
+    )
+
+
+def calculate_midstates(
+    headers: Sequence[bytes], vectorized: bool = False
+) -> list[bytes]:
+    """
+    Calculates the SHA256 midstates for many block headers at once (see calculate_midstate)
 
-    a = addu32(a, A0)
-    b = addu32(b, B0)
-    c = addu32(c, C0)
-    d = addu32(d, D0)
-    e = addu32(e, E0)
-    f = addu32(f, F0)
-    g = addu32(g, G0)
-    h = addu32(h, H0)
+    :param headers: block headers in little endian (at least 64 bytes each)
+    :param vectorized: use the vectorized backend (requires the package 'numpy', see sha256d_batch.midstates)
+    :raises ImportError if the vectorized backend is not available
+    :return: 32 byte midstate for each header
+    """
+    if vectorized:
+        import sha256d_batch
 
-    return struct.pack("<IIIIIIII", a, b, c, d, e, f, g, h)
+        return sha256d_batch.midstates(headers)
+    return [calculate_midstate(header) for header in headers]
@@ -0,0 +1,86 @@
+#  Copyright (C) 2022 Jan Sturm
+#
+#  This program is free software: you can redistribute it and/or modify it under
+#  the terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  This program is distributed in the hope that it will be useful, but WITHOUT
+#  ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or FITNESS
+#  FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Common definitions of the Stratum V1 mining protocol (line-based JSON-RPC over TCP)"""
+
+import json
+from typing import Any, Optional
+
+# target of difficulty 1 (bits 0x1d00ffff)
+DIFF1_TARGET = 0xFFFF << 208
+# size in bytes of the extranonce assigned to each connection by the server
+EXTRANONCE1_SIZE = 4
+
+# error codes of mining.submit and mining.authorize
+ERROR_OTHER = 20
+ERROR_JOB_NOT_FOUND = 21
+ERROR_DUPLICATE_SHARE = 22
+ERROR_LOW_DIFFICULTY = 23
+ERROR_UNAUTHORIZED = 24
+ERROR_NOT_SUBSCRIBED = 25
+
+
+class StratumError(Exception):
+    """
+    Error of a Stratum request
+
+    :param code: error code (see ERROR_*)
+    :param message: human-readable error message
+    """
+
+    def __init__(self, code: int, message: str):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+    def __str__(self):
+        return f"{self.code}: {self.message}"
+
+    def to_json(self) -> list:
+        """Returns the error object [code, message, traceback] of a response"""
+        return [self.code, self.message, None]
+
+
+def difficulty_to_target(difficulty: float) -> int:
+    """Returns the share target (as integer) for the given (pool) difficulty"""
+    return min(int(DIFF1_TARGET / difficulty), 2**256 - 1)
+
+
+def target_to_difficulty(target: int) -> float:
+    """Returns the (pool) difficulty for the given share target"""
+    return DIFF1_TARGET / max(target, 1)
+
+
+def encode(
+    msg_id: Optional[int] = None,
+    method: Optional[str] = None,
+    params: Optional[list] = None,
+    result: Any = None,
+    error: Optional[StratumError] = None,
+) -> bytes:
+    """
+    Encodes a single message as JSON line, i.e. a request or notification (with 'method') or a response
+
+    :param msg_id: id of the request (None for notifications)
+    :param method: method of a request or notification
+    :param params: parameters of a request or notification
+    :param result: result of a response
+    :param error: error of a response
+    :return: JSON line terminated by a newline
+    """
+    if method is not None:
+        message = dict(id=msg_id, method=method, params=params or [])
+    else:
+        message = dict(id=msg_id, result=result, error=error and error.to_json())
+    return json.dumps(message).encode() + b"\n"
@@ -0,0 +1,311 @@
+#  Copyright (C) 2022 Jan Sturm
+#
+#  This program is free software: you can redistribute it and/or modify it under
+#  the terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  This program is distributed in the hope that it will be useful, but WITHOUT
+#  ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or FITNESS
+#  FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Stratum V1 client, that receives work from a pool or upstream server instead of getblocktemplate"""
+
+import asyncio
+import itertools
+import json
+from typing import Any, NamedTuple, Optional
+from urllib.parse import urlsplit
+
+from custom_logger import logger
+from rpc_client import Backoff
+from stratum import StratumError, difficulty_to_target, encode
+
+# timeout in seconds of a single request (e.g. mining.submit)
+REQUEST_TIMEOUT = 30
+
+
+class StratumJob(NamedTuple):
+    """
+    A job of mining.notify, with the extranonce and share target of the connection at the time of reception.
+    Hashes and previous block hash are in the byte order of the block header.
+    """
+
+    job_id: str
+    prevhash: bytes
+    coinb1: bytes
+    coinb2: bytes
+    merkle_branch: list[bytes]
+    version: int
+    bits: bytes
+    ntime: int
+    clean: bool
+    extranonce1: bytes
+    extranonce2_size: int
+    target: int
+
+    @classmethod
+    def from_notify(
+        cls, params: list, extranonce1: bytes, extranonce2_size: int, target: int
+    ) -> "StratumJob":
+        """
+        Decodes the parameters of mining.notify
+        [job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, clean_jobs]
+
+        :raises ValueError if the parameters are malformed
+        """
+        try:
+            (
+                job_id,
+                prevhash,
+                coinb1,
+                coinb2,
+                branch,
+                version,
+                bits,
+                ntime,
+                clean,
+            ) = params[:9]
+            prevhash = bytes.fromhex(prevhash)
+            return cls(
+                job_id=job_id,
+                # each 4 byte word of the previous block hash is swapped
+                prevhash=b"".join(prevhash[i : i + 4][::-1] for i in range(0, 32, 4)),
+                coinb1=bytes.fromhex(coinb1),
+                coinb2=bytes.fromhex(coinb2),
+                merkle_branch=[bytes.fromhex(sibling) for sibling in branch],
+                version=int(version, 16),
+                bits=bytes.fromhex(bits)[::-1],
+                ntime=int(ntime, 16),
+                clean=bool(clean),
+                extranonce1=extranonce1,
+                extranonce2_size=extranonce2_size,
+                target=target,
+            )
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Invalid job {params!r} ({e})")
+
+
+class StratumCoinbase:
+    """
+    Coinbase transactions of a Stratum job, i.e. [coinb1 | extranonce1 | extranonce2 | coinb2]
+    (same interface as coinbase.CoinbaseBuilder)
+
+    :param job: Stratum job
+    """
+
+    def __init__(self, job: StratumJob):
+        self.extranonce_size = job.extranonce2_size
+        self.prefix = job.coinb1 + job.extranonce1
+        self.suffix = job.coinb2
+
+    def build(self, extranonce: bytes = b"") -> bytes:
+        """
+        Assembles the raw coinbase transaction for the given extranonce2
+
+        :param extranonce: extranonce2 of size 'extranonce_size'
+        :return: serialized coinbase transaction
+        """
+        assert len(extranonce) == self.extranonce_size
+        return self.prefix + extranonce + self.suffix
+
+
+class StratumClient:
+    """
+    Asyncio Stratum V1 client, that keeps a connection to the upstream server (reconnecting with backoff).
+
+    After mining.subscribe and mining.authorize, the latest job of mining.notify is available via next_job. The share
+    difficulty of mining.set_difficulty applies to all jobs received afterwards. Jobs of a previous connection with
+    another extranonce1 are stale (see is_stale).
+
+    :param config: stratum config (see [stratum] in config.toml) with 'url' 'stratum+tcp://<host>:<port>', 'user' and
+                   'password'
+    """
+
+    def __init__(self, config: dict):
+        url = urlsplit(config["url"])
+        self.host = url.hostname
+        self.port = url.port or 3333
+        self.user = config.get("user", "")
+        self.password = config.get("password", "x")
+        self.extranonce1 = b""
+        self.extranonce2_size = 0
+        self.difficulty = 1.0
+        self.accepted_shares = 0
+        self.rejected_shares = 0
+        self.__job: Optional[StratumJob] = None
+        # created within the running event loop (see new_job)
+        self.__new_job: Optional[asyncio.Event] = None
+        self.__writer: Optional[asyncio.StreamWriter] = None
+        # method and response of each pending request by id
+        self.__pending: dict[int, tuple[str, asyncio.Future]] = {}
+        self.__ids = itertools.count(1)
+
+    def __str__(self):
+        return f"<StratumClient [stratum+tcp://{self.user}@{self.host}:{self.port}]>"
+
+    @property
+    def new_job(self) -> asyncio.Event:
+        """Event that is set when a job was received, but not yet returned by next_job"""
+        if self.__new_job is None:
+            self.__new_job = asyncio.Event()
+        return self.__new_job
+
+    async def next_job(self) -> StratumJob:
+        """Waits for a new job of the server (returns immediately, if the latest job was not yet returned)"""
+        await self.new_job.wait()
+        self.new_job.clear()
+        return self.__job
+
+    def is_stale(self, job: StratumJob) -> bool:
+        """
+        Checks if a job belongs to a previous connection with another extranonce1, i.e. its shares can only be rejected.
+        While the client is not subscribed, all jobs are stale.
+
+        :param job: a job of this client
+        :return: True if stale, else False
+        """
+        return job.extranonce1 != self.extranonce1
+
+    async def request(self, method: str, *params) -> Any:
+        """
+        Sends a request to the server and waits for its response
+
+        :raises StratumError if the server returned an error
+        :raises ConnectionError if the server is not connected or does not respond in time
+        :return: result of the request
+        """
+        if self.__writer is None:
+            raise ConnectionError(f"{self} is not connected")
+        msg_id = next(self.__ids)
+        loop = asyncio.get_running_loop()
+        response = loop.create_future()
+        self.__pending[msg_id] = (method, response)
+        # a timer instead of asyncio.wait_for, which may swallow a cancellation if the response arrives at the same time
+        timeout = loop.call_later(
+            REQUEST_TIMEOUT,
+            lambda: response.done()
+            or response.set_exception(
+                ConnectionError(f"{self} did not respond to {method}")
+            ),
+        )
+        try:
+            self.__writer.write(encode(msg_id, method, list(params)))
+            result, error = await response
+        finally:
+            timeout.cancel()
+            self.__pending.pop(msg_id, None)
+        if isinstance(error, list) and len(error) >= 2:
+            raise StratumError(error[0], str(error[1]))
+        if error:
+            raise StratumError(None, str(error))
+        return result
+
+    async def submit(
+        self, job_id: str, extranonce2: bytes, ntime: int, nonce: str
+    ) -> bool:
+        """
+        Submits a share to the server (mining.submit)
+
+        :param job_id: id of the job
+        :param extranonce2: extranonce2 of the share
+        :param ntime: header timestamp of the share
+        :param nonce: nonce in hex format (big endian)
+        :return: True if the share was accepted, else False
+        """
+        try:
+            accepted = bool(
+                await self.request(
+                    "mining.submit",
+                    self.user,
+                    job_id,
+                    extranonce2.hex(),
+                    f"{ntime:08x}",
+                    nonce,
+                )
+            )
+        except (StratumError, ConnectionError) as e:
+            logger.error(f"Share of job {job_id} rejected by {self} ({e})")
+            accepted = False
+        if accepted:
+            self.accepted_shares += 1
+            logger.info(f"Share of job {job_id} accepted by {self}")
+        else:
+            self.rejected_shares += 1
+        return accepted
+
+    def handle(self, message: dict) -> None:
+        """Handles a single message (response or notification) of the server"""
+        method = message.get("method")
+        if method is None:
+            request, response = self.__pending.get(message.get("id"), (None, None))
+            result = message.get("result")
+            if request == "mining.subscribe" and result:
+                # jobs may follow right after the response
+                self.extranonce1 = bytes.fromhex(result[1])
+                self.extranonce2_size = int(result[2])
+            if response and not response.done():
+                response.set_result((result, message.get("error")))
+        elif method == "mining.set_difficulty":
+            self.difficulty = float(message["params"][0])
+            logger.info(f"Share difficulty of {self} set to {self.difficulty:g}")
+        elif method == "mining.notify":
+            self.__job = StratumJob.from_notify(
+                message["params"],
+                self.extranonce1,
+                self.extranonce2_size,
+                difficulty_to_target(self.difficulty),
+            )
+            self.new_job.set()
+            logger.debug(f"New job {self.__job.job_id} from {self}")
+        else:
+            logger.debug(f"\tIgnoring {method} from {self}")
+
+    async def __receive(self, reader: asyncio.StreamReader) -> None:
+        while line := await reader.readline():
+            try:
+                self.handle(json.loads(line))
+            except (ValueError, KeyError, IndexError, TypeError) as e:
+                logger.debug(f"\tInvalid message from {self}: {line!r} ({e})")
+
+    async def run(self) -> None:
+        """Keeps the connection to the server until cancelled"""
+        backoff = Backoff()
+        while True:
+            receiver = None
+            try:
+                reader, self.__writer = await asyncio.open_connection(
+                    self.host, self.port
+                )
+                # jobs of a previous connection belong to another extranonce1
+                self.new_job.clear()
+                receiver = asyncio.create_task(self.__receive(reader))
+                await self.request("mining.subscribe", "mcu-miner")
+                if not await self.request("mining.authorize", self.user, self.password):
+                    raise StratumError(None, f"Worker '{self.user}' not authorized")
+                logger.info(
+                    f"Connected to {self} (extranonce1={self.extranonce1.hex()})"
+                )
+                backoff.reset()
+                await receiver
+                logger.error(f"Connection to {self} closed")
+            except (ConnectionError, OSError, StratumError, ValueError) as e:
+                logger.error(f"Cannot connect to {self} ({e})")
+            finally:
+                if receiver:
+                    receiver.cancel()
+                if self.__writer:
+                    self.__writer.close()
+                    self.__writer = None
+                # all jobs are stale until the next mining.subscribe
+                self.extranonce1 = b""
+                for _, response in self.__pending.values():
+                    if not response.done():
+                        response.set_exception(
+                            ConnectionError(f"Connection to {self} lost")
+                        )
+            logger.info(f"\tTrying again in {backoff.delay:g} seconds ...")
+            await backoff.wait()
@@ -0,0 +1,368 @@
+#  Copyright (C) 2022 Jan Sturm
+#
+#  This program is free software: you can redistribute it and/or modify it under
+#  the terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  This program is distributed in the hope that it will be useful, but WITHOUT
+#  ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or FITNESS
+#  FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Optional Stratum V1 server, that distributes the block templates of the miner to remote workers"""
+
+import asyncio
+import itertools
+import json
+import struct
+import time
+from typing import TYPE_CHECKING, Any, Callable, Optional
+
+from custom_logger import logger
+from metrics import Metrics
+from stratum import (
+    ERROR_DUPLICATE_SHARE,
+    ERROR_JOB_NOT_FOUND,
+    ERROR_LOW_DIFFICULTY,
+    ERROR_NOT_SUBSCRIBED,
+    ERROR_OTHER,
+    ERROR_UNAUTHORIZED,
+    EXTRANONCE1_SIZE,
+    StratumError,
+    difficulty_to_target,
+    encode,
+)
+
+if TYPE_CHECKING:
+    from miner import BlockTemplate, Job
+
+# number of recent jobs, that still accept shares (all jobs are dropped on a new previous block)
+MAX_JOBS = 8
+# extranonce1 of the first connection, local devices use extranonces below (see Miner.create_jobs)
+EXTRANONCE1_START = 0x80000000
+
+
+def swap32(buf: bytes) -> bytes:
+    """Swaps the byte order of each 4 byte word, e.g. of the previous block hash in mining.notify"""
+    return b"".join(buf[i : i + 4][::-1] for i in range(0, len(buf), 4))
+
+
+def notify_params(job_id: str, block_template: "BlockTemplate", clean: bool) -> list:
+    """
+    Returns the parameters of mining.notify for the given block template:
+    [job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, clean_jobs].
+
+    The coinbase transaction of a worker is coinb1 + extranonce1 + extranonce2 + coinb2, the Merkle root follows
+    from its txid and the Merkle branch (see BlockTemplate.merkle_root_from_branch).
+
+    :param job_id: id of the job
+    :param block_template: block template with an extranonce of size EXTRANONCE1_SIZE + extranonce2_size
+    :param clean: True iff workers must drop all previous jobs
+    :return: parameters of mining.notify
+    """
+    builder = block_template.coinbase_builder
+    return [
+        job_id,
+        swap32(block_template.prevhash).hex(),
+        builder.prefix.hex(),
+        builder.suffix.hex(),
+        [sibling.hex() for sibling in block_template.merkle_branch],
+        f"{block_template.version:08x}",
+        block_template.template["bits"],
+        f"{block_template.curtime:08x}",
+        clean,
+    ]
+
+
+class StratumConnection:
+    """
+    Connection of a single remote worker
+
+    :param peer: address of the worker
+    :param writer: stream to the worker
+    :param extranonce1: extranonce assigned to this connection
+    :param difficulty: share difficulty of this connection
+    """
+
+    def __init__(
+        self,
+        peer: str,
+        writer: asyncio.StreamWriter,
+        extranonce1: bytes,
+        difficulty: float,
+    ):
+        self.peer = peer
+        self.writer = writer
+        self.extranonce1 = extranonce1
+        self.difficulty = difficulty
+        self.target = difficulty_to_target(difficulty)
+        self.subscribed = False
+        self.workers: set[str] = set()
+
+    def __str__(self):
+        return (
+            f"<StratumConnection [{self.peer}, extranonce1={self.extranonce1.hex()}]>"
+        )
+
+    def send(self, method: str, params: list) -> None:
+        """Sends a notification to the worker (without waiting for the transmission)"""
+        self.writer.write(encode(method=method, params=params))
+
+
+class StratumServer:
+    """
+    Asyncio Stratum V1 server, so that the miners of many hosts share the block templates of a single miner.
+
+    Each new block template is sent as job to all subscribed workers (mining.notify), which roll their own extranonce2
+    (and timestamp, if the block template allows it). Shares of the current and recent jobs are validated centrally
+    against the share difficulty of the connection (mining.set_difficulty). Shares that are a valid proof of work for
+    the block are passed on to be submitted like the blocks of local devices. Accepted, stale (unknown job) and low
+    difficulty shares are counted in the metrics of each worker.
+
+    :param config: stratum config (see [stratum] in config.toml)
+    :param on_block: called with job and nonce (hex) of each share that solves the block
+    :param metrics: optional metrics of the miner
+    """
+
+    def __init__(
+        self,
+        config: dict,
+        on_block: Callable[["Job", str], None],
+        metrics: Optional[Metrics] = None,
+    ):
+        self.host = config.get("host", "127.0.0.1")
+        self.port = config.get("port", 3333)
+        self.difficulty = config.get("difficulty", 1.0)
+        self.extranonce2_size = config.get("extranonce2_size", 4)
+        self.on_block = on_block
+        self.metrics = metrics
+        self.__started: Optional[asyncio.Event] = None
+        self.block_template: Optional["BlockTemplate"] = None
+        # recent jobs by id with the shares received for each job
+        self.jobs: dict[str, tuple["BlockTemplate", set]] = {}
+        self.connections: set[StratumConnection] = set()
+        self.__job_ids = itertools.count(1)
+        self.__extranonces = itertools.count(EXTRANONCE1_START)
+
+    @property
+    def started(self) -> asyncio.Event:
+        """Event that is set once the server accepts connections (created within the running event loop)"""
+        if self.__started is None:
+            self.__started = asyncio.Event()
+        return self.__started
+
+    def __str__(self):
+        return f"<StratumServer [stratum+tcp://{self.host}:{self.port}]>"
+
+    @property
+    def extranonce_size(self) -> int:
+        """Size of the extranonce of block templates for this server (extranonce1 + extranonce2)"""
+        return EXTRANONCE1_SIZE + self.extranonce2_size
+
+    def notify(self, block_template: "BlockTemplate") -> None:
+        """
+        Sends a new block template as job to all subscribed workers.
+
+        The same block template (e.g. with rolled timestamp for local devices) is not sent again. Workers drop all
+        previous jobs only if the previous block changed, otherwise shares of recent jobs are still accepted.
+
+        :param block_template: block template with an extranonce of size 'extranonce_size'
+        """
+        if block_template is self.block_template:
+            return
+        clean = (
+            self.block_template is None
+            or self.block_template.prevhash != block_template.prevhash
+        )
+        if clean:
+            self.jobs.clear()
+        job_id = f"{next(self.__job_ids):x}"
+        self.jobs[job_id] = (block_template, set())
+        while len(self.jobs) > MAX_JOBS:
+            del self.jobs[next(iter(self.jobs))]
+        self.block_template = block_template
+
+        params = notify_params(job_id, block_template, clean)
+        now = time.monotonic()
+        for connection in self.connections:
+            if connection.subscribed:
+                connection.send("mining.notify", params)
+                self.__worker_metrics(connection, lambda m: m.work(now))
+
+    def current_job(self) -> Optional[list]:
+        """Returns the parameters of mining.notify for the latest job (with clean_jobs), or None if there is none"""
+        if not self.jobs:
+            return None
+        job_id = next(reversed(self.jobs))
+        return notify_params(job_id, self.jobs[job_id][0], True)
+
+    def subscribe(self, connection: StratumConnection, params: list) -> list:
+        """Handles mining.subscribe, the worker gets the difficulty and current job right after the response"""
+        connection.subscribed = True
+        subscription = connection.extranonce1.hex()
+        logger.info(f"{connection} subscribed ({params[0] if params else 'unknown'})")
+        return [
+            [["mining.set_difficulty", subscription], ["mining.notify", subscription]],
+            connection.extranonce1.hex(),
+            self.extranonce2_size,
+        ]
+
+    def authorize(self, connection: StratumConnection, params: list) -> bool:
+        """Handles mining.authorize, any worker name is accepted"""
+        if not params or not isinstance(params[0], str):
+            raise StratumError(ERROR_OTHER, "Missing worker name")
+        connection.workers.add(params[0])
+        logger.info(f"{connection} authorized worker '{params[0]}'")
+        self.__worker_metrics(connection, lambda m: setattr(m, "online", True))
+        return True
+
+    def submit(self, connection: StratumConnection, params: list) -> bool:
+        """
+        Handles mining.submit with parameters [worker, job_id, extranonce2, ntime, nonce]
+
+        :raises StratumError if the share is rejected
+        :return: True if the share is accepted
+        """
+        if not connection.subscribed:
+            raise StratumError(ERROR_NOT_SUBSCRIBED, "Not subscribed")
+        if len(params) < 5:
+            raise StratumError(ERROR_OTHER, "Invalid parameters")
+        worker, job_id, extranonce2, ntime, nonce = params[:5]
+        if worker not in connection.workers:
+            raise StratumError(ERROR_UNAUTHORIZED, "Unauthorized worker")
+        if job_id not in self.jobs:
+            now = time.monotonic()
+            self.__worker_metrics(
+                connection, lambda m: m.share("stale", connection.target, now)
+            )
+            raise StratumError(ERROR_JOB_NOT_FOUND, "Job not found")
+        block_template, shares = self.jobs[job_id]
+        try:
+            extranonce2 = bytes.fromhex(extranonce2)
+            ntime = struct.unpack(">L", bytes.fromhex(ntime))[0]
+            nonce = bytes.fromhex(nonce)
+        except (TypeError, ValueError, struct.error):
+            raise StratumError(ERROR_OTHER, "Malformed share")
+        if len(extranonce2) != self.extranonce2_size or len(nonce) != 4:
+            raise StratumError(ERROR_OTHER, "Malformed share")
+        if ntime != block_template.curtime and not block_template.ntime_mutable:
+            raise StratumError(ERROR_OTHER, "ntime not mutable")
+        if not block_template.mintime <= ntime <= block_template.maxtime:
+            raise StratumError(ERROR_OTHER, "ntime out of range")
+        share = (connection.extranonce1 + extranonce2, ntime, nonce)
+        if share in shares:
+            raise StratumError(ERROR_DUPLICATE_SHARE, "Duplicate share")
+        shares.add(share)
+
+        job = block_template.job(connection.extranonce1 + extranonce2, ntime=ntime)
+        block_hash = int.from_bytes(job.block_header_hash(nonce.hex()), byteorder="big")
+        now = time.monotonic()
+        if block_hash <= block_template.target_int:
+            logger.info(
+                f"\x1b[33;1m>>> Worker '{worker}' of {connection} found a valid hash for {job.block_info()}\x1b[0m"
+            )
+            self.on_block(job, nonce.hex())
+        elif block_hash > connection.target:
+            self.__worker_metrics(
+                connection, lambda m: m.share("invalid", connection.target, now)
+            )
+            raise StratumError(ERROR_LOW_DIFFICULTY, "Low difficulty share")
+        self.__worker_metrics(
+            connection, lambda m: m.share("accepted", connection.target, now)
+        )
+        return True
+
+    def dispatch(self, connection: StratumConnection, method: str, params: list) -> Any:
+        """
+        Handles a single request of a worker
+
+        :raises StratumError if the request failed
+        :return: result of the request
+        """
+        if method == "mining.subscribe":
+            return self.subscribe(connection, params)
+        if method == "mining.authorize":
+            return self.authorize(connection, params)
+        if method == "mining.submit":
+            return self.submit(connection, params)
+        if method == "mining.extranonce.subscribe":
+            return False
+        raise StratumError(ERROR_OTHER, f"Unknown method '{method}'")
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """Handles the connection of a single worker until it is closed"""
+        peer = writer.get_extra_info("peername")
+        extranonce1 = next(self.__extranonces).to_bytes(
+            EXTRANONCE1_SIZE, byteorder="little"
+        )
+        connection = StratumConnection(
+            f"{peer[0]}:{peer[1]}" if peer else "unknown",
+            writer,
+            extranonce1,
+            self.difficulty,
+        )
+        self.connections.add(connection)
+        logger.info(f"{connection} connected")
+        try:
+            while line := await reader.readline():
+                try:
+                    request = json.loads(line)
+                    msg_id, method = request.get("id"), request["method"]
+                    params = request.get("params") or []
+                except (ValueError, KeyError, AttributeError):
+                    logger.debug(f"\tInvalid request from {connection}: {line!r}")
+                    continue
+                try:
+                    writer.write(
+                        encode(msg_id, result=self.dispatch(connection, method, params))
+                    )
+                except StratumError as e:
+                    logger.debug(f"\t{connection} {method} failed ({e})")
+                    writer.write(encode(msg_id, error=e))
+                if method == "mining.subscribe":
+                    connection.send("mining.set_difficulty", [connection.difficulty])
+                    if job := self.current_job():
+                        connection.send("mining.notify", job)
+                await writer.drain()
+        except (
+            ConnectionError,
+            asyncio.IncompleteReadError,
+            ValueError,
+        ):
+            # ValueError: line exceeds the buffer limit
+            pass
+        finally:
+            self.connections.discard(connection)
+            self.__worker_metrics(connection, lambda m: setattr(m, "online", False))
+            logger.info(f"{connection} disconnected")
+            writer.close()
+
+    def __worker_metrics(
+        self, connection: StratumConnection, update: Callable[[Any], None]
+    ) -> None:
+        if self.metrics:
+            for worker in connection.workers:
+                update(self.metrics.device(f"stratum:{worker}"))
+
+    async def run(self) -> None:
+        """Serves the workers until cancelled"""
+        try:
+            server = await asyncio.start_server(self.handle, self.host, self.port)
+        except OSError as e:
+            logger.error(f"Cannot start Stratum server ({e})")
+            return
+        # the actual port, if port 0 was configured
+        self.port = server.sockets[0].getsockname()[1]
+        logger.info(f"Serving work on {self}")
+        self.started.set()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for connection in self.connections:
+                connection.writer.close()
@@ -0,0 +1,295 @@
+#  Copyright (C) 2022 Jan Sturm
+#
+#  This program is free software: you can redistribute it and/or modify it under
+#  the terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  This program is distributed in the hope that it will be useful, but WITHOUT
+#  ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or FITNESS
+#  FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Micro-benchmarks for the hot paths of the mining software (run with 'python -m tests.benchmark')"""
+
+import json
+import struct
+import timeit
+import tracemalloc
+from pathlib import Path
+
+import toml
+from bitcoinlib.encoding import int_to_varbyteint
+
+from coinbase import CoinbaseBuilder
+from custom_logger import logger
+import sha256d_batch
+from miner import BlockTemplate, Job, Miner, sha256d
+from mining_device import scanhash
+from sha256d_ms import calculate_midstates
+from tests.test_miner import (
+    bitcoinlib_coinbase,
+    bits_to_target,
+    template_dict_from_block,
+    template_from_block,
+)
+
+
+def load_block(height: int) -> tuple[dict, dict]:
+    """
+    Loads a test block and its coinbase config (see test_config.toml)
+
+    :param height: height of the test block
+    :return: block and coinbase config
+    """
+    test_config = toml.load(Path(__file__).with_name("test_config.toml"))
+    for block_conf in test_config["blocks"]:
+        with open(Path(__file__).with_name(block_conf["file"])) as f:
+            block = json.load(f)
+        if block["height"] == height:
+            return block, block_conf["coinbase"]
+    raise KeyError(f"No test block with height {height}")
+
+
+def report(name: str, seconds: float, number: int, unit: str = "op") -> None:
+    """Prints the throughput of a benchmark"""
+    print(
+        f"  {name:<48} {number / seconds:>14,.1f} {unit}/s  ({1e6 * seconds / number:,.2f} us/{unit})"
+    )
+
+
+def bench_merkle_root() -> None:
+    """Merkle root for a new coinbase transaction: cached Merkle branch vs. full recomputation"""
+    block, cb_config = load_block(555444)
+    block_template: BlockTemplate = template_from_block(
+        block, dict(cb_config, extranonce_size=4)
+    )
+    txid = sha256d(block_template.coinbase_tx(bytes([1, 0, 0, 0])))
+    assert block_template.merkle_root_from_branch(
+        txid
+    ) == block_template.compute_merkle_root(txid)
+
+    print(
+        f"Merkle root (block #{block['height']}, {len(block['tx'])} transactions, "
+        f"branch length {len(block_template.merkle_branch)})"
+    )
+    number = 20
+    seconds = timeit.timeit(
+        lambda: block_template.compute_merkle_root(txid), number=number
+    )
+    report("full recomputation", seconds, number, "root")
+    number = 20000
+    seconds = timeit.timeit(
+        lambda: block_template.merkle_root_from_branch(txid), number=number
+    )
+    report("cached Merkle branch", seconds, number, "root")
+
+
+def bench_coinbase() -> None:
+    """Coinbase transaction with a new extranonce: bitcoinlib Transaction objects vs. CoinbaseBuilder"""
+    block, cb_config = load_block(555444)
+    cb_config = dict(cb_config, extranonce_size=4)
+    args = dict(
+        height=block["height"],
+        value=cb_config["value"],
+        cb_config=cb_config,
+        witness_commitment=cb_config["witness_commitment"],
+    )
+    extranonce = bytes([1, 0, 0, 0])
+    builder = CoinbaseBuilder(**args)
+    assert builder.build(extranonce) == bitcoinlib_coinbase(
+        **args, extranonce=extranonce
+    )
+
+    print(f"Coinbase transaction (block #{block['height']})")
+    number = 500
+    seconds = timeit.timeit(
+        lambda: bitcoinlib_coinbase(**args, extranonce=extranonce), number=number
+    )
+    report("bitcoinlib Transaction", seconds, number, "tx")
+    number = 200
+    seconds = timeit.timeit(lambda: CoinbaseBuilder(**args), number=number)
+    report("CoinbaseBuilder (once per template)", seconds, number, "tx")
+    number = 200000
+    seconds = timeit.timeit(lambda: builder.build(extranonce), number=number)
+    report("CoinbaseBuilder.build (per extranonce)", seconds, number, "tx")
+
+
+def allocated(factory) -> int:
+    """Returns the number of bytes that remain allocated for the object returned by factory"""
+    tracemalloc.start()
+    obj = factory()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del obj
+    return size
+
+
+def hex_template(block: dict, cb_config: dict, tx_size: int = 250) -> dict:
+    """getblocktemplate result for the given block with synthetic transaction data of tx_size bytes"""
+    return dict(
+        version=block["version"],
+        previousblockhash=block["previousblockhash"],
+        transactions=[
+            dict(data="00" * tx_size, txid=tx, hash=tx) for tx in block["tx"][1:]
+        ],
+        height=block["height"],
+        bits=block["bits"],
+        curtime=block["time"],
+        target=bits_to_target(bytes.fromhex(block["bits"])),
+        coinbasevalue=cb_config["value"],
+        default_witness_commitment=cb_config["witness_commitment"],
+    )
+
+
+def hex_block_header(template: dict, merkle_root: bytes, nonce: str) -> bytes:
+    """Block header assembled from the hex-encoded template fields on every call (as before binary templates)"""
+    return (
+        struct.pack("<L", template["version"])
+        + bytes.fromhex(template["previousblockhash"])[::-1]
+        + merkle_root[::-1]
+        + struct.pack("<L", template["curtime"])
+        + bytes.fromhex(template["bits"])[::-1]
+        + struct.pack("<L", int(nonce, 16))
+    )
+
+
+def hex_create_block(template: dict, job: Job, nonce: str) -> str:
+    """Block assembled from the hex-encoded transactions (as before binary templates)"""
+    return (
+        hex_block_header(template, job.merkle_root, nonce).hex()
+        + int_to_varbyteint(len(template["transactions"]) + 1).hex()
+        + job.coinbase.hex()
+        + "".join(tx["data"] for tx in template["transactions"])
+    )
+
+
+def bench_block_template() -> None:
+    """Memory and per-share cost of hex-encoded template dicts vs. binary BlockTemplate/Job objects"""
+    block, cb_config = load_block(555444)
+    cb_config = dict(cb_config, extranonce_size=4)
+    template = hex_template(block, cb_config)
+    block_template = BlockTemplate(template, cb_config)
+    job = next(block_template.jobs())
+    nonce = "8a8e4a6e"
+    assert hex_block_header(template, job.merkle_root, nonce) == job.block_header(nonce)
+
+    print(f"Block template (block #{block['height']}, {len(block['tx'])} transactions)")
+    hex_size = allocated(lambda: hex_template(block, cb_config))
+    binary_size = allocated(
+        lambda: BlockTemplate(hex_template(block, cb_config), cb_config)
+    )
+    print(
+        f"  {'hex-encoded getblocktemplate result':<48} {hex_size / 1024:>14,.1f} KiB"
+    )
+    print(f"  {'BlockTemplate':<48} {binary_size / 1024:>14,.1f} KiB")
+    number = 2000
+    job_size = allocated(lambda: [Job(block_template, bytes(4)) for _ in range(number)])
+    print(f"  {'Job':<48} {job_size / number:>14,.1f} B")
+
+    number = 100000
+    seconds = timeit.timeit(
+        lambda: hex_block_header(template, job.merkle_root, nonce), number=number
+    )
+    report("block header from hex template", seconds, number, "header")
+    seconds = timeit.timeit(lambda: job.block_header(nonce), number=number)
+    report("Job.block_header", seconds, number, "header")
+    number = 100
+    seconds = timeit.timeit(
+        lambda: hex_create_block(template, job, nonce), number=number
+    )
+    report("block from hex template", seconds, number, "block")
+    seconds = timeit.timeit(lambda: job.create_block(nonce), number=number)
+    report("Job.create_block", seconds, number, "block")
+
+
+def hex_check_nonce(job: Job, nonce: str) -> bool:
+    """Share validation on a freshly assembled header with hex nonce and hex target (as before the fast path)"""
+    block_hash = job.block_header_hash(nonce)
+    target_hash = bytes.fromhex(job.block_template.template["target"])
+    logger.debug(f"\t{job.block_info()} block_hash  = {block_hash.hex()}")
+    logger.debug(f"\t{job.block_info()} target_hash = {target_hash.hex()}")
+    return block_hash <= target_hash
+
+
+def bench_check_nonce() -> None:
+    """Share validation: header assembly with hex nonce vs. in-place nonce patching with integer target"""
+    block, cb_config = load_block(555444)
+    job = Job(template_from_block(block, cb_config))
+    shares = [nonce.to_bytes(4, "big") for nonce in range(1000)]
+    shares.append(block["nonce"].to_bytes(4, "big"))
+    for share in shares:
+        assert hex_check_nonce(job, share.hex()) == Miner.check_nonce(job, share)
+
+    print(f"Share validation (block #{block['height']}, logging level {logger.level})")
+    number = 100
+    seconds = timeit.timeit(
+        lambda: [hex_check_nonce(job, share.hex()) for share in shares], number=number
+    )
+    report("block header from hex nonce", seconds, number * len(shares), "share")
+    seconds = timeit.timeit(
+        lambda: [Miner.check_nonce(job, share) for share in shares], number=number
+    )
+    report("Miner.check_nonce", seconds, number * len(shares), "share")
+
+
+def bench_sha256d_engines() -> None:
+    """Nonce scanning: hashlib one nonce at a time vs. numpy batches"""
+    if sha256d_batch.np is None:
+        print("SHA256d engines: skipped (numpy is not installed)")
+        return
+    block, cb_config = load_block(555444)
+    job = Job(template_from_block(block, cb_config))
+    header = job.block_header()
+    nonce, count = block["nonce"] - 0x10000, 0x20000
+    assert scanhash(header, nonce, count) == scanhash(header, nonce, count, "numpy")
+
+    print(f"SHA256d engines (block #{block['height']})")
+    seconds = timeit.timeit(lambda: scanhash(header, nonce, count), number=1)
+    report("scanhash (hashlib)", seconds, count, "hash")
+    seconds = timeit.timeit(lambda: scanhash(header, nonce, count, "numpy"), number=1)
+    report("scanhash (numpy)", seconds, count, "hash")
+
+
+def bench_midstates() -> None:
+    """Midstates for the jobs of many devices: scalar calculate_midstate vs. vectorized numpy backend"""
+    block, cb_config = load_block(555444)
+    jobs = BlockTemplate(
+        template_dict_from_block(block, cb_config["value"]),
+        dict(cb_config, extranonce_size=4),
+    ).jobs()
+    headers = [next(jobs).block_header() for _ in range(1024)]
+    vectorized = sha256d_batch.np is not None
+    if vectorized:
+        assert calculate_midstates(headers) == calculate_midstates(headers, True)
+
+    print(f"Midstates (block #{block['height']}, one job per device)")
+    for devices in (8, 1024):
+        number = max(1, 4096 // devices)
+        seconds = timeit.timeit(
+            lambda: calculate_midstates(headers[:devices]), number=number
+        )
+        report(f"scalar, {devices} headers", seconds, number * devices, "header")
+        if vectorized:
+            seconds = timeit.timeit(
+                lambda: calculate_midstates(headers[:devices], True), number=number
+            )
+            report(
+                f"vectorized, {devices} headers", seconds, number * devices, "header"
+            )
+
+
+BENCHMARKS = [
+    bench_merkle_root,
+    bench_coinbase,
+    bench_block_template,
+    bench_check_nonce,
+    bench_sha256d_engines,
+    bench_midstates,
+]
+
+if __name__ == "__main__":
+    for benchmark in BENCHMARKS:
+        benchmark()
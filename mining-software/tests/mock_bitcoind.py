@@ -0,0 +1,136 @@
+#  Copyright (C) 2022 Jan Sturm
+#
+#  This program is free software: you can redistribute it and/or modify it under
+#  the terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  This program is distributed in the hope that it will be useful, but WITHOUT
+#  ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or FITNESS
+#  FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Local JSON-RPC server that stands in for bitcoind in tests"""
+
+import copy
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockBitcoind:
+    """
+    Minimal bitcoind JSON-RPC server stand-in, running in a background thread.
+
+    Serves the given getblocktemplate results (one per chain tip) including BIP 22 long polling,
+    and records all blocks passed to submitblock. Like bitcoind, it supports HTTP/1.1 keep-alive and JSON-RPC batches,
+    and responds to failed calls with HTTP status 500.
+
+    :param templates: getblocktemplate results, the n-th template is served for the n-th chain tip
+    """
+
+    def __init__(self, templates: list[dict]):
+        self.templates = templates
+        self.tip = 0
+        self.blocks = []
+        self.calls = []
+        self.connections = 0
+        # delay in seconds of each response (except long polls)
+        self.delay = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                mock.connections += 1
+
+            def do_POST(self):
+                request = json.loads(
+                    self.rfile.read(int(self.headers["Content-Length"]))
+                )
+                if isinstance(request, list):
+                    status, response = 200, [mock.respond(r) for r in request]
+                else:
+                    response = mock.respond(request)
+                    status = 500 if response["error"] else 200
+                body = json.dumps(response).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except ConnectionError:
+                    # the client gave up (timeout or cancelled hedged request)
+                    self.close_connection = True
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    @property
+    def server(self) -> str:
+        """ip address and port of the server"""
+        host, port = self.httpd.server_address[:2]
+        return f"{host}:{port}"
+
+    def new_tip(self) -> None:
+        """Simulates a new block on the network, i.e. all pending long polls return the next template"""
+        with self.cond:
+            self.tip += 1
+            self.cond.notify_all()
+
+    def respond(self, request: dict) -> dict:
+        """Handles a single JSON-RPC request"""
+        try:
+            result, error = self.dispatch(request["method"], request["params"]), None
+        except Exception as e:
+            result, error = None, dict(code=-1, message=str(e))
+        return dict(result=result, error=error, id=request["id"])
+
+    def dispatch(self, method: str, params: list):
+        self.calls.append(method)
+        longpoll = (
+            bool(params) and isinstance(params[0], dict) and "longpollid" in params[0]
+        )
+        if self.delay and not longpoll:
+            time.sleep(self.delay)
+        if method == "getblocktemplate":
+            longpollid = params[0].get("longpollid") if params else None
+            with self.cond:
+                self.cond.wait_for(
+                    lambda: self.closed or longpollid != f"lp{self.tip}", timeout=30
+                )
+                template = copy.deepcopy(self.templates[self.tip % len(self.templates)])
+                template["longpollid"] = f"lp{self.tip}"
+            return template
+        if method == "submitblock":
+            self.blocks.append(params[0])
+            return None
+        if method == "getblockcount":
+            return self.tip
+        if method == "getbestblockhash":
+            return self.templates[self.tip % len(self.templates)]["previousblockhash"]
+        raise Exception(f"Method not found: {method}")
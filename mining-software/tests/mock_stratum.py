@@ -0,0 +1,110 @@
+#  Copyright (C) 2022 Jan Sturm
+#
+#  This program is free software: you can redistribute it and/or modify it under
+#  the terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  This program is distributed in the hope that it will be useful, but WITHOUT
+#  ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or FITNESS
+#  FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Local Stratum V1 server that stands in for a pool in tests"""
+
+import asyncio
+import json
+
+
+class MockStratumServer:
+    """
+    Minimal Stratum V1 server stand-in, running in the event loop of the test.
+
+    Each subscribed client gets the difficulty and the latest job right after mining.subscribe (delayed by
+    'job_delay' seconds). Every mining.submit is recorded and accepted (or rejected with error 23, if 'reject' is set).
+
+    :param job: parameters of the first mining.notify
+    :param difficulty: share difficulty
+    :param extranonce1: extranonce1 (hex) of all connections
+    :param extranonce2_size: size of the extranonce2 in bytes
+    """
+
+    def __init__(
+        self,
+        job: list,
+        difficulty: float = 1,
+        extranonce1: str = "f000000a",
+        extranonce2_size: int = 4,
+    ):
+        self.job = job
+        self.difficulty = difficulty
+        self.extranonce1 = extranonce1
+        self.extranonce2_size = extranonce2_size
+        self.reject = False
+        self.job_delay = 0.0
+        self.subscriptions = 0
+        self.submits = []
+        self.writers: list[asyncio.StreamWriter] = []
+        self.server = None
+        self.port = None
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self) -> None:
+        self.disconnect()
+        self.server.close()
+        await self.server.wait_closed()
+
+    def disconnect(self) -> None:
+        """Closes the connections to all clients"""
+        for writer in self.writers:
+            writer.close()
+        self.writers = []
+
+    def send(self, writer: asyncio.StreamWriter, message: dict) -> None:
+        writer.write(json.dumps(message).encode() + b"\n")
+
+    def notify(self, job: list) -> None:
+        """Sends a new job to all clients"""
+        self.job = job
+        for writer in self.writers:
+            self.send(writer, dict(id=None, method="mining.notify", params=job))
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        self.writers.append(writer)
+        try:
+            while line := await reader.readline():
+                request = json.loads(line)
+                method, params = request["method"], request["params"]
+                result, error = True, None
+                if method == "mining.subscribe":
+                    self.subscriptions += 1
+                    result = [[], self.extranonce1, self.extranonce2_size]
+                elif method == "mining.submit":
+                    self.submits.append(params)
+                    if self.reject:
+                        result, error = None, [23, "Low difficulty share", None]
+                self.send(writer, dict(id=request["id"], result=result, error=error))
+                if method == "mining.subscribe":
+                    self.send(
+                        writer,
+                        dict(
+                            id=None,
+                            method="mining.set_difficulty",
+                            params=[self.difficulty],
+                        ),
+                    )
+                    await writer.drain()
+                    await asyncio.sleep(self.job_delay)
+                    self.send(
+                        writer, dict(id=None, method="mining.notify", params=self.job)
+                    )
+                await writer.drain()
+        except ConnectionError:
+            pass
@@ -0,0 +1,77 @@
+#  Copyright (C) 2022 Jan Sturm
+#
+#  This program is free software: you can redistribute it and/or modify it under
+#  the terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  This program is distributed in the hope that it will be useful, but WITHOUT
+#  ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or FITNESS
+#  FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Variable share difficulty (vardiff), i.e. a share target per device that follows the hashrate of the device"""
+
+from fractions import Fraction
+from typing import Optional
+
+from mining_device import SHARE_TARGET
+
+# default share target of the mining firmware (as integer)
+DEFAULT_SHARE_TARGET = int.from_bytes(SHARE_TARGET, byteorder="big")
+
+
+class VarDiff:
+    """
+    Controller for the share target of a single device.
+
+    The share rate of the device is measured over 'retarget_interval' seconds. If it deviates by more than
+    'tolerance' from 'shares_per_minute', the target is scaled accordingly (by at most 'max_step' per retarget).
+
+    :param config: vardiff config (see [vardiff] in config.toml)
+    :param now: current time in seconds (monotonic), start of the first measurement
+    :param target: initial share target of the device
+    """
+
+    def __init__(self, config: dict, now: float, target: int = DEFAULT_SHARE_TARGET):
+        self.shares_per_minute = config.get("shares_per_minute", 6)
+        self.retarget_interval = config.get("retarget_interval", 60)
+        self.max_target = int(config.get("max_target", "00" + "FF" * 31), 16)
+        self.min_target = int(config.get("min_target", "00" * 8 + "FF" * 24), 16)
+        self.tolerance = config.get("tolerance", 0.25)
+        self.max_step = config.get("max_step", 4)
+        self.target = target
+        self.shares = 0
+        self.since = now
+
+    def __str__(self):
+        return f"<VarDiff [target={self.target:064x}, shares/min={self.shares_per_minute}]>"
+
+    def share(self) -> None:
+        """Records a share of the device"""
+        self.shares += 1
+
+    def retarget(self, now: float) -> Optional[int]:
+        """
+        Computes a new share target once the current measurement is complete
+
+        :param now: current time in seconds (monotonic)
+        :return: the new share target, or None if the target is unchanged
+        """
+        elapsed = now - self.since
+        if elapsed < self.retarget_interval:
+            return None
+        ratio = (self.shares / elapsed * 60) / self.shares_per_minute
+        self.shares, self.since = 0, now
+        if abs(ratio - 1) <= self.tolerance:
+            return None
+        # too many shares require a smaller target (and vice versa)
+        ratio = min(max(ratio, 1 / self.max_step), self.max_step)
+        target = int(self.target / Fraction(ratio))
+        target = min(max(target, self.min_target), self.max_target)
+        if target == self.target:
+            return None
+        self.target = target
+        return target
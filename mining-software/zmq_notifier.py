@@ -0,0 +1,91 @@
+#  Copyright (C) 2022 Jan Sturm
+#
+#  This program is free software: you can redistribute it and/or modify it under
+#  the terms of the GNU General Public License as published by the Free Software
+#  Foundation, either version 3 of the License, or (at your option) any later
+#  version.
+#
+#  This program is distributed in the hope that it will be useful, but WITHOUT
+#  ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or FITNESS
+#  FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Optional ZMQ notification source (requires pyzmq) that triggers block template refreshes"""
+
+from typing import Callable
+
+from custom_logger import logger
+
+try:
+    import zmq
+    import zmq.asyncio
+except ImportError:
+    zmq = None
+
+
+class ZMQNotifier:
+    """
+    Subscribes to the ZMQ notifications of bitcoind (see https://github.com/bitcoin/bitcoin/blob/master/doc/zmq.md)
+    and requests a new block template
+
+    - as soon as a new block is announced via 'hashblock', or
+    - after 'tx_threshold' new mempool transactions were announced via 'hashtx' (if configured)
+
+    :param config: zmq config (see [zmq] in config.toml)
+    :param on_refresh: callback that requests a new block template
+    """
+
+    def __init__(self, config: dict, on_refresh: Callable[[str], None]):
+        if zmq is None:
+            raise ImportError("ZMQ notifications require the package 'pyzmq'")
+        self.hashblock = config["hashblock"]
+        self.hashtx = config.get("hashtx")
+        self.tx_threshold = config.get("tx_threshold", 10)
+        self.on_refresh = on_refresh
+        self.new_transactions = 0
+
+    def __str__(self):
+        return f"<ZMQNotifier [hashblock={self.hashblock}, hashtx={self.hashtx}]>"
+
+    def handle(self, topic: bytes, body: bytes) -> None:
+        """
+        Handles a single notification
+
+        :param topic: 'hashblock' or 'hashtx'
+        :param body: 32 byte block hash or transaction id
+        """
+        if topic == b"hashblock":
+            logger.debug(f"ZMQ<hashblock> {body.hex()}")
+            self.new_transactions = 0
+            self.on_refresh(f"new block {body.hex()}")
+        elif topic == b"hashtx":
+            self.new_transactions += 1
+            if self.new_transactions >= self.tx_threshold:
+                self.new_transactions = 0
+                self.on_refresh(f"{self.tx_threshold} new transactions")
+
+    async def run(self) -> None:
+        """Receives notifications until cancelled"""
+        ctx = zmq.asyncio.Context()
+        socket = ctx.socket(zmq.SUB)
+        try:
+            socket.connect(self.hashblock)
+            socket.setsockopt(zmq.SUBSCRIBE, b"hashblock")
+            if self.hashtx:
+                if self.hashtx != self.hashblock:
+                    socket.connect(self.hashtx)
+                socket.setsockopt(zmq.SUBSCRIBE, b"hashtx")
+            logger.info(f"Subscribed to {self}")
+            while True:
+                # [topic | body | 4 byte sequence number]
+                topic, body, *_ = await socket.recv_multipart()
+                self.handle(topic, body)
+        except zmq.ZMQError as e:
+            logger.error(
+                f"ZMQ notifications unavailable ({e}), falling back to polling"
+            )
+        finally:
+            socket.close(linger=0)
+            ctx.term()